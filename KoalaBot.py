@@ -229,6 +229,9 @@ async def on_command_error(ctx, error):
 if __name__ == "__main__":  # pragma: no cover
     os.system("title " + "KoalaBot")
     database_manager.create_base_tables()
+    database_manager.load_guild_extensions()
     load_all_cogs()
+    logging.info(f"Database startup report:\n{database_manager.startup_report()}")
     # Starts bot using the given BOT_ID
     client.run(BOT_TOKEN)
+    database_manager.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot database read/write contention benchmark
+Runs a mixed load of reader threads (like the reaction and message listeners) alongside a writer thread (like the
+Twitch loops), and reports the throughput and latency percentiles of each. The load goes through the database threads
+like the awaitable API the bot uses, so without the read-only connection pool reads queue on the database thread with
+the writes. Every combination of SQLite's default rollback journal or the KoalaDBManager engine profile, with or
+without the reader pool, is run, so each row differs from its neighbour in one setting. Run from the root of the
+project:
+
+    python benchmarks/db_contention_benchmark.py
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Own modules
+from utils import KoalaDBManager
+
+# Constants
+DB_PATH = "KoalaContentionBenchmark.db"
+DB_KEY = "2DD29CA851E7B56E4697B0E1F08507293D761A05CE4D1B628663F411A8086D99"
+# Name, engine profile, and whether selects use the read-only connection pool
+PROFILES = [("rollback one thread", {}, False),
+            ("rollback pool", {}, True),
+            ("WAL one thread", KoalaDBManager.DEFAULT_ENGINE_PROFILE, False),
+            ("WAL pool", KoalaDBManager.DEFAULT_ENGINE_PROFILE, True)]
+
+
+def remove_database(db_file_path):
+    """
+    Removes the benchmark database along with any journal files
+
+    :param db_file_path: The path of the database file
+    """
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        try:
+            os.remove(db_file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def percentile(latencies, p):
+    """
+    Gets a percentile of a list of latencies
+
+    :param latencies: Sorted list of latencies
+    :param p: The percentile to get, e.g. 99
+    :return: The latency at the percentile
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def run_profile(name, profile, reader_pool, readers, duration):
+    """
+    Runs the mixed load against a fresh database with the given engine profile
+
+    :param name: The name of the profile to print
+    :param profile: The engine profile passed to KoalaDBManager
+    :param reader_pool: False to run selects on the database thread with the writes
+    :param readers: The number of reader threads
+    :param duration: Seconds to run the load for
+    """
+    db_manager = KoalaDBManager.KoalaDBManager(DB_PATH, DB_KEY, pool_size=readers if reader_pool else 0,
+                                               engine_profile=profile)
+    remove_database(db_manager.db_file_path)
+    db_manager.create_base_tables()
+    db_manager.db_execute_many("INSERT INTO GuildExtensions VALUES (?, ?)", [("All", guild_id)
+                                                                             for guild_id in range(1000)])
+    read_latencies, write_latencies = [], []
+    stop = threading.Event()
+    read_executor = db_manager.get_reader_executor()
+    write_executor = db_manager.get_executor()
+
+    def reader(seed):
+        i = seed
+        while not stop.is_set():
+            start = time.perf_counter()
+            read_executor.submit(db_manager.db_execute_select,
+                                 "SELECT extension_id FROM GuildExtensions WHERE guild_id = ?", [i % 1000]).result()
+            read_latencies.append(time.perf_counter() - start)
+            i += 1
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            write_executor.submit(db_manager.db_execute_commit,
+                                  "UPDATE GuildExtensions SET extension_id = ? WHERE guild_id = ?",
+                                  ["All", i % 1000]).result()
+            write_latencies.append(time.perf_counter() - start)
+            i += 1
+
+    threads = [threading.Thread(target=reader, args=[seed]) for seed in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for kind, latencies in [("read", sorted(read_latencies)), ("write", sorted(write_latencies))]:
+        print(f"{name:<19} {kind:<6} {len(latencies) / duration:>8.0f} ops/s  "
+              f"p50 {percentile(latencies, 50) * 1000:>7.3f}ms  p99 {percentile(latencies, 99) * 1000:>7.3f}ms  "
+              f"max {percentile(latencies, 100) * 1000:>8.3f}ms")
+
+    db_manager.close()
+    remove_database(db_manager.db_file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=4, help="number of reader threads")
+    parser.add_argument("--duration", type=float, default=5, help="seconds to run each profile for")
+    args = parser.parse_args()
+
+    for name, profile, reader_pool in PROFILES:
+        run_profile(name, profile, reader_pool, args.readers, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot database connection pool benchmark
+Compares opening a new connection for every query against the pooled KoalaDBManager, for both encrypted and
+unencrypted databases. Run from the root of the project:
+
+    python benchmarks/db_pool_benchmark.py
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Constants
+DB_PATH = "KoalaPoolBenchmark.db"
+DB_KEY = "2DD29CA851E7B56E4697B0E1F08507293D761A05CE4D1B628663F411A8086D99"
+SQL_SELECT = "SELECT extension_id FROM GuildExtensions WHERE guild_id = ?"
+
+
+def setup_database(db_manager):
+    """
+    Creates the base tables and fills GuildExtensions with some guilds to query
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    """
+    db_manager.create_base_tables()
+    db_manager.db_execute_commit("DELETE FROM GuildExtensions")
+    for guild_id in range(100):
+        db_manager.db_execute_commit("INSERT INTO GuildExtensions VALUES (?, ?)", args=["All", guild_id])
+
+
+def connect_per_query(db_manager, queries):
+    """
+    The previous behaviour, a new (keyed) connection is opened and closed for every query
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    :param queries: The number of queries to run
+    """
+    for i in range(queries):
+        conn, c = db_manager.create_connection()
+        c.execute(SQL_SELECT, [i % 100])
+        c.fetchall()
+        c.close()
+        conn.close()
+
+
+def pooled(db_manager, queries):
+    """
+    Runs the queries through db_execute_select, which borrows connections from the pool
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    :param queries: The number of queries to run
+    """
+    for i in range(queries):
+        db_manager.db_execute_select(SQL_SELECT, args=[i % 100])
+
+
+def run_mode(queries):
+    """
+    Runs the benchmark in the encryption mode given by the ENCRYPTED environment variable
+
+    :param queries: The number of queries to run for each strategy
+    """
+    from utils import KoalaDBManager
+
+    db_manager = KoalaDBManager.KoalaDBManager(DB_PATH, DB_KEY)
+    setup_database(db_manager)
+    mode = "unencrypted" if os.name == 'nt' or not KoalaDBManager.ENCRYPTED_DB else "encrypted"
+
+    for name, strategy in [("connect per query", connect_per_query), ("pooled", pooled)]:
+        start = time.perf_counter()
+        strategy(db_manager, queries)
+        elapsed = time.perf_counter() - start
+        print(f"{mode:<12} {name:<18} {queries / elapsed:>10.0f} queries/s")
+
+    db_manager.close()
+    os.remove(db_manager.db_file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=5000, help="queries to run for each strategy")
+    parser.add_argument("--mode", choices=["encrypted", "unencrypted"],
+                        help="run a single mode in this process (used internally)")
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.queries)
+        return
+
+    # ENCRYPTED is read when KoalaDBManager is imported, so each mode runs in its own process
+    for mode in ["unencrypted", "encrypted"]:
+        env = dict(os.environ, ENCRYPTED=str(mode == "encrypted"))
+        result = subprocess.run([sys.executable, __file__, "--mode", mode, "--queries", str(args.queries)], env=env)
+        if result.returncode != 0:
+            print(f"{mode} benchmark failed, is pysqlcipher3 installed?")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot database row mapping benchmark
+Compares fetching every UserInTwitchAlert row with SELECT * into plain tuples against projecting only the needed
+columns into row_type records, and against streaming the projected records with db_execute_select_iter. Reports the
+time taken and the peak memory allocated by each. Run from the root of the project:
+
+    python benchmarks/db_row_benchmark.py
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Own modules
+from utils import KoalaDBManager
+
+# Constants
+DB_PATH = "KoalaRowBenchmark.db"
+DB_KEY = "2DD29CA851E7B56E4697B0E1F08507293D761A05CE4D1B628663F411A8086D99"
+SQL_CREATE_USER_IN_TWITCH_ALERT = """
+CREATE TABLE IF NOT EXISTS UserInTwitchAlert (
+channel_id integer NOT NULL,
+twitch_username text NOT NULL,
+custom_message text,
+message_id integer,
+PRIMARY KEY (channel_id, twitch_username)
+);"""
+UsernameRow = KoalaDBManager.row_type("UsernameRow", ["twitch_username", "message_id"])
+
+
+def select_all(db_manager):
+    """
+    The previous behaviour, every column of every row is fetched into a list of tuples
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    :return: The number of live users
+    """
+    return sum(1 for row in db_manager.db_execute_select("SELECT * FROM UserInTwitchAlert") if row[3] is not None)
+
+
+def select_projected(db_manager):
+    """
+    Only the needed columns are fetched, into a list of row_type records
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    :return: The number of live users
+    """
+    rows = db_manager.db_execute_select(f"SELECT {UsernameRow.columns} FROM UserInTwitchAlert", row=UsernameRow)
+    return sum(1 for row in rows if row.message_id is not None)
+
+
+def select_streamed(db_manager):
+    """
+    Only the needed columns are fetched, and the records are streamed a batch at a time
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    :return: The number of live users
+    """
+    rows = db_manager.db_execute_select_iter(f"SELECT {UsernameRow.columns} FROM UserInTwitchAlert", row=UsernameRow)
+    return sum(1 for row in rows if row.message_id is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000, help="number of UserInTwitchAlert rows")
+    parser.add_argument("--repeat", type=int, default=5, help="times to run each strategy")
+    args = parser.parse_args()
+
+    db_manager = KoalaDBManager.KoalaDBManager(DB_PATH, DB_KEY)
+    db_manager.db_execute_commit("DROP TABLE IF EXISTS UserInTwitchAlert")
+    db_manager.db_execute_commit(SQL_CREATE_USER_IN_TWITCH_ALERT)
+    db_manager.db_execute_many("INSERT INTO UserInTwitchAlert VALUES (?, ?, ?, ?)",
+                               [(i % 100, f"streamer_{i}", "A custom message for this streamer going live",
+                                 i if i % 10 == 0 else None) for i in range(args.rows)])
+
+    for name, strategy in [("SELECT * tuples", select_all), ("projected rows", select_projected),
+                           ("streamed rows", select_streamed)]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            strategy(db_manager)
+        elapsed = (time.perf_counter() - start) / args.repeat
+
+        tracemalloc.start()
+        strategy(db_manager)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:<16} {elapsed * 1000:>8.1f}ms  peak {peak / 1024 / 1024:>7.2f}MiB")
+
+    db_manager.close()
+    for suffix in ["", "-wal", "-shm"]:
+        try:
+            os.remove(db_manager.db_file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot text filter benchmark
+Fills a guild with filtered words and regexes and checks a stream of messages against them, comparing the previous
+on_message behaviour of querying the guild's filters for every message and checking them one at a time, against the
+cached FilterMatcher of the guild. The previous behaviour is slow with many filters, so it only checks the first
+--baseline-messages messages, and the matches of both are compared on those. Run from the root of the project:
+
+    python benchmarks/text_filter_benchmark.py
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+
+# Own modules
+from cogs import TextFilter
+from utils import KoalaDBManager
+
+# Constants
+DB_PATH = "KoalaTextFilterBenchmark.db"
+DB_KEY = "2DD29CA851E7B56E4697B0E1F08507293D761A05CE4D1B628663F411A8086D99"
+GUILD_ID = 1
+
+
+def remove_database(db_file_path):
+    """
+    Removes the benchmark database along with any journal files
+
+    :param db_file_path: The path of the database file
+    """
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        try:
+            os.remove(db_file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def random_word(rng):
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 10)))
+
+
+def generate_filters(db_manager, filters, regex_share, rng):
+    """
+    Adds the filtered words and regexes of the benchmark guild
+
+    :param db_manager: The TextFilterDBManager of the benchmark database
+    :param filters: The number of filters
+    :param regex_share: The share of the filters that are regexes
+    :param rng: The random number generator
+    :return: The filtered words
+    """
+    words = set()
+    while len(words) < filters:
+        words.add(random_word(rng))
+    words = sorted(words)
+    rng.shuffle(words)
+    regexes = int(filters * regex_share)
+    for i, word in enumerate(words):
+        filter_type = "risky" if i % 3 == 0 else "banned"
+        if i < regexes:
+            db_manager.new_filtered_text(GUILD_ID, f"{word[:3]}[0-9]+{word[3:]}", filter_type, True)
+        else:
+            db_manager.new_filtered_text(GUILD_ID, word, filter_type, False)
+    return words
+
+
+def generate_messages(words, messages, match_share, rng):
+    """
+    Generates messages of random words, some of which contain a filtered word
+
+    :param words: The filtered words
+    :param messages: The number of messages
+    :param match_share: The share of the messages that contain a filtered word
+    :param rng: The random number generator
+    :return: The content of each message
+    """
+    vocabulary = [random_word(rng) for _ in range(2000)]
+    contents = []
+    for _ in range(messages):
+        message = [rng.choice(vocabulary) for _ in range(rng.randint(3, 30))]
+        if rng.random() < match_share:
+            word = rng.choice(words)
+            if rng.random() < 0.5:
+                word = f"{word[:3]}{rng.randint(0, 99)}{word[3:]}"
+            message[rng.randrange(len(message))] = word
+        contents.append(" ".join(message))
+    return contents
+
+
+def check_one_at_a_time(db_manager, content):
+    """
+    The previous behaviour, the filters of the guild are queried and checked one at a time
+
+    :param db_manager: The TextFilterDBManager of the benchmark database
+    :param content: The content of the message
+    :return: The first filter that matches, or None
+    """
+    for word, filter_type, is_regex in db_manager.get_filtered_text_for_guild(GUILD_ID):
+        if word in content or (is_regex == '1' and re.search(word, content)):
+            if filter_type in ["risky", "banned"]:
+                return word, filter_type, is_regex
+    return None
+
+
+def check_matcher(db_manager, content):
+    """
+    The guild's filters are compiled once into a FilterMatcher, which every message is checked against
+
+    :param db_manager: The TextFilterDBManager of the benchmark database
+    :param content: The content of the message
+    :return: The first filter that matches, or None
+    """
+    matcher = db_manager.matchers.get(GUILD_ID)
+    if matcher is None:
+        matcher = db_manager.get_matcher(GUILD_ID)
+    return matcher.match(content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filters", type=int, default=5000, help="number of filters in the guild")
+    parser.add_argument("--regex-share", type=float, default=0.05, help="share of the filters that are regexes")
+    parser.add_argument("--messages", type=int, default=100000, help="number of messages checked")
+    parser.add_argument("--match-share", type=float, default=0.05, help="share of messages with a filtered word")
+    parser.add_argument("--baseline-messages", type=int, default=2000,
+                        help="number of messages checked one filter at a time")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated filters and messages")
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    database_manager = KoalaDBManager.KoalaDBManager(DB_PATH, DB_KEY)
+    remove_database(database_manager.db_file_path)
+    db_manager = TextFilter.TextFilterDBManager(database_manager, None)
+    db_manager.create_tables()
+    words = generate_filters(db_manager, args.filters, args.regex_share, rng)
+    contents = generate_messages(words, args.messages, args.match_share, rng)
+
+    start = time.perf_counter()
+    db_manager.get_matcher(GUILD_ID)
+    print(f"Compiled {args.filters} filters in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    results = {}
+    for name, strategy, messages in [("one at a time", check_one_at_a_time, contents[:args.baseline_messages]),
+                                     ("compiled matcher", check_matcher, contents)]:
+        start = time.perf_counter()
+        results[name] = [strategy(db_manager, content) for content in messages]
+        elapsed = time.perf_counter() - start
+        matches = sum(1 for result in results[name] if result is not None)
+        print(f"{name:<17} {len(messages):>7} messages  {elapsed:>7.2f}s  "
+              f"{elapsed / len(messages) * 1000000:>9.1f}us/message  {matches} matched")
+
+    baseline = results["one at a time"]
+    mismatches = sum(1 for old, new in zip(baseline, results["compiled matcher"]) if old != new)
+    print(f"{mismatches} of {len(baseline)} messages matched differently")
+
+    database_manager.close()
+    remove_database(database_manager.db_file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot Twitch poll scheduler simulation
+Simulates weeks of streamers with daily, weekly, occasional and no streams, and compares polling every streamer every
+loop against the adaptive PollScheduler of TwitchAlert. Reports the Helix streams requests per hour, the streamers
+polled per hour, and the latency from a stream going live to the poll that sees it. Run from the root of the project:
+
+    python benchmarks/twitch_poll_scheduler_benchmark.py
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import bisect
+import calendar
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+
+# Own modules
+from cogs import TwitchAlert
+
+# Constants
+START = calendar.timegm((2021, 6, 7, 0, 0, 0))
+DAY = 24 * 60 * 60
+LOOP = TwitchAlert.LOOP_CHECK_LIVE_DELAY * 60
+# Kind of streamer and share of the streamers
+KINDS = [("daily", 0.3), ("weekly", 0.3), ("occasional", 0.2), ("never", 0.2)]
+
+
+def percentile(latencies, p):
+    """
+    Gets a percentile of a list of latencies
+
+    :param latencies: Sorted list of latencies
+    :param p: The percentile to get, e.g. 99
+    :return: The latency at the percentile
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def generate_streams(kind, days, rng):
+    """
+    Generates the streams of a streamer
+
+    :param kind: The kind of streamer, from KINDS
+    :param days: The number of days simulated
+    :param rng: The random number generator
+    :return: Sorted list of the start and end time of each stream
+    """
+    hour = rng.randrange(24)
+    weekday = rng.randrange(7)
+    streams = []
+    for day in range(days):
+        if kind == "daily" and rng.random() < 0.85:
+            start = START + day * DAY + hour * 3600 + rng.gauss(0, 1800)
+        elif kind == "weekly" and day % 7 == weekday:
+            start = START + day * DAY + hour * 3600 + rng.gauss(0, 1800)
+        elif kind == "occasional" and rng.random() < 1 / 20:
+            start = START + day * DAY + rng.uniform(0, DAY)
+        else:
+            continue
+        start = max(start, streams[-1][1] if streams else START)
+        streams.append((start, start + rng.uniform(1, 4) * 3600))
+    return streams
+
+
+def is_live(streams, starts, t):
+    i = bisect.bisect_right(starts, t) - 1
+    return i >= 0 and streams[i][0] <= t < streams[i][1]
+
+
+def simulate(streamers, days, adaptive):
+    """
+    Runs the live loop over the simulated streams
+
+    :param streamers: dict of username to the streams of the streamer
+    :param days: The number of days simulated
+    :param adaptive: True to poll with a PollScheduler, False to poll every streamer every loop
+    :return: The Helix requests, streamers polled, and sorted alert latencies
+    """
+    scheduler = TwitchAlert.PollScheduler()
+    starts = {username: [start for start, _ in streams] for username, streams in streamers.items()}
+    usernames = list(streamers)
+    alerted = set()
+    requests = polled_total = 0
+    latencies = []
+    for tick in range(int(days * DAY / LOOP)):
+        now = START + tick * LOOP
+        polled = scheduler.due(usernames, now) if adaptive else usernames
+        requests += math.ceil(len(polled) / TwitchAlert.TWITCH_BATCH_SIZE)
+        polled_total += len(polled)
+        for username in polled:
+            streams = streamers[username]
+            live = is_live(streams, starts[username], now)
+            if adaptive:
+                scheduler.observe(username, live, now)
+            if live:
+                stream = streams[bisect.bisect_right(starts[username], now) - 1]
+                if stream not in alerted:
+                    alerted.add(stream)
+                    latencies.append(now - stream[0])
+    return requests, polled_total, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streamers", type=int, default=500, help="number of subscribed streamers")
+    parser.add_argument("--days", type=int, default=21, help="days to simulate")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    streamers = {}
+    for i in range(args.streamers):
+        kind = rng.choices([kind for kind, _ in KINDS], [share for _, share in KINDS])[0]
+        streamers[f"{kind}_{i}"] = generate_streams(kind, args.days, rng)
+    hours = args.days * 24
+
+    for name, adaptive in [("every loop", False), ("adaptive", True)]:
+        requests, polled, latencies = simulate(streamers, args.days, adaptive)
+        print(f"{name:<11} {requests / hours:>7.1f} requests/h  {polled / hours:>8.0f} polled/h  "
+              f"latency p50 {percentile(latencies, 50):>5.0f}s  p95 {percentile(latencies, 95):>5.0f}s  "
+              f"max {percentile(latencies, 100):>5.0f}s  ({len(latencies)} streams)")
+
+
+if __name__ == "__main__":
+    main()
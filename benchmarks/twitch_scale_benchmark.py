@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot TwitchAlert scale benchmark
+Fills a database with TwitchAlerts, user alerts and team alerts spread over thousands of dpytest guilds, serves a
+local stand-in for the Helix API with a configurable live ratio and latency, and runs loop_check_live against them.
+Between passes some live streamers go offline and some offline streamers go live, and every streamer is polled each
+pass rather than on the adaptive schedule, which is the worst case of a loop. Each pass reports the loop
+duration, the time spent in the database and in twitch requests, and the discord messages sent and deleted.
+Nothing leaves the machine, so it runs offline. Run from the root of the project:
+
+    python benchmarks/twitch_scale_benchmark.py
+    python benchmarks/twitch_scale_benchmark.py --guilds 50 --subscriptions 500 --passes 2
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+
+# Libs
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import discord
+from discord.ext import commands
+import discord.ext.test as dpytest
+
+# Own modules
+import KoalaBot
+from cogs import TwitchAlert
+from utils import KoalaDBManager
+
+# Constants
+DB_PATH = "KoalaTwitchScaleBenchmark.db"
+DB_KEY = "2DD29CA851E7B56E4697B0E1F08507293D761A05CE4D1B628663F411A8086D99"
+GAMES = 50
+
+
+def remove_database(db_file_path):
+    """
+    Removes the benchmark database along with any journal files
+
+    :param db_file_path: The path of the database file
+    """
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        try:
+            os.remove(db_file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def create_helix_app(streamers, teams, live_ratio, latency, rng):
+    """
+    Creates a stand-in for the Helix API. Each streamer is live with probability live_ratio, and every request waits
+    for latency seconds before it is answered
+
+    :param streamers: The usernames of every streamer
+    :param teams: dict of team name to the usernames of its members
+    :param live_ratio: The share of streamers that are live
+    :param latency: Seconds each request takes
+    :param rng: The random number generator
+    :return: The aiohttp application, with the set of live usernames in app["state"]["live"]
+    """
+    app = web.Application()
+    state = app["state"] = {"live": set(rng.sample(streamers, int(len(streamers) * live_ratio)))}
+
+    async def respond(data):
+        await asyncio.sleep(latency)
+        return web.json_response(data)
+
+    async def oauth(request):
+        return await respond({"access_token": "benchmark", "expires_in": 3600, "token_type": "bearer"})
+
+    async def streams(request):
+        return await respond({"data": [{"id": f"stream_{login}", "user_login": login, "user_name": login,
+                                        "game_id": str(int(login.rsplit("_", 1)[1]) % GAMES), "type": "live",
+                                        "title": f"{login} is live"}
+                                       for login in request.query.getall("user_login", [])
+                                       if login in state["live"]]})
+
+    async def users(request):
+        return await respond({"data": [{"id": f"id_{login}", "login": login, "display_name": login,
+                                        "profile_image_url": f"https://example.com/{login}.png"}
+                                       for login in request.query.getall("login", [])]})
+
+    async def games(request):
+        return await respond({"data": [{"id": game_id, "name": f"Game {game_id}"}
+                                       for game_id in request.query.getall("id", [])]})
+
+    async def team(request):
+        members = teams.get(request.query.get("name"), [])
+        return await respond({"data": [{"users": [{"user_id": f"id_{login}", "user_login": login,
+                                                   "user_name": login} for login in members]}]})
+
+    app.router.add_post("/oauth2/token", oauth)
+    app.router.add_get("/helix/streams", streams)
+    app.router.add_get("/helix/users", users)
+    app.router.add_get("/helix/games", games)
+    app.router.add_get("/helix/teams", team)
+    return app
+
+
+def generate_alerts(db_manager, channels, streamers, subscriptions, team_share, team_size, rng):
+    """
+    Fills the TwitchAlert tables. Every channel gets a TwitchAlert, and the subscriptions are split between user
+    alerts and the members of team alerts
+
+    :param db_manager: The KoalaDBManager of the benchmark database
+    :param channels: The dpytest text channels
+    :param streamers: The usernames of every streamer
+    :param subscriptions: The total number of user and team member alerts
+    :param team_share: The share of the subscriptions that come from teams
+    :param team_size: The number of members of each team
+    :param rng: The random number generator
+    :return: dict of team name to the usernames of its members
+    """
+    db_manager.db_execute_many("INSERT INTO GuildExtensions VALUES (?, ?)",
+                               [("TwitchAlert", guild_id) for guild_id in {channel.guild.id for channel in channels}])
+    db_manager.db_execute_many("INSERT INTO TwitchAlerts VALUES (?, ?, ?)",
+                               [(channel.guild.id, channel.id, TwitchAlert.DEFAULT_MESSAGE) for channel in channels])
+
+    team_alerts = int(subscriptions * team_share) // team_size
+    teams = {f"team_{i}": rng.sample(streamers, team_size) for i in range(max(1, team_alerts // 4))}
+    team_rows = []
+    member_rows = []
+    for i in range(team_alerts):
+        team_name = f"team_{i % len(teams)}"
+        team_rows.append((i + 1, channels[i % len(channels)].id, team_name, None))
+        member_rows += [(str(i + 1), username, None) for username in teams[team_name]]
+    db_manager.db_execute_many("INSERT INTO TeamInTwitchAlert VALUES (?, ?, ?, ?)", team_rows)
+    db_manager.db_execute_many("INSERT INTO UserInTwitchTeam VALUES (?, ?, ?)", member_rows)
+
+    user_rows = {}
+    while len(user_rows) < subscriptions - len(member_rows):
+        channel = rng.choice(channels)
+        username = rng.choice(streamers)
+        user_rows[(channel.id, username)] = (channel.id, username, None, None)
+    db_manager.db_execute_many("INSERT INTO UserInTwitchAlert VALUES (?, ?, ?, ?)", list(user_rows.values()))
+    return teams
+
+
+class DiscordCounter:
+    """
+    Counts the messages the bot sends and deletes, from the dpytest backend callbacks
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.deleted = 0
+        message_callback = dpytest.callbacks.get_callback("send_message")
+
+        async def on_send_message(message):
+            self.sent += 1
+            await message_callback(message)
+
+        async def on_delete_message(channel, message, reason=None):
+            self.deleted += 1
+
+        dpytest.callbacks.set_callback(on_send_message, "send_message")
+        dpytest.callbacks.set_callback(on_delete_message, "delete_message")
+
+    def reset(self):
+        self.sent = 0
+        self.deleted = 0
+
+
+def churn(live, streamers, share, rng):
+    """
+    Takes some live streamers offline and brings the same number of offline streamers live
+
+    :param live: The set of live usernames, which is changed
+    :param streamers: The usernames of every streamer
+    :param share: The share of the live streamers that change
+    :param rng: The random number generator
+    """
+    changes = int(len(live) * share)
+    offline = rng.sample(sorted(set(streamers) - live), min(changes, len(streamers) - len(live)))
+    live.difference_update(rng.sample(sorted(live), changes))
+    live.update(offline)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    intents = discord.Intents.default()
+    intents.members = True
+    intents.guilds = True
+    intents.messages = True
+    bot = commands.Bot(KoalaBot.COMMAND_PREFIX, intents=intents)
+    start = time.perf_counter()
+    dpytest.configure(bot, num_guilds=args.guilds, num_channels=1, num_members=1)
+    channels = dpytest.get_config().channels
+    print(f"Configured {args.guilds} dpytest guilds in {time.perf_counter() - start:.1f}s")
+
+    db_manager = KoalaDBManager.KoalaDBManager(DB_PATH, DB_KEY)
+    remove_database(db_manager.db_file_path)
+    cog = TwitchAlert.TwitchAlert(bot, database_manager=db_manager)
+    db_manager.bootstrap()
+    streamers = [f"streamer_{i}" for i in range(args.streamers)]
+    start = time.perf_counter()
+    teams = generate_alerts(db_manager, channels, streamers, args.subscriptions, args.team_share, args.team_size, rng)
+    db_manager.load_guild_extensions()
+    print(f"Generated {args.subscriptions} alerts of {args.streamers} streamers in {len(teams)} teams "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    app = create_helix_app(streamers, teams, args.live_ratio, args.latency / 1000, rng)
+    server = TestServer(app)
+    await server.start_server()
+    twitch_handler = TwitchAlert.TwitchAPIHandler("client_id", "client_secret",
+                                                  api_url=str(server.make_url("/helix/")),
+                                                  oauth_url=str(server.make_url("/oauth2/token")))
+    cog.ta_database_manager.twitch_handler = twitch_handler
+    cog.poll_scheduler = TwitchAlert.PollScheduler(min_interval=0, max_interval=0)
+    db_manager.enable_instrumentation(slow_query_threshold=float("inf"))
+    counter = DiscordCounter()
+
+    start = time.perf_counter()
+    await cog.ta_database_manager.update_all_teams_members()
+    stats = cog.ta_database_manager.team_sync_stats
+    print(f"Team sync        {(time.perf_counter() - start) * 1000:>8.1f}ms  "
+          f"{stats['added']} added, {stats['removed']} removed, {stats['failed']} failed")
+
+    print(f"{'pass':<5} {'live':>6} {'loop':>10} {'db':>10} {'queries':>8} {'http':>10} {'requests':>9} "
+          f"{'sent':>6} {'deleted':>8}")
+    for i in range(args.passes):
+        if i:
+            churn(app["state"]["live"], streamers, args.churn, rng)
+        db_manager.query_stats.reset()
+        twitch_handler.request_stats.reset()
+        counter.reset()
+
+        start = time.perf_counter()
+        await cog.loop_check_live()
+        elapsed = time.perf_counter() - start
+
+        queries = db_manager.query_report()["queries"]
+        requests = twitch_handler.request_stats.report()
+        await dpytest.empty_queue()
+        print(f"{i + 1:<5} {len(app['state']['live']):>6} {elapsed * 1000:>8.1f}ms "
+              f"{sum(query['total_time'] for query in queries) * 1000:>8.1f}ms "
+              f"{sum(query['calls'] for query in queries):>8} "
+              f"{sum(request['total_time'] for request in requests) * 1000:>8.1f}ms "
+              f"{sum(request['requests'] for request in requests):>9} {counter.sent:>6} {counter.deleted:>8}")
+
+    await twitch_handler.close()
+    await server.close()
+    db_manager.close()
+    remove_database(db_manager.db_file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=2000, help="number of guilds, each with one TwitchAlert")
+    parser.add_argument("--subscriptions", type=int, default=10000, help="number of user and team member alerts")
+    parser.add_argument("--streamers", type=int, default=5000, help="number of distinct streamers")
+    parser.add_argument("--team-share", type=float, default=0.2, help="share of the alerts that come from teams")
+    parser.add_argument("--team-size", type=int, default=20, help="number of members of each team")
+    parser.add_argument("--live-ratio", type=float, default=0.1, help="share of the streamers that are live")
+    parser.add_argument("--churn", type=float, default=0.2, help="share of the live streamers that change each pass")
+    parser.add_argument("--latency", type=float, default=50, help="milliseconds each twitch request takes")
+    parser.add_argument("--passes", type=int, default=3, help="number of loop passes")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated alerts and live streamers")
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Koala Bot Twitch API session benchmark
+Runs a local stand-in for the twitch API and compares the request latency of opening a new aiohttp session for every
+request against the shared session of TwitchAPIHandler. The stand-in serves plain HTTP, so the saving from skipping
+the TLS handshake against the real API is larger than reported here. Run from the root of the project:
+
+    python benchmarks/twitch_session_benchmark.py
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+
+# Libs
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+# Own modules
+from cogs import TwitchAlert
+
+
+def percentile(latencies, p):
+    """
+    Gets a percentile of a list of latencies
+
+    :param latencies: Sorted list of latencies
+    :param p: The percentile to get, e.g. 99
+    :return: The latency at the percentile
+    """
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+async def users(request):
+    return web.json_response({"data": [{"login": request.query.get("login")}]})
+
+
+async def oauth(request):
+    return web.json_response({"access_token": "benchmark", "expires_in": 3600})
+
+
+async def session_per_request(handler, url):
+    """
+    The previous behaviour, a new session (and connection) is opened for every request
+
+    :param handler: The TwitchAPIHandler, used for its headers
+    :param url: The URL to request
+    """
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(60)) as client:
+        async with client.get(url=url, headers=handler.base_headers) as response:
+            return await response.json()
+
+
+async def shared_session(handler, url):
+    """
+    The request is made through the shared session of the handler
+
+    :param handler: The TwitchAPIHandler
+    :param url: The URL to request
+    """
+    return await handler.requests_get(url)
+
+
+async def run(requests):
+    app = web.Application()
+    app.router.add_get("/helix/users", users)
+    app.router.add_post("/oauth2/token", oauth)
+    server = TestServer(app)
+    await server.start_server()
+    handler = TwitchAlert.TwitchAPIHandler("client_id", "client_secret",
+                                           api_url=str(server.make_url("/helix/")),
+                                           oauth_url=str(server.make_url("/oauth2/token")))
+    await handler.get_new_twitch_oauth()
+    url = handler.api_url + "users?login=monstercat"
+
+    for name, strategy in [("session per request", session_per_request), ("shared session", shared_session)]:
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            await strategy(handler, url)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f"{name:<20} mean {sum(latencies) / len(latencies) * 1000:>6.2f}ms  "
+              f"p50 {percentile(latencies, 50) * 1000:>6.2f}ms  p99 {percentile(latencies, 99) * 1000:>6.2f}ms")
+
+    await handler.close()
+    await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="requests to make with each strategy")
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -52,7 +52,7 @@ class Announce(commands.Cog):
         self.bot = bot
         self.messages = {}
         self.roles = {}
-        KoalaBot.database_manager.insert_extension("Announce", 0, True, True)
+        KoalaBot.database_manager.register_extension("Announce", 0, True, True)
         self.announce_database_manager = AnnounceDBManager(KoalaBot.database_manager)
         self.announce_database_manager.create_tables()
 
@@ -328,7 +328,8 @@ class AnnounceDBManager:
         FOREIGN KEY (guild_id) REFERENCES GuildExtensions(guild_id)
         );
         """
-        self.database_manager.db_execute_commit(sql_create_usage_tables)
+        self.database_manager.register_schema("Announce", [sql_create_usage_tables])
+        self.database_manager.bootstrap()
 
     def get_last_use_date(self, guild_id: int):
         """
@@ -8,6 +8,8 @@ Commented using reStructuredText (reST)
 # Futures
 
 # Built-in/Generic Imports
+import os
+import time
 
 # Libs
 import inspect
@@ -22,6 +24,8 @@ from utils.KoalaColours import *
 
 
 # Constants
+DB_STATS_LIMIT = 10  # Number of fingerprints shown by the dbStats command
+BACKUP_DIR = "backups"
 
 # Variables
 
@@ -82,6 +86,27 @@ def list_ext_embed(guild_id):
     return embed
 
 
+def db_stats_embed(report, limit=DB_STATS_LIMIT):
+    """
+    Creates a discord embed of the statements that have taken the most database time
+    :param report: The query report from KoalaDBManager.query_report
+    :param limit: The maximum number of statements to show
+    :return: The finished discord embed
+    """
+    embed = discord.Embed()
+    embed.title = "Database query statistics"
+    embed.colour = KOALA_GREEN
+    queries = report["queries"]
+    embed.set_footer(text=f"{len(queries)} statements, {len(report['slow_queries'])} recent slow queries")
+    for stats in queries[:limit]:
+        embed.add_field(name=stats["fingerprint"][:256],
+                        value=f"{stats['calls']} calls, {stats['errors']} errors, {stats['rows']} rows\n"
+                              f"total {stats['total_time'] * 1000:.1f}ms, p50 {stats['p50'] * 1000:.2f}ms, "
+                              f"p99 {stats['p99'] * 1000:.2f}ms, max {stats['max_time'] * 1000:.2f}ms",
+                        inline=False)
+    return embed
+
+
 class BaseCog(commands.Cog, name='KoalaBot'):
     """
         A discord.py cog with general commands useful to managers of the bot and servers
@@ -173,6 +198,45 @@ class BaseCog(commands.Cog, name='KoalaBot'):
             self.bot.unload_extension(self.COGS_DIR.replace("/", ".") + f'.{extension}')
             await ctx.send(f'{extension} Cog Unloaded')
 
+    @commands.command(name="dbStats", aliases=["db_stats"])
+    @commands.check(KoalaBot.is_owner)
+    async def db_stats(self, ctx, action=None):
+        """
+        Shows the database statements that have taken the most time
+        :param ctx: Context of the command
+        :param action: "enable" or "disable" to turn query instrumentation on or off, "reset" to clear the statistics
+        """
+        if action == "enable":
+            KoalaBot.database_manager.enable_instrumentation()
+            await ctx.send("Database query instrumentation enabled")
+        elif action == "disable":
+            KoalaBot.database_manager.disable_instrumentation()
+            await ctx.send("Database query instrumentation disabled")
+        elif KoalaBot.database_manager.query_stats is None:
+            await ctx.send(f"Database query instrumentation is disabled, "
+                           f"use `{KoalaBot.COMMAND_PREFIX}dbStats enable` to enable it")
+        elif action == "reset":
+            KoalaBot.database_manager.query_stats.reset()
+            await ctx.send("Database query statistics reset")
+        else:
+            await ctx.send(embed=db_stats_embed(KoalaBot.database_manager.query_report()))
+
+    @commands.command(name="backupDB", aliases=["backup_db"])
+    @commands.check(KoalaBot.is_owner)
+    async def backup_db(self, ctx, file_name=None):
+        """
+        Takes a backup of the database while the bot keeps running
+        :param ctx: Context of the command
+        :param file_name: The file name of the backup in the backups folder, defaults to one with the current time
+        """
+        if file_name is None:
+            file_name = f"{os.path.splitext(os.path.basename(KoalaBot.DATABASE_PATH))[0]}-" \
+                        f"{time.strftime('%Y%m%d-%H%M%S')}.db"
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        await ctx.send("Starting database backup")
+        dest = await KoalaBot.database_manager.run_backup(os.path.join(BACKUP_DIR, os.path.basename(file_name)))
+        await ctx.send(f"Database backed up to {dest}")
+
     @commands.command(name="enableExt", aliases=["enable_koala_ext"])
     @commands.check(KoalaBot.is_admin)
     async def enable_koala_ext(self, ctx, koala_extension):
@@ -67,8 +67,7 @@ class ColourRole(commands.Cog):
         :param bot: The bot client for this cog
         """
         self.bot = bot
-        KoalaBot.database_manager.create_base_tables()
-        KoalaBot.database_manager.insert_extension("ColourRole", 0, True, True)
+        KoalaBot.database_manager.register_extension("ColourRole", 0, True, True)
         self.cr_database_manager = ColourRoleDBManager(KoalaBot.database_manager)
         self.cr_database_manager.create_tables()
 
@@ -580,8 +579,9 @@ class ColourRoleDBManager:
         );"""
 
         # Create Tables
-        self.database_manager.db_execute_commit(sql_create_guild_colour_change_permissions_table)
-        self.database_manager.db_execute_commit(sql_create_guild_colour_change_invalid_colours_table)
+        self.database_manager.register_schema("ColourRole", [sql_create_guild_colour_change_permissions_table,
+                                                             sql_create_guild_colour_change_invalid_colours_table])
+        self.database_manager.bootstrap()
 
     def add_colour_change_role_perms(self, guild_id, role_id):
         self.database_manager.db_execute_commit(
@@ -54,8 +54,7 @@ class ReactForRole(commands.Cog):
 
     def __init__(self, bot: discord.Client):
         self.bot = bot
-        KoalaBot.database_manager.create_base_tables()
-        KoalaBot.database_manager.insert_extension("ReactForRole", 0, True, True)
+        KoalaBot.database_manager.register_extension("ReactForRole", 0, True, True)
         self.rfr_database_manager = ReactForRoleDBManager(KoalaBot.database_manager)
         self.rfr_database_manager.create_tables()
 
@@ -639,8 +638,9 @@ class ReactForRole(commands.Cog):
         """
         if payload.guild_id is not None:
             if not payload.member.bot:
-                rfr_message = self.rfr_database_manager.get_rfr_message(payload.guild_id, payload.channel_id,
-                                                                        payload.message_id)
+                db = self.rfr_database_manager.get_parent_database_manager()
+                rfr_message = await db.run_read(self.rfr_database_manager.get_rfr_message, payload.guild_id,
+                                                payload.channel_id, payload.message_id)
                 if not rfr_message:
                     return
 
@@ -654,11 +654,11 @@ class ReactForRole(commands.Cog):
                     msg: discord.Message = await channel.fetch_message(payload.message_id)
                     await msg.clear_reaction(payload.emoji)
                 else:
-                    if self.can_have_rfr_role(member_role[0]):
+                    if await db.run_read(self.can_have_rfr_role, member_role[0]):
                         await member_role[0].add_roles(member_role[1])
                     else:
                         # Remove all rfr roles from member
-                        role_ids = self.rfr_database_manager.get_guild_rfr_roles(payload.guild_id)
+                        role_ids = await db.run_read(self.rfr_database_manager.get_guild_rfr_roles, payload.guild_id)
                         roles: List[discord.Role] = []
                         for role_id in role_ids:
                             role = discord.utils.get(member_role[0].guild.roles, id=role_id)
@@ -668,7 +668,8 @@ class ReactForRole(commands.Cog):
                         for role_to_remove in roles:
                             await member_role[0].remove_roles(role_to_remove)
                         # Remove members' reaction from all rfr messages in guild
-                        guild_rfr_messages = self.rfr_database_manager.get_guild_rfr_messages(payload.guild_id)
+                        guild_rfr_messages = await db.run_read(self.rfr_database_manager.get_guild_rfr_messages,
+                                                               payload.guild_id)
                         if not guild_rfr_messages:
                             KoalaBot.logger.error(
                                 f"ReactForRole: Guild RFR messages is empty on raw reaction add. Please check"
@@ -755,8 +756,9 @@ class ReactForRole(commands.Cog):
         :return:
         """
         if payload.guild_id is not None:
-            rfr_message = self.rfr_database_manager.get_rfr_message(payload.guild_id, payload.channel_id,
-                                                                    payload.message_id)
+            db = self.rfr_database_manager.get_parent_database_manager()
+            rfr_message = await db.run_read(self.rfr_database_manager.get_rfr_message, payload.guild_id,
+                                            payload.channel_id, payload.message_id)
             if not rfr_message:
                 return
             member_role = await self.get_role_member_info(payload.emoji, payload.guild_id,
@@ -1079,9 +1081,10 @@ class ReactForRoleDBManager:
         UNIQUE (guild_id, role_id)
         );
         """
-        self.database_manager.db_execute_commit(sql_create_guild_rfr_message_ids_table)
-        self.database_manager.db_execute_commit(sql_create_rfr_message_emoji_roles_table)
-        self.database_manager.db_execute_commit(sql_create_rfr_required_roles_table)
+        self.database_manager.register_schema("ReactForRole", [sql_create_guild_rfr_message_ids_table,
+                                                               sql_create_rfr_message_emoji_roles_table,
+                                                               sql_create_rfr_required_roles_table])
+        self.database_manager.bootstrap()
 
     def add_rfr_message(self, guild_id: int, channel_id: int, message_id: int):
         """
@@ -8,6 +8,8 @@ Created by: Stefan Cooper
 # Built-in/Generic Imports
 import os
 import asyncio
+import logging
+import threading
 import time
 import re
 
@@ -21,6 +23,15 @@ from utils.KoalaColours import *
 from utils.KoalaUtils import error_embed, is_channel_in_guild, extract_id
 from utils.KoalaDBManager import KoalaDBManager
 
+# Constants
+# Schema migrations, applied in order after the tables are created
+MIGRATIONS = [
+    ["CREATE INDEX IF NOT EXISTS TextFilter_guild_id ON TextFilter (guild_id)",
+     "CREATE INDEX IF NOT EXISTS TextFilterIgnoreList_guild_id_ignore_type "
+     "ON TextFilterIgnoreList (guild_id, ignore_type)"],
+]
+REGEX_SPECIAL_CHARS = ".^$*+?{}[]\\|()"
+
 
 def text_filter_is_enabled(ctx):
     """
@@ -47,8 +58,7 @@ class TextFilter(commands.Cog, name="TextFilter"):
         if not database_manager:
             database_manager = KoalaBot.database_manager
         self.bot = bot
-        database_manager.create_base_tables()
-        database_manager.insert_extension("TextFilter", 0, True, True)
+        database_manager.register_extension("TextFilter", 0, True, True)
         self.tf_database_manager = TextFilterDBManager(database_manager, bot)
         self.tf_database_manager.create_tables()
 
@@ -281,20 +291,22 @@ class TextFilter(commands.Cog, name="TextFilter"):
                 message.content.startswith(KoalaBot.COMMAND_PREFIX+"unfilter"):
             return
         elif str(message.channel.type) == 'text' and message.channel.guild is not None:
-            censor_list = self.tf_database_manager.get_filtered_text_for_guild(message.channel.guild.id)
-            for word, filter_type, is_regex in censor_list:
-                if (word in message.content or (is_regex == '1' and re.search(word, message.content))) and not self.is_ignored(message):
-                    if filter_type == "risky":
-                        await message.author.send("Watch your language! Your message: '*"+message.content+"*' in " +
-                                                  message.channel.mention+" contains a 'risky' word. "
-                                                  "This is a warning.")
-                        return
-                    elif filter_type == "banned":
-                        await message.author.send("Watch your language! Your message: '*"+message.content+"*' in " +
-                                                  message.channel.mention+" has been deleted by KoalaBot.")
-                        await self.send_to_moderation_channels(message)
-                        await message.delete()
-                        return
+            db = self.tf_database_manager.database_manager
+            matcher = self.tf_database_manager.matchers.get(message.channel.guild.id)
+            if matcher is None:
+                matcher = await db.run_read(self.tf_database_manager.get_matcher, message.channel.guild.id)
+            match = matcher.match(message.content)
+            if match is not None and not await db.run_read(self.is_ignored, message):
+                word, filter_type, is_regex = match
+                if filter_type == "risky":
+                    await message.author.send("Watch your language! Your message: '*"+message.content+"*' in " +
+                                              message.channel.mention+" contains a 'risky' word. "
+                                              "This is a warning.")
+                elif filter_type == "banned":
+                    await message.author.send("Watch your language! Your message: '*"+message.content+"*' in " +
+                                              message.channel.mention+" has been deleted by KoalaBot.")
+                    await self.send_to_moderation_channels(message)
+                    await message.delete()
 
     def build_channel_list(self, channels, embed):
         """
@@ -366,7 +378,7 @@ class TextFilter(commands.Cog, name="TextFilter"):
         :return: boolean true if mod channel exists, false otherwise
         """
         channels = self.tf_database_manager.get_mod_channel(guild_id)
-        return len(channels) > 0
+        return channels is not None and len(channels) > 0
 
     async def send_to_moderation_channels(self, message):
         """
@@ -374,9 +386,10 @@ class TextFilter(commands.Cog, name="TextFilter"):
 
         :param message: The message in question which is being deleted
         """
-        if self.is_moderation_channel_available(message.guild.id):
-            channels = self.tf_database_manager.get_mod_channel(message.guild.id)
-            for each_channel in channels:
+        db = self.tf_database_manager.database_manager
+        if await db.run_read(self.is_moderation_channel_available, message.guild.id):
+            channels = await db.run_read(self.tf_database_manager.get_mod_channel, message.guild.id)
+            for each_channel in channels or []:
                 channel = self.bot.get_channel(id=int(each_channel[0]))
                 await channel.send(embed=build_moderation_deleted_embed(message))
 
@@ -506,6 +519,149 @@ def build_moderation_deleted_embed(message):
     return embed
 
 
+class FilterMatcher:
+    """
+    The compiled filtered text of a guild. Every filtered text is matched as a substring with an Aho-Corasick
+    automaton, which also finds the literal prefixes of regexes so only the regexes whose prefix is in a message are
+    searched. Regexes without a literal prefix are prefiltered with one combined alternation. When several filters
+    match, the one the guild added first wins, as when they were checked one at a time
+    """
+
+    def __init__(self, censor_list):
+        """
+        Compiles the filtered text of a guild
+
+        :param censor_list: list of the filtered text, filter type and is regex of each filter, in the order they are
+        checked, from TextFilterDBManager.get_filtered_text_for_guild
+        """
+        self.entries = [entry for entry in censor_list if type_exists(entry[1])]
+        self.goto = [{}]
+        self.fail = [0]
+        self.first = [len(self.entries)]
+        self.triggers = {}
+        # Regexes without a literal prefix, searched whenever the combined pattern matches
+        self.regexes = []
+        self.combinable = []
+        for index, (word, _, is_regex) in enumerate(self.entries):
+            node = self.add_word(word)
+            self.first[node] = min(self.first[node], index)
+            if is_regex != '1':
+                continue
+            try:
+                pattern = re.compile(word)
+            except re.error as err:
+                logging.warning(f"TextFilter: Skipping invalid regex {word} {err}")
+                continue
+            prefix = literal_prefix(word)
+            if prefix:
+                self.triggers.setdefault(self.add_word(prefix), []).append((index, pattern))
+            elif pattern.groups:
+                # Patterns with groups could have backreferences that change meaning in the combined pattern
+                self.regexes.append((index, pattern))
+            else:
+                self.combinable.append((index, pattern))
+        self.build_fail_links()
+
+        try:
+            self.combined = re.compile("|".join(f"(?:{pattern.pattern})" for _, pattern in self.combinable)) \
+                if self.combinable else None
+        except re.error:
+            # e.g. inline flags that are only valid at the start of a pattern, so each regex is searched on its own
+            self.combined = None
+            self.regexes = sorted(self.regexes + self.combinable, key=lambda regex: regex[0])
+            self.combinable = []
+
+    def add_word(self, word):
+        """
+        Adds a text to the trie of the automaton
+
+        :param word: The filtered text or regex prefix
+        :return: The node the text ends at
+        """
+        node = 0
+        for char in word:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.first.append(len(self.entries))
+            node = next_node
+        return node
+
+    def build_fail_links(self):
+        """
+        Links each node of the trie to the node of its longest proper suffix, breadth first, and merges the first
+        filter and the regexes triggered at that suffix into the node
+        """
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, next_node in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0) if node else 0
+                self.fail[next_node] = fail
+                self.first[next_node] = min(self.first[next_node], self.first[fail])
+                if fail in self.triggers:
+                    self.triggers[next_node] = self.triggers.get(next_node, []) + self.triggers[fail]
+                queue.append(next_node)
+
+    def match(self, content):
+        """
+        Finds the filter a message breaks
+
+        :param content: The content of the message
+        :return: The filtered text, filter type and is regex of the first filter that matches, or None
+        """
+        goto, fail, first, triggers = self.goto, self.fail, self.first, self.triggers
+        found = first[0]
+        triggered = []
+        node = 0
+        for char in content:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if first[node] < found:
+                found = first[node]
+                if not found:
+                    break
+            if node in triggers:
+                triggered += triggers[node]
+
+        regexes = triggered + self.regexes
+        if self.combined is not None and self.combinable[0][0] < found and self.combined.search(content):
+            regexes += self.combinable
+        for index, pattern in sorted(set(regexes), key=lambda regex: regex[0]):
+            if index >= found:
+                break
+            if pattern.search(content):
+                found = index
+                break
+        return self.entries[found] if found < len(self.entries) else None
+
+
+def literal_prefix(regex):
+    """
+    Gets the literal text every match of a regex starts with, so the regex can't match a message without it
+
+    :param regex: The regex
+    :return: The literal prefix, empty if the regex has no prefix that is certain
+    """
+    if "|" in regex:
+        return ""
+    prefix = ""
+    for char in regex[1:] if regex.startswith("^") else regex:
+        if char in REGEX_SPECIAL_CHARS:
+            if char in "*?{":
+                # The previous character is optional
+                prefix = prefix[:-1]
+            break
+        prefix += char
+    return prefix
+
+
 class TextFilterDBManager:
     """
     A class for interacting with the Koala text filter database
@@ -520,6 +676,9 @@ class TextFilterDBManager:
         """
         self.database_manager = database_manager
         self.bot = bot_client
+        self.matchers = {}
+        self.matcher_versions = {}
+        self._matchers_lock = threading.Lock()
 
     def create_tables(self):
         """
@@ -553,9 +712,9 @@ class TextFilterDBManager:
         PRIMARY KEY (ignore_id)
         );"""
 
-        self.database_manager.db_execute_commit(sql_create_text_filter_table)
-        self.database_manager.db_execute_commit(sql_create_mod_table)
-        self.database_manager.db_execute_commit(sql_create_ignore_list_table)
+        self.database_manager.register_schema("TextFilter", [sql_create_text_filter_table, sql_create_mod_table,
+                                                             sql_create_ignore_list_table], MIGRATIONS)
+        self.database_manager.bootstrap()
 
     def new_mod_channel(self, guild_id, channel_id):
         """
@@ -584,6 +743,7 @@ class TextFilterDBManager:
                 "INSERT INTO TextFilter (filtered_text_id, guild_id, filtered_text, filter_type, is_regex)"
                 " VALUES (?,?,?,?,?)",
                 args=[ft_id, guild_id, filtered_text, filter_type, is_regex])
+            self.invalidate_matcher(guild_id)
             return 
         raise Exception("Filtered word already exists")
             
@@ -599,6 +759,7 @@ class TextFilterDBManager:
         if self.does_word_exist(ft_id):
             self.database_manager.db_execute_commit(
                 "DELETE FROM TextFilter WHERE filtered_text_id = ?", args=[ft_id])
+            self.invalidate_matcher(guild_id)
             return
         raise Exception("Filtered word does not exist")
 
@@ -645,6 +806,35 @@ class TextFilterDBManager:
             censor_list.append((row[2], row[3], str(row[4])))
         return censor_list
 
+    def get_matcher(self, guild_id):
+        """
+        Gets the compiled filtered text of a guild, compiling it if it has changed since it was last compiled
+
+        :param guild_id: Guild ID to retrieve the matcher of
+        :return: The FilterMatcher of the guild
+        """
+        guild_id = int(guild_id)
+        matcher = self.matchers.get(guild_id)
+        if matcher is None:
+            version = self.matcher_versions.get(guild_id, 0)
+            matcher = FilterMatcher(self.get_filtered_text_for_guild(guild_id))
+            with self._matchers_lock:
+                # The filters may have changed while compiling, in which case the next message compiles them again
+                if self.matcher_versions.get(guild_id, 0) == version:
+                    self.matchers[guild_id] = matcher
+        return matcher
+
+    def invalidate_matcher(self, guild_id):
+        """
+        Discards the compiled filtered text of a guild, after its filters have changed
+
+        :param guild_id: Guild ID whose filters have changed
+        """
+        guild_id = int(guild_id)
+        with self._matchers_lock:
+            self.matcher_versions[guild_id] = self.matcher_versions.get(guild_id, 0) + 1
+            self.matchers.pop(guild_id, None)
+
     def get_ignore_list_channels(self, guild_id):
         """
         Get lists of ignored channels
@@ -13,6 +13,13 @@ import time
 import re
 import aiohttp
 import logging
+import calendar
+import hashlib
+import hmac
+import json
+import random
+from collections import OrderedDict
+from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(filename='TwitchAlert.log')
@@ -24,6 +31,7 @@ from utils.KoalaUtils import error_embed, is_channel_in_guild, extract_id
 from utils import KoalaDBManager
 
 # Libs
+from aiohttp import web
 from discord.ext import commands, tasks
 from dotenv import load_dotenv
 import asyncio
@@ -35,12 +43,67 @@ TWITCH_ICON = "https://cdn3.iconfinder.com/data/icons/social-messaging-ui-color-
               "/128/social-twitch-circle-512.png"
 TWITCH_CLIENT_ID = os.environ.get('TWITCH_TOKEN')
 TWITCH_SECRET = os.environ.get('TWITCH_SECRET')
+TWITCH_EVENTSUB_CALLBACK = os.environ.get('TWITCH_EVENTSUB_CALLBACK')
+TWITCH_EVENTSUB_SECRET = os.environ.get('TWITCH_EVENTSUB_SECRET')
+TWITCH_EVENTSUB_HOST = os.environ.get('TWITCH_EVENTSUB_HOST', "0.0.0.0")
+TWITCH_EVENTSUB_PORT = int(os.environ.get('TWITCH_EVENTSUB_PORT', 8080))
 TWITCH_USERNAME_REGEX = "^[a-z0-9][a-z0-9_]{3,24}$"
+TWITCH_OAUTH_URL = "https://id.twitch.tv/oauth2/token"
+TWITCH_API_URL = "https://api.twitch.tv/helix/"
+HTTP_TIMEOUT = 60
+HTTP_CONNECTION_LIMIT = 10  # Maximum number of open connections to the Twitch API
+HTTP_KEEPALIVE_TIMEOUT = 60  # Seconds an idle connection is kept open, longer than the loop delays
+HTTP_DNS_CACHE_TTL = 300  # Seconds resolved addresses are cached for
+TWITCH_BATCH_SIZE = 100  # Maximum number of users twitch allows in one streams request
+STREAMS_CONCURRENCY = 5  # Maximum number of streams batches requested at once
+USER_CACHE_SIZE = 1000
+USER_CACHE_TTL = 60 * 60  # Seconds user details (e.g. profile images) are cached for
+GAME_CACHE_SIZE = 500
+GAME_CACHE_TTL = 24 * 60 * 60  # Seconds game details are cached for
+TWITCH_RATE_LIMIT = 800  # Requests per minute twitch allows an app token, until the rate limit headers say otherwise
+TWITCH_RATE_LIMIT_PERIOD = 60  # Seconds the bucket takes to refill
+MAX_RETRIES = 3  # Retries of a request after a 429, a 5xx or a connection error
+RETRY_BASE_DELAY = 1  # Seconds the jittered exponential backoff starts from
+RETRY_MAX_DELAY = 30  # Seconds the backoff is capped at
+MAX_TOKEN_REFRESHES = 1  # New tokens fetched for a request rejected with a 401
+TOKEN_REFRESH_MARGIN = 10 * 60  # Seconds before the token expires that it is refreshed in the background
+TOKEN_DEFAULT_LIFETIME = 60 * 60  # Seconds a token is assumed to last if twitch doesn't say
 
 LOOP_CHECK_LIVE_DELAY = 1
-TEAMS_LOOP_CHECK_LIVE_DELAY = 1
+POLL_MAX_STALENESS = 10 * 60  # Maximum seconds between polls of any streamer
+POLL_LEARNING_PERIOD = 24 * 60 * 60  # Seconds a new streamer is polled every loop, before their history is used
+POLL_USUAL_HOUR_SHARE = 0.2  # Share of a streamer's go-lives within an hour of now for them to be polled every loop
+POLL_HISTORY_DECAY = 0.9  # Weight kept by older go-lives each time a streamer goes live
 REFRESH_TEAMS_DELAY = 5
 
+SQL_CHUNK_SIZE = 500  # Maximum usernames in one IN (...), below SQLite's limit of 999 parameters
+BULK_DELETE_SIZE = 100  # Maximum messages discord deletes in one bulk delete
+BULK_DELETE_MAX_AGE = 14 * 24 * 60 * 60 - 60 * 60  # Seconds old a message can be bulk deleted, with a margin
+CLEANUP_CONCURRENCY = 5  # Maximum channels cleaned up at once
+
+EVENTSUB_TYPES = ["stream.online", "stream.offline"]
+EVENTSUB_RECONCILE_DELAY = 10  # Minutes between the live loops when EventSub is running, as a fallback
+EVENTSUB_SYNC_DELAY = 1  # Minutes between checks for changed alerts to sync the EventSub subscriptions of
+EVENTSUB_MESSAGE_MAX_AGE = 10 * 60  # Seconds after which a message is rejected, as twitch may replay it
+EVENTSUB_DEDUP_SIZE = 1000  # Number of message IDs remembered to ignore retried messages
+EVENTSUB_STREAM_RETRIES = 3  # Attempts to get a stream after it goes online, as the API can lag behind the event
+EVENTSUB_STREAM_RETRY_DELAY = 5  # Seconds between the attempts
+EVENTSUB_ACTIVE_STATUSES = ["enabled", "webhook_callback_verification_pending"]
+
+# Schema migrations, applied in order after the tables are created
+MIGRATIONS = [
+    ["CREATE INDEX IF NOT EXISTS UserInTwitchAlert_twitch_username ON UserInTwitchAlert (twitch_username)",
+     "CREATE INDEX IF NOT EXISTS UserInTwitchTeam_twitch_username ON UserInTwitchTeam (twitch_username)"],
+]
+# Rows of the loop queries, each with the guild ID last for filter_enabled_guilds
+UserSubscriptionRow = KoalaDBManager.row_type("UserSubscriptionRow", [
+    "twitch_username", "UserInTwitchAlert.channel_id", "message_id", "custom_message", "default_message",
+    "TA.guild_id"])
+TeamSubscriptionRow = KoalaDBManager.row_type("TeamSubscriptionRow", [
+    "twitch_username", "twitch_team_name", "TITA.channel_id", "UserInTwitchTeam.message_id",
+    "TITA.team_twitch_alert_id", "custom_message", "default_message", "TA.guild_id"])
+AlertMessageRow = KoalaDBManager.row_type("AlertMessageRow", ["channel_id", "message_id"])
+
 # Variables
 
 
@@ -73,14 +136,30 @@ class TwitchAlert(commands.Cog):
         if not database_manager:
             database_manager = KoalaBot.database_manager
         self.bot = bot
-        database_manager.create_base_tables()
-        database_manager.insert_extension("TwitchAlert", 0, True, True)
+        database_manager.register_extension("TwitchAlert", 0, True, True)
         self.ta_database_manager = TwitchAlertDBManager(database_manager, bot)
         self.ta_database_manager.create_tables()
         self.loop_thread = None
         self.loop_team_thread = None
         self.running = False
         self.stop_loop = False
+        self.alerts_lock = asyncio.Lock()
+        self.poll_scheduler = PollScheduler()
+        self.eventsub = None
+        self.eventsub_version = None
+        if TWITCH_EVENTSUB_CALLBACK and TWITCH_EVENTSUB_SECRET:
+            self.eventsub = EventSubHandler(self.ta_database_manager.twitch_handler, TWITCH_EVENTSUB_SECRET,
+                                            TWITCH_EVENTSUB_CALLBACK, self.on_stream_online, self.on_stream_offline)
+        self.user_alerts = LiveAlertState("channel_id", """
+        UPDATE UserInTwitchAlert 
+        SET message_id = ? 
+        WHERE channel_id = ? 
+            AND twitch_username = ?""")
+        self.team_alerts = LiveAlertState("team_twitch_alert_id", """
+        UPDATE UserInTwitchTeam 
+        SET message_id = ?
+        WHERE team_twitch_alert_id = ?
+        AND twitch_username = ?""")
 
     @commands.command(name="twitchEditMsg", aliases=["edit_default_message"])
     @commands.check(KoalaBot.is_admin)
@@ -369,6 +448,22 @@ class TwitchAlert(commands.Cog):
 
         await ctx.send(embed=embed)
 
+    @commands.command(name="twitchStats", aliases=["twitch_stats"])
+    @commands.check(KoalaBot.is_owner)
+    async def twitch_stats(self, ctx, action=None):
+        """
+        Shows the requests made to each twitch endpoint, and how often they were retried or throttled
+        :param ctx: Context of the command
+        :param action: "reset" to clear the statistics
+        :return:
+        """
+        request_stats = self.ta_database_manager.twitch_handler.request_stats
+        if action == "reset":
+            request_stats.reset()
+            await ctx.send("Twitch request statistics reset")
+        else:
+            await ctx.send(embed=twitch_stats_embed(request_stats.report(), self.ta_database_manager.team_sync_stats))
+
     @commands.Cog.listener()
     async def on_ready(self):
         """
@@ -379,109 +474,234 @@ class TwitchAlert(commands.Cog):
             self.start_loops()
 
     def start_loops(self):
+        if self.eventsub is not None:
+            # Alerts are pushed by EventSub, so the live loop only reconciles any missed events
+            self.loop_check_live.change_interval(minutes=EVENTSUB_RECONCILE_DELAY)
+            self.loop_sync_eventsub.start()
         self.loop_update_teams.start()
-        self.loop_check_team_live.start()
         self.loop_check_live.start()
         self.running = True
 
     def end_loops(self):
+        self.loop_sync_eventsub.cancel()
         self.loop_update_teams.cancel()
-        self.loop_check_team_live.cancel()
         self.loop_check_live.cancel()
         self.running = False
 
+    def cog_unload(self):
+        """
+        When the cog is unloaded, the loops are stopped and the connections to twitch are closed
+        :return:
+        """
+        self.end_loops()
+        self.bot.loop.create_task(self.ta_database_manager.twitch_handler.close())
+
+    def filter_enabled_guilds(self, rows):
+        """
+        Filters out the rows of guilds which don't have TwitchAlert enabled, using the cached guild extensions
+        :param rows: The sql results, with the guild ID as the last column
+        :return: The rows of guilds with TwitchAlert enabled
+        """
+        database_manager = self.ta_database_manager.database_manager
+        return [row for row in rows if database_manager.extension_enabled(row[-1], "TwitchAlert")]
+
     @tasks.loop(minutes=LOOP_CHECK_LIVE_DELAY)
     async def loop_check_live(self):
         """
-        A loop that continually checks the live status of users and
+        A loop that continually checks the live status of users and members of teams, and
         sends alerts when online, removing them when offline
         :return:
         """
         start = time.time()
-        # logging.info("TwitchAlert: User Loop Started")
-        sql_find_users = "SELECT twitch_username " \
+        # logging.info("TwitchAlert: Live Loop Started")
+        async with self.alerts_lock:
+            states = [state for state, load_alerts in [(self.user_alerts, self.load_user_alerts),
+                                                       (self.team_alerts, self.load_team_alerts)]
+                      if await load_alerts()]
+            try:
+                await self.reconcile_alerts(states)
+            except Exception as err:
+                logging.error(f"TwitchAlert: Live Loop error {err}")
+
+        time_diff = time.time() - start
+        if time_diff > 5:
+            logging.warning(f"TwitchAlert: Live Loop Finished in > 5s | {time_diff}s")
+
+    async def load_user_alerts(self):
+        """
+        Loads the user alerts from the database if they have changed since they were last loaded, removing any
+        invalid usernames
+        :return: False if the alerts couldn't be loaded
+        """
+        sql_find_users = f"SELECT {UserSubscriptionRow.columns} " \
                          "FROM UserInTwitchAlert " \
-                         "JOIN TwitchAlerts TA on UserInTwitchAlert.channel_id = TA.channel_id " \
-                         "JOIN (SELECT extension_id, guild_id FROM GuildExtensions " \
-                         "WHERE extension_id = 'TwitchAlert' OR extension_id = 'All') GE on TA.guild_id = GE.guild_id;"
-        users = self.ta_database_manager.database_manager.db_execute_select(sql_find_users)
-        usernames = []
-        for user in users:
-            if not re.search(TWITCH_USERNAME_REGEX, user[0]):
+                         "JOIN TwitchAlerts TA on UserInTwitchAlert.channel_id = TA.channel_id;"
+        database_manager = self.ta_database_manager.database_manager
+        version = self.ta_database_manager.subscriptions_version
+        if self.user_alerts.is_stale(version):
+            users = await database_manager.select(sql_find_users, row=UserSubscriptionRow)
+            if users is None:
+                return False
+            subscriptions = []
+            invalid_usernames = set()
+            for user in users:
+                if not re.search(TWITCH_USERNAME_REGEX, user.twitch_username):
+                    invalid_usernames.add(user.twitch_username)
+                else:
+                    subscriptions.append(user)
+            for username in invalid_usernames:
                 sql_remove_invalid_user = "DELETE FROM UserInTwitchAlert WHERE twitch_username = ?"
-                self.ta_database_manager.database_manager.db_execute_commit(sql_remove_invalid_user, args=[user[0]])
-            else:
-                usernames.append(user[0])
+                await database_manager.commit(sql_remove_invalid_user, args=[username])
+            self.user_alerts.hydrate(subscriptions, version)
+        return True
+
+    async def load_team_alerts(self):
+        """
+        Loads the team alerts from the database if they have changed since they were last loaded, removing any
+        invalid team names
+        :return: False if the alerts couldn't be loaded
+        """
+        sql_select_team_users = f"SELECT {TeamSubscriptionRow.columns} " \
+                                "FROM UserInTwitchTeam " \
+                                "JOIN TeamInTwitchAlert TITA " \
+                                "  ON UserInTwitchTeam.team_twitch_alert_id = TITA.team_twitch_alert_id " \
+                                "JOIN TwitchAlerts TA on TITA.channel_id = TA.channel_id "
+        database_manager = self.ta_database_manager.database_manager
+        version = self.ta_database_manager.subscriptions_version
+        if self.team_alerts.is_stale(version):
+            users_and_teams = await database_manager.select(sql_select_team_users, row=TeamSubscriptionRow)
+            if users_and_teams is None:
+                return False
+            subscriptions = []
+            invalid_teams = set()
+            for user in users_and_teams:
+                if not re.search(TWITCH_USERNAME_REGEX, user.twitch_team_name):
+                    invalid_teams.add(user.twitch_team_name)
+                else:
+                    subscriptions.append(user)
+            for team_name in invalid_teams:
+                sql_remove_invalid_user = "DELETE FROM TeamInTwitchAlert WHERE twitch_team_name = ?"
+                await database_manager.commit(sql_remove_invalid_user, args=[team_name])
+            self.team_alerts.hydrate(subscriptions, version)
+        return True
 
-        # user_streams = self.ta_database_manager.twitch_handler.get_streams_data(usernames)
+    async def reconcile_alerts(self, states):
+        """
+        Diffs the alerts of live states against the live streams on twitch, sending the alerts of streams that have
+        gone live and deleting the alerts of streams that have gone offline. Each user is requested once however many
+        alerts and teams they are in, and only these transitions touch discord or the database, with the message ID
+        changes of each state written in a single transaction
+        :param states: The LiveAlertStates of the alerts
+        :return:
+        """
+        subscriptions = [(state, self.filter_enabled_guilds(state.subscriptions)) for state in states]
+        usernames = list(dict.fromkeys(subscription.twitch_username
+                                       for _, state_subscriptions in subscriptions
+                                       for subscription in state_subscriptions))
         if not usernames:
+            for state in states:
+                state.live = {}
             return
 
-        user_streams = await self.ta_database_manager.twitch_handler.get_streams_data(usernames)
-        if user_streams is None:
+        # Only the streamers the scheduler says are due are polled, the rest keep their current alerts
+        now = time.time()
+        polled = self.poll_scheduler.due(usernames, now)
+        self.poll_scheduler.prune(usernames)
+        if not polled:
             return
-
-        # Deals with online streams
-        for streams_details in user_streams:
+        failed_usernames = []
+        streams_data = await self.ta_database_manager.twitch_handler.get_streams_data(polled, failed_usernames)
+        if streams_data is None:
+            return
+        live_streams = {get_stream_login(stream_data): stream_data for stream_data in streams_data
+                        if stream_data.get('type') == "live"}
+        unknown_usernames = set(failed_usernames) | (set(usernames) - set(polled))
+        for username in polled:
+            if username not in unknown_usernames:
+                self.poll_scheduler.observe(username, username in live_streams, now)
+
+        for state, state_subscriptions in subscriptions:
+            state.live = {username: stream_id for username, stream_id in state.live.items()
+                          if username in unknown_usernames}
+            state.live.update({subscription.twitch_username: live_streams[subscription.twitch_username].get("id")
+                               for subscription in state_subscriptions
+                               if subscription.twitch_username in live_streams})
+            await self.apply_alerts(state, state_subscriptions, live_streams, unknown_usernames)
+
+    async def apply_alerts(self, state, subscriptions, live_streams, failed_usernames):
+        """
+        Sends the alerts of streams that have gone live and deletes the alerts of streams that have gone offline
+        :param state: The LiveAlertState of the alerts
+        :param subscriptions: The subscription rows to update
+        :param live_streams: dict of username to the twitch stream data of the live streams
+        :param failed_usernames: The usernames whose status couldn't be fetched, which are left as they are
+        :return:
+        """
+        # Diffs the alerts against the live streams, skipping users whose status couldn't be fetched
+        new_alerts = []
+        offline_alerts = []
+        for subscription in subscriptions:
+            message_id = state.messages.get(state.key(subscription))
+            if subscription.twitch_username in live_streams:
+                if message_id is None:
+                    new_alerts.append(subscription)
+            elif message_id is not None and subscription.twitch_username not in failed_usernames:
+                offline_alerts.append((subscription, message_id))
+        if not new_alerts and not offline_alerts:
+            return
+        await self.prefetch_alert_data([live_streams[subscription.twitch_username] for subscription in new_alerts])
+
+        # One embed per stream, using the message of its first alert
+        embeds = {}
+        for subscription in new_alerts:
+            if subscription.twitch_username not in embeds:
+                if subscription.custom_message is not None:
+                    message = subscription.custom_message
+                else:
+                    message = subscription.default_message
+                try:
+                    embeds[subscription.twitch_username] = await self.create_alert_embed(
+                        live_streams[subscription.twitch_username], message)
+                except Exception as err:
+                    embeds[subscription.twitch_username] = None
+                    logging.error(f"TwitchAlert: Failed to create alert for {subscription.twitch_username} {err}")
+
+        async def send_alert(subscription):
+            channel = self.bot.get_channel(id=subscription.channel_id)
+            embed = embeds.get(subscription.twitch_username)
+            if embed is None or channel is None:
+                return None
             try:
-                if streams_details.get('type') == "live":
-                    current_username = str.lower(streams_details.get("user_name"))
-                    usernames.remove(current_username)
-
-                    sql_find_message_id = \
-                        "SELECT UserInTwitchAlert.channel_id, message_id, custom_message, default_message " \
-                        "FROM UserInTwitchAlert " \
-                        "JOIN TwitchAlerts TA on UserInTwitchAlert.channel_id = TA.channel_id " \
-                        "JOIN (SELECT extension_id, guild_id FROM GuildExtensions " \
-                        "WHERE extension_id = 'TwitchAlert' " \
-                        "  OR extension_id = 'All') GE on TA.guild_id = GE.guild_id " \
-                        "WHERE twitch_username = ?;"
-
-                    results = self.ta_database_manager.database_manager.db_execute_select(
-                        sql_find_message_id, args=[current_username])
-
-                    new_message_embed = None
-
-                    for result in results:
-                        channel_id = result[0]
-                        message_id = result[1]
-                        custom_message = result[2]
-                        channel_default_message = result[3]
-
-                        channel = self.bot.get_channel(id=channel_id)
-                        try:
-                            # If no Alert is posted
-                            if message_id is None:
-                                if new_message_embed is None:
-                                    if custom_message is not None:
-                                        message = custom_message
-                                    else:
-                                        message = channel_default_message
-
-                                    new_message_embed = await self.create_alert_embed(streams_details, message)
-
-                                if new_message_embed is not None and channel is not None:
-                                    new_message = await channel.send(embed=new_message_embed)
-                                    sql_update_message_id = """
-                                    UPDATE UserInTwitchAlert 
-                                    SET message_id = ? 
-                                    WHERE channel_id = ? 
-                                        AND twitch_username = ?"""
-                                    self.ta_database_manager.database_manager.db_execute_commit(
-                                        sql_update_message_id, args=[new_message.id, result[0], current_username])
-                        except discord.errors.Forbidden as err:
-                            logging.warning(f"TwitchAlert: {err}  Name: {channel} ID: {channel.id}")
-                            sql_remove_invalid_channel = "DELETE FROM TwitchAlerts WHERE channel_id = ?"
-                            self.ta_database_manager.database_manager.db_execute_commit(sql_remove_invalid_channel,
-                                                                                        args=[channel.id])
+                new_message = await channel.send(embed=embed)
+                return subscription, new_message.id
+            except discord.errors.Forbidden as err:
+                logging.warning(f"TwitchAlert: {err}  Name: {channel} ID: {channel.id}")
+                sql_remove_invalid_channel = "DELETE FROM TwitchAlerts WHERE channel_id = ?"
+                await self.ta_database_manager.database_manager.commit(sql_remove_invalid_channel, args=[channel.id])
+                self.ta_database_manager.subscriptions_changed()
             except Exception as err:
-                logging.error(f"TwitchAlert: User Loop error {err}")
+                logging.error(f"TwitchAlert: Failed to send alert to {subscription.channel_id} {err}")
 
-        # Deals with remaining offline streams
-        await self.ta_database_manager.delete_all_offline_streams(False, usernames)
-        time_diff = time.time() - start
-        if time_diff > 5:
-            logging.warning(f"TwitchAlert: User Loop Finished in > 5s | {time_diff}s")
+        async def delete_alert(subscription, message_id):
+            await self.ta_database_manager.delete_message(message_id, subscription.channel_id)
+            return subscription, None
+
+        changes = await asyncio.gather(*[send_alert(subscription) for subscription in new_alerts],
+                                       *[delete_alert(subscription, message_id)
+                                         for subscription, message_id in offline_alerts])
+        changes = [change for change in changes if change is not None]
+        try:
+            await self.ta_database_manager.database_manager.execute_many(
+                state.sql_update_message_id,
+                [(message_id, getattr(subscription, state.alert_id_field), subscription.twitch_username)
+                 for subscription, message_id in changes], pass_errors=True)
+        except Exception as err:
+            # The database is the source of truth, so the state is reloaded from it next pass
+            logging.error(f"TwitchAlert: Failed to save alert messages {err}")
+            state.invalidate()
+            return
+        for subscription, message_id in changes:
+            state.set_message(subscription, message_id)
 
     async def create_alert_embed(self, stream_data, message):
         """
@@ -490,120 +710,166 @@ class TwitchAlert(commands.Cog):
         :param message: The custom message to be added as a description
         :return: The discord message id of the sent message
         """
-        user_details = await self.ta_database_manager.twitch_handler.get_user_data(
-            stream_data.get("user_name"))
+        user_details = await self.ta_database_manager.twitch_handler.get_user_data(get_stream_login(stream_data))
         game_details = await self.ta_database_manager.twitch_handler.get_game_data(
             stream_data.get("game_id"))
         return create_live_embed(stream_data, user_details, game_details, message)
 
+    async def prefetch_alert_data(self, streams_data):
+        """
+        Fetches the user and game details of every live stream in bulk, so the alerts of this loop pass are created
+        from the cache rather than making two requests each
+        :param streams_data: The twitch stream data of the loop pass
+        :return:
+        """
+        live_streams = [stream_data for stream_data in streams_data if stream_data.get('type') == "live"]
+        try:
+            await asyncio.gather(
+                self.ta_database_manager.twitch_handler.get_users_data(
+                    [get_stream_login(stream_data) for stream_data in live_streams]),
+                self.ta_database_manager.twitch_handler.get_games_data(
+                    [stream_data.get("game_id") for stream_data in live_streams]))
+        except Exception as err:
+            logging.error(f"TwitchAlert: Failed to prefetch alert data {err}")
+
     @tasks.loop(minutes=REFRESH_TEAMS_DELAY)
     async def loop_update_teams(self):
         start = time.time()
         # logging.info("TwitchAlert: Started Update Teams")
-        await self.ta_database_manager.update_all_teams_members()
+        try:
+            added, removed = await self.ta_database_manager.update_all_teams_members()
+            if added or removed:
+                logging.info(f"TwitchAlert: Teams updated, {added} members added and {removed} removed")
+        except Exception as err:
+            logging.error(f"TwitchAlert: Update Teams error {err}")
         time_diff = time.time() - start
         if time_diff > 5:
             logging.warning(f"TwitchAlert: Teams updated in > 5s | {time_diff}s")
 
-    @tasks.loop(minutes=TEAMS_LOOP_CHECK_LIVE_DELAY)
-    async def loop_check_team_live(self):
+    @tasks.loop(minutes=EVENTSUB_SYNC_DELAY)
+    async def loop_sync_eventsub(self):
+        """
+        A loop that keeps the EventSub subscriptions in sync with the users and teams in alerts, only contacting
+        twitch when the alerts have changed
+        :return:
         """
-        A loop to repeatedly send messages if a member of a team is live, and remove it when they are not
+        version = self.ta_database_manager.subscriptions_version
+        if version == self.eventsub_version:
+            return
+        sql_select_usernames = "SELECT twitch_username FROM UserInTwitchAlert " \
+                               "UNION SELECT twitch_username FROM UserInTwitchTeam"
+        usernames = await self.ta_database_manager.database_manager.select(sql_select_usernames)
+        if usernames is None:
+            return
+        try:
+            await self.eventsub.sync_subscriptions([username for username, in usernames
+                                                    if re.search(TWITCH_USERNAME_REGEX, username)])
+            self.eventsub_version = version
+        except Exception as err:
+            logging.error(f"TwitchAlert: EventSub sync error {err}")
+
+    @loop_sync_eventsub.before_loop
+    async def start_eventsub(self):
+        await self.eventsub.start()
+
+    @loop_sync_eventsub.after_loop
+    async def stop_eventsub(self):
+        await self.eventsub.stop()
 
+    async def on_stream_online(self, username):
+        """
+        Sends the alerts of a user when EventSub notifies that they have gone live
+        :param username: The twitch username of the user
         :return:
         """
-        start = time.time()
-        # logging.info("TwitchAlert: Team Loop Started")
-        sql_select_team_users = "SELECT twitch_username, twitch_team_name " \
-                                "FROM UserInTwitchTeam " \
-                                "JOIN TeamInTwitchAlert TITA " \
-                                "  ON UserInTwitchTeam.team_twitch_alert_id = TITA.team_twitch_alert_id " \
-                                "JOIN TwitchAlerts TA on TITA.channel_id = TA.channel_id " \
-                                "JOIN (SELECT extension_id, guild_id FROM GuildExtensions " \
-                                "WHERE extension_id = 'TwitchAlert' " \
-                                "  OR extension_id = 'All') GE on TA.guild_id = GE.guild_id "
-
-        users_and_teams = self.ta_database_manager.database_manager.db_execute_select(sql_select_team_users)
-        usernames = []
-        for user in users_and_teams:
-            if not re.search(TWITCH_USERNAME_REGEX, user[1]):
-                sql_remove_invalid_user = "DELETE FROM TeamInTwitchAlert WHERE twitch_team_name = ?"
-                self.ta_database_manager.database_manager.db_execute_commit(sql_remove_invalid_user, args=[user[1]])
-            else:
-                usernames.append(user[0])
+        try:
+            stream_data = None
+            for attempt in range(EVENTSUB_STREAM_RETRIES):
+                if attempt:
+                    await asyncio.sleep(EVENTSUB_STREAM_RETRY_DELAY)
+                streams_data = await self.ta_database_manager.twitch_handler.get_streams_data([username])
+                stream_data = next((stream_data for stream_data in streams_data or []
+                                    if stream_data.get('type') == "live"), None)
+                if stream_data is not None:
+                    break
+            if stream_data is None:
+                # The next pass of the live loops will send the alerts instead
+                logging.warning(f"TwitchAlert: Stream of {username} not found after online event")
+                return
+            await self.update_stream(username, stream_data)
+        except Exception as err:
+            logging.error(f"TwitchAlert: Online event error {err}")
 
-        if not usernames:
-            return
+    async def on_stream_offline(self, username):
+        """
+        Deletes the alerts of a user when EventSub notifies that they have gone offline
+        :param username: The twitch username of the user
+        :return:
+        """
+        try:
+            await self.update_stream(username, None)
+        except Exception as err:
+            logging.error(f"TwitchAlert: Offline event error {err}")
 
-        streams_data = await self.ta_database_manager.twitch_handler.get_streams_data(usernames)
+    async def update_stream(self, username, stream_data):
+        """
+        Updates the user and team alerts of a single user
+        :param username: The twitch username of the user
+        :param stream_data: The twitch stream data of the user, or None if they are offline
+        :return:
+        """
+        live_streams = {username: stream_data} if stream_data is not None else {}
+        self.poll_scheduler.observe(username, stream_data is not None)
+        async with self.alerts_lock:
+            for state, load_alerts in [(self.user_alerts, self.load_user_alerts),
+                                       (self.team_alerts, self.load_team_alerts)]:
+                if not await load_alerts():
+                    continue
+                if stream_data is not None:
+                    state.live[username] = stream_data.get("id")
+                else:
+                    state.live.pop(username, None)
+                subscriptions = [subscription for subscription in self.filter_enabled_guilds(state.subscriptions)
+                                 if subscription.twitch_username == username]
+                await self.apply_alerts(state, subscriptions, live_streams, set())
+
+
+def get_stream_login(stream_data):
+    """
+    Gets the lower case login of the user of a stream
+    :param stream_data: The twitch stream data
+    :return: The login, falling back to the display name if the login is missing
+    """
+    return str.lower(stream_data.get("user_login") or stream_data.get("user_name"))
 
-        if streams_data is None:
-            return
-        # Deals with online streams
-        for stream_data in streams_data:
-            try:
-                if stream_data.get('type') == "live":
-                    current_username = str.lower(stream_data.get("user_name"))
-                    usernames.remove(current_username)
-
-                    sql_find_message_id = """
-                    SELECT TITA.channel_id, UserInTwitchTeam.message_id, TITA.team_twitch_alert_id, custom_message, 
-                      default_message 
-                    FROM UserInTwitchTeam
-                    JOIN TeamInTwitchAlert TITA on UserInTwitchTeam.team_twitch_alert_id = TITA.team_twitch_alert_id
-                    JOIN TwitchAlerts TA on TITA.channel_id = TA.channel_id
-                    JOIN (SELECT extension_id, guild_id 
-                          FROM GuildExtensions 
-                          WHERE extension_id = 'TwitchAlert' OR extension_id = 'All') GE ON TA.guild_id = GE.guild_id 
-                    WHERE twitch_username = ?"""
-
-                    results = self.ta_database_manager.database_manager.db_execute_select(
-                        sql_find_message_id, args=[current_username])
-
-                    new_message_embed = None
-
-                    for result in results:
-                        channel_id = result[0]
-                        message_id = result[1]
-                        team_twitch_alert_id = result[2]
-                        custom_message = result[3]
-                        channel_default_message = result[4]
-                        channel = self.bot.get_channel(id=channel_id)
-                        try:
-                            # If no Alert is posted
-                            if message_id is None:
-                                if new_message_embed is None:
-                                    if custom_message is not None:
-                                        message = custom_message
-                                    else:
-                                        message = channel_default_message
-
-                                    new_message_embed = await self.create_alert_embed(stream_data, message)
-
-                                if new_message_embed is not None and channel is not None:
-                                    new_message = await channel.send(embed=new_message_embed)
-
-                                    sql_update_message_id = """
-                                    UPDATE UserInTwitchTeam 
-                                    SET message_id = ?
-                                    WHERE team_twitch_alert_id = ?
-                                    AND twitch_username = ?"""
-                                    self.ta_database_manager.database_manager.db_execute_commit(
-                                        sql_update_message_id,
-                                        args=[new_message.id, team_twitch_alert_id, current_username])
-                        except discord.errors.Forbidden as err:
-                            logging.warning(f"TwitchAlert: {err}  Name: {channel} ID: {channel.id}")
-                            sql_remove_invalid_channel = "DELETE FROM TwitchAlerts WHERE channel_id = ?"
-                            self.ta_database_manager.database_manager.db_execute_commit(sql_remove_invalid_channel,
-                                                                                        args=[channel.id])
-            except Exception as err:
-                logging.error(f"TwitchAlert: Team Loop error {err}")
 
-        # Deals with remaining offline streams
-        await self.ta_database_manager.delete_all_offline_streams(True, usernames)
-        time_diff = time.time() - start
-        if time_diff > 5:
-            logging.warning(f"TwitchAlert: Teams Loop Finished in > 5s | {time_diff}s")
+def twitch_stats_embed(report, team_sync_stats=None):
+    """
+    Creates a discord embed of the requests made to each twitch endpoint
+    :param report: The report from RequestStats.report
+    :param team_sync_stats: The team_sync_stats of the TwitchAlertDBManager
+    :return: The finished discord embed
+    """
+    embed = discord.Embed()
+    embed.title = "Twitch request statistics"
+    embed.colour = KOALA_GREEN
+    embed.set_footer(text=f"{len(report)} endpoints")
+    if team_sync_stats is not None:
+        embed.add_field(name="Team rosters",
+                        value=f"{team_sync_stats['runs']} syncs of {team_sync_stats['teams']} teams, "
+                              f"{team_sync_stats['failed']} failed\n"
+                              f"{team_sync_stats['added']} members added, {team_sync_stats['removed']} removed\n"
+                              f"last {team_sync_stats['last_duration']:.1f}s, "
+                              f"max {team_sync_stats['max_duration']:.1f}s",
+                        inline=False)
+    for stats in report[:24]:
+        embed.add_field(name=stats["endpoint"][:256],
+                        value=f"{stats['requests']} requests, {stats['errors']} errors, {stats['retries']} retries\n"
+                              f"{stats['throttled']} throttled for {stats['throttle_time']:.1f}s, "
+                              f"mean {stats['total_time'] / max(stats['requests'], 1) * 1000:.1f}ms, "
+                              f"max {stats['max_time'] * 1000:.1f}ms",
+                        inline=False)
+    return embed
 
 
 def create_live_embed(stream_info, user_info, game_info, message):
@@ -633,18 +899,493 @@ def create_live_embed(stream_info, user_info, game_info, message):
     return embed
 
 
+class LiveAlertState:
+    """
+    The resident state of the alerts of a live loop: the alerts, the messages posted for them, and the streams that
+    are live. It is loaded from the database when the alerts change, and otherwise only updated on online and offline
+    transitions, which are written to the database first so it stays the source of truth after a crash
+    """
+
+    def __init__(self, alert_id_field, sql_update_message_id):
+        """
+        Initialises local variables
+        :param alert_id_field: The field of the subscription rows identifying the alert in sql_update_message_id
+        :param sql_update_message_id: SQL setting the message_id of an alert, given the message ID, the alert ID and
+        the twitch username
+        """
+        self.alert_id_field = alert_id_field
+        self.sql_update_message_id = sql_update_message_id
+        self.subscriptions = []
+        self.messages = {}
+        self.live = {}
+        self.version = None
+
+    def key(self, subscription):
+        """
+        :param subscription: A subscription row
+        :return: The alert ID and twitch username of the subscription
+        """
+        return getattr(subscription, self.alert_id_field), subscription.twitch_username
+
+    def is_stale(self, version):
+        """
+        :param version: The current subscriptions_version of the TwitchAlertDBManager
+        :return: True if the alerts need to be reloaded from the database
+        """
+        return self.version != version
+
+    def hydrate(self, subscriptions, version):
+        """
+        Replaces the state with alerts loaded from the database
+        :param subscriptions: The subscription rows, with the twitch_username, channel_id, message_id, custom_message
+        and default_message of each alert
+        :param version: The subscriptions_version of the TwitchAlertDBManager when the rows were loaded
+        """
+        self.subscriptions = subscriptions
+        self.messages = {self.key(subscription): subscription.message_id for subscription in subscriptions
+                         if subscription.message_id is not None}
+        self.version = version
+
+    def set_message(self, subscription, message_id):
+        """
+        Records the message posted for an alert
+        :param subscription: The subscription row of the alert
+        :param message_id: The discord message ID, or None if the alert was removed
+        """
+        if message_id is None:
+            self.messages.pop(self.key(subscription), None)
+        else:
+            self.messages[self.key(subscription)] = message_id
+
+    def invalidate(self):
+        """
+        Forces the alerts to be reloaded from the database
+        """
+        self.version = None
+
+
+class StreamerHistory:
+    """
+    What the PollScheduler has learnt about a streamer
+    """
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_live = None
+        self.live = False
+        self.hours = [0.0] * 24
+        self.next_poll = now
+
+
+class PollScheduler:
+    """
+    Decides when each streamer is next polled, from the times they have been seen going live. Streamers who are live,
+    are new, or usually go live within an hour of now are polled every min_interval. Others back off exponentially
+    with the days since they were last live, but are never polled less often than every max_interval
+    """
+
+    def __init__(self, min_interval=LOOP_CHECK_LIVE_DELAY * 60, max_interval=POLL_MAX_STALENESS):
+        """
+        Initialises local variables
+        :param min_interval: Seconds between the polls of likely live streamers
+        :param max_interval: Maximum seconds between the polls of any streamer
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.histories = {}
+
+    def history(self, username, now):
+        history = self.histories.get(username)
+        if history is None:
+            history = self.histories[username] = StreamerHistory(now)
+        return history
+
+    def due(self, usernames, now=None):
+        """
+        :param usernames: The usernames of every subscribed streamer
+        :param now: The current time
+        :return: The usernames that should be polled now
+        """
+        if now is None:
+            now = time.time()
+        return [username for username in usernames if self.history(username, now).next_poll <= now]
+
+    def observe(self, username, live, now=None):
+        """
+        Records the status of a streamer from a poll or an event, and schedules their next poll
+        :param username: The username of the streamer
+        :param live: True if the streamer is live
+        :param now: The current time
+        :return:
+        """
+        if now is None:
+            now = time.time()
+        history = self.history(username, now)
+        if live and not history.live:
+            history.hours = [weight * POLL_HISTORY_DECAY for weight in history.hours]
+            history.hours[time.gmtime(now).tm_hour] += 1
+        if live or history.live:
+            history.last_live = now
+        history.live = live
+        history.next_poll = now + self.interval(history, now)
+
+    def interval(self, history, now):
+        """
+        :param history: The StreamerHistory of a streamer
+        :param now: The current time
+        :return: Seconds until the streamer should next be polled
+        """
+        if history.live or now - history.first_seen < POLL_LEARNING_PERIOD:
+            return self.min_interval
+        total = sum(history.hours)
+        hour = time.gmtime(now).tm_hour
+        if total and sum(history.hours[(hour + offset) % 24] for offset in [-1, 0, 1]) / total \
+                >= POLL_USUAL_HOUR_SHARE:
+            return self.min_interval
+        idle_days = (now - (history.last_live or history.first_seen)) / (24 * 60 * 60)
+        return min(self.max_interval, self.min_interval * 2 ** idle_days)
+
+    def prune(self, usernames):
+        """
+        Forgets the streamers who are no longer subscribed, after due has been called with the same usernames
+        :param usernames: The distinct usernames of every subscribed streamer
+        :return:
+        """
+        if len(self.histories) > len(usernames):
+            usernames = set(usernames)
+            self.histories = {username: history for username, history in self.histories.items()
+                              if username in usernames}
+
+
+class TTLCache:
+    """
+    A least recently used cache whose entries expire after a time to live, counting its hits and misses
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        Initialises local variables
+        :param max_size: The maximum number of entries, the least recently used is evicted when it is full
+        :param ttl: Seconds an entry is kept for
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Gets a cached value, counting a hit or a miss
+        :param key: The key of the value
+        :return: The value, or None if it isn't cached or has expired
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        """
+        Caches a value, evicting the least recently used value if the cache is full
+        :param key: The key of the value
+        :param value: The value to cache
+        """
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes every entry and resets the counters
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict of the hits, misses, hit rate and size of the cache
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries)}
+
+
+class TwitchAPIError(Exception):
+    """
+    A request to the twitch API failed, after any retries
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class TokenBucket:
+    """
+    A token bucket pacing requests to the twitch rate limit. It refills continuously over the rate limit period, and
+    is corrected by the rate limit headers of each response
+    """
+
+    def __init__(self, capacity=TWITCH_RATE_LIMIT, period=TWITCH_RATE_LIMIT_PERIOD):
+        """
+        Initialises local variables
+        :param capacity: The number of requests allowed each period
+        :param period: Seconds the bucket takes to refill from empty
+        """
+        self.capacity = capacity
+        self.period = period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.reset_at = 0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.period)
+        self.updated = now
+
+    async def acquire(self):
+        """
+        Takes a token, waiting until one is available
+        :return: Seconds spent waiting
+        """
+        start = time.monotonic()
+        async with self.lock:
+            while True:
+                if self.reset_at > time.time():
+                    # Twitch says the bucket is empty until it resets
+                    await asyncio.sleep(self.reset_at - time.time())
+                    self.reset_at = 0
+                    self.tokens = max(self.tokens, 1)
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return time.monotonic() - start
+                await asyncio.sleep((1 - self.tokens) * self.period / self.capacity)
+
+    def update(self, headers):
+        """
+        Corrects the bucket from the rate limit headers of a response
+        :param headers: The headers of the response
+        :return:
+        """
+        try:
+            limit = int(headers["Ratelimit-Limit"])
+            remaining = int(headers["Ratelimit-Remaining"])
+            reset = int(headers["Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        self.refill()
+        self.capacity = max(limit, 1)
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0:
+            self.reset_at = reset
+
+
+class RequestStats:
+    """
+    Request, error, retry and throttle counts of the requests made to each twitch endpoint
+    """
+
+    def __init__(self):
+        self._stats = {}
+
+    def get(self, endpoint):
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            stats = self._stats[endpoint] = {"requests": 0, "errors": 0, "retries": 0, "throttled": 0,
+                                             "throttle_time": 0.0, "total_time": 0.0, "max_time": 0.0,
+                                             "statuses": {}}
+        return stats
+
+    def record(self, endpoint, status, elapsed):
+        """
+        Records a response, or a failed connection
+        :param endpoint: The endpoint requested, e.g. streams
+        :param status: The HTTP status of the response, None if no response was received
+        :param elapsed: Seconds the request took
+        :return:
+        """
+        stats = self.get(endpoint)
+        stats["requests"] += 1
+        stats["errors"] += int(status is None or status > 399)
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+
+    def record_retry(self, endpoint):
+        self.get(endpoint)["retries"] += 1
+
+    def record_throttle(self, endpoint, waited):
+        """
+        Records a request that waited for the rate limit
+        :param endpoint: The endpoint requested, e.g. streams
+        :param waited: Seconds the request waited
+        :return:
+        """
+        stats = self.get(endpoint)
+        stats["throttled"] += 1
+        stats["throttle_time"] += waited
+
+    def report(self):
+        """
+        :return: List of dicts of the endpoint and its statistics, most requested first
+        """
+        return sorted([dict(stats, endpoint=endpoint, statuses=dict(stats["statuses"]))
+                       for endpoint, stats in self._stats.items()],
+                      key=lambda stats: stats["requests"], reverse=True)
+
+    def reset(self):
+        self._stats.clear()
+
+
+class TokenManager:
+    """
+    Keeps an OAuth token fresh. Concurrent refreshes share one in-flight request, the token is refreshed in the
+    background before it expires so requests don't wait for it, and failed refreshes back off
+    """
+
+    def __init__(self, fetch_token, refresh_margin=TOKEN_REFRESH_MARGIN, retry_base_delay=RETRY_BASE_DELAY):
+        """
+        Initialises local variables
+        :param fetch_token: Coroutine function getting a new token, with its absolute expiry time as expires_in
+        :param refresh_margin: Seconds before the token expires that it is refreshed in the background
+        :param retry_base_delay: Seconds the jittered exponential backoff of failed refreshes starts from
+        """
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.retry_base_delay = retry_base_delay
+        self.token = {}
+        self.refresh_future = None
+        self.failures = 0
+        self.retry_at = 0
+
+    def is_valid(self, now):
+        return bool(self.token.get("access_token")) and self.token.get("expires_in", 0) > now + 1
+
+    async def get_token(self):
+        """
+        Gets the current token, only waiting for a new one if it has expired
+        :return: The OAuth token
+        :raises TwitchAPIError: If there is no valid token and the refresh failed or is backing off
+        """
+        now = time.time()
+        if self.is_valid(now):
+            if self.token["expires_in"] - now < self.refresh_margin and now >= self.retry_at:
+                self.start_refresh()
+            return self.token
+        return await self.refresh()
+
+    async def refresh(self, stale_token=None):
+        """
+        Gets a new token, joining the refresh in flight if there is one
+        :param stale_token: The token a request was rejected with, a new token isn't fetched if it was already replaced
+        :return: The OAuth token
+        :raises TwitchAPIError: If the refresh failed or is backing off
+        """
+        if stale_token is not None and self.token is not stale_token and self.is_valid(time.time()):
+            return self.token
+        if self.refresh_future is None and time.time() < self.retry_at:
+            raise TwitchAPIError(None, f"OAuth token refresh backing off for {self.retry_at - time.time():.1f}s")
+        return await asyncio.shield(self.start_refresh())
+
+    def start_refresh(self):
+        """
+        Starts a refresh if there isn't one in flight
+        :return: The future of the refresh
+        """
+        if self.refresh_future is None:
+            self.refresh_future = asyncio.ensure_future(self._refresh())
+            # Background refreshes are not awaited, so their errors are retrieved here
+            self.refresh_future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        return self.refresh_future
+
+    async def _refresh(self):
+        try:
+            token = await self.fetch_token()
+        except Exception as err:
+            self.failures += 1
+            delay = min(RETRY_MAX_DELAY, self.retry_base_delay * 2 ** self.failures) * random.uniform(0.5, 1)
+            self.retry_at = time.time() + delay
+            logging.error(f"TwitchAlert: Failed to get OAuth token, retrying in {delay:.1f}s {err}")
+            raise TwitchAPIError(getattr(err, "status", None), f"Failed to get OAuth token {err}")
+        finally:
+            self.refresh_future = None
+        self.failures = 0
+        self.retry_at = 0
+        self.token = token
+        return token
+
+    def cancel(self):
+        """
+        Cancels the refresh in flight, if there is one
+        :return:
+        """
+        if self.refresh_future is not None:
+            self.refresh_future.cancel()
+            self.refresh_future = None
+
+
 class TwitchAPIHandler:
     """
     A wrapper to interact with the twitch API
     """
 
-    def __init__(self, client_id: str, client_secret: str):
+    def __init__(self, client_id: str, client_secret: str, api_url=TWITCH_API_URL, oauth_url=TWITCH_OAUTH_URL,
+                 streams_concurrency=STREAMS_CONCURRENCY, max_retries=MAX_RETRIES, retry_base_delay=RETRY_BASE_DELAY):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.api_url = api_url
+        self.oauth_url = oauth_url
+        self.streams_concurrency = streams_concurrency
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.rate_limiter = TokenBucket()
+        self.request_stats = RequestStats()
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.game_cache = TTLCache(GAME_CACHE_SIZE, GAME_CACHE_TTL)
         self.params = {'client_id': self.client_id,
                        'client_secret': self.client_secret,
                        'grant_type': 'client_credentials'}
-        self.token = {}
+        self.token_manager = TokenManager(self.fetch_token, retry_base_delay=retry_base_delay)
+        self.session = None
+
+    def get_session(self):
+        """
+        Gets the session used for every request, creating it if it is not open. The session keeps its connections to
+        twitch alive between requests, so the TLS handshake isn't repeated every loop
+        :return: The aiohttp client session
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                                             ttl_dns_cache=HTTP_DNS_CACHE_TTL)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(HTTP_TIMEOUT))
+        return self.session
+
+    async def close(self):
+        """
+        Closes the session and its connections, a new session is created if another request is made
+        :return:
+        """
+        self.token_manager.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @property
+    def token(self):
+        return self.token_manager.token
 
     @property
     def base_headers(self):
@@ -655,26 +1396,34 @@ class TwitchAPIHandler:
 
     async def get_new_twitch_oauth(self):
         """
-        Get a new OAuth2 token from twitch using client_id and client_secret
+        Get a new OAuth2 token from twitch using client_id and client_secret, joining the request in flight if there
+        is one
         :return: The new OAuth2 token
         """
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(60)) as client:
-            async with client.post('https://id.twitch.tv/oauth2/token', params=self.params) as response:
-                if response.status > 399:
-                    logging.critical(f'TwitchAlert: Error {response.status} while getting Oauth token')
-                    self.token = {}
-
-                response_json = await response.json()
+        return await self.token_manager.refresh()
 
-                try:
-                    response_json['expires_in'] += time.time()
-                except KeyError:
-                    # probably shouldn't need this, but catch just in case
-                    logging.warning('TwitchAlert: Failed to set token expiration time')
+    async def fetch_token(self):
+        """
+        Requests a new OAuth2 token from twitch
+        :return: The new OAuth2 token, with its absolute expiry time as expires_in
+        :raises TwitchAPIError: If twitch didn't give a token
+        """
+        start = time.perf_counter()
+        async with self.get_session().post(self.oauth_url, params=self.params) as response:
+            self.request_stats.record("oauth2/token", response.status, time.perf_counter() - start)
+            if response.status > 399:
+                logging.critical(f'TwitchAlert: Error {response.status} while getting Oauth token')
+                raise TwitchAPIError(response.status, f"{response.status} while getting OAuth token")
 
-                self.token = response_json
+            response_json = await response.json()
 
-                return self.token
+        try:
+            response_json['expires_in'] += time.time()
+        except KeyError:
+            # probably shouldn't need this, but catch just in case
+            logging.warning('TwitchAlert: Failed to set token expiration time')
+            response_json['expires_in'] = time.time() + TOKEN_DEFAULT_LIFETIME
+        return response_json
 
     async def requests_get(self, url, headers=None, params=None):
         """
@@ -684,50 +1433,162 @@ class TwitchAPIHandler:
         :param params: The parameters of the request
         :return: The response of the request
         """
-        if self.token.get('expires_in', 0) <= time.time() + 1 or not self.token:
-            await self.get_new_twitch_oauth()
-
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(60)) as client:
-            async with client.get(url=url, headers=headers if headers else self.base_headers, params=params) as \
-                    response:
+        return await self.request("GET", url, headers, params)
 
-                if response.status == 401:
-                    logging.info(f"TwitchAlert: {response.status}, getting new oauth and retrying")
-                    await self.get_new_twitch_oauth()
-                    return await self.requests_get(url, headers, params)
-                elif response.status > 399:
-                    logging.warning(f'TwitchAlert: {response.status} while getting requesting URL:{url}')
+    async def request(self, method, url, headers=None, params=None, json_data=None):
+        """
+        Sends a request to the given url using headers of this object. Requests are paced by the rate limit, a 429, a
+        5xx or a connection error is retried with jittered exponential backoff, and a 401 gets a new token once
+        :param method: The HTTP method of the request, e.g. POST
+        :param url: The URL to send the request to
+        :param headers: the Headers required for the request, will use self.headers by default
+        :param params: The parameters of the request
+        :param json_data: The JSON body of the request
+        :return: The response of the request, empty if it has no content
+        :raises TwitchAPIError: If the request failed after any retries
+        """
+        endpoint = self.endpoint_name(url)
+        retries = 0
+        refreshes = 0
+        while True:
+            token = await self.token_manager.get_token()
+            waited = await self.rate_limiter.acquire()
+            if waited > 0.001:
+                self.request_stats.record_throttle(endpoint, waited)
+            start = time.perf_counter()
+            try:
+                async with self.get_session().request(method, url=url,
+                                                      headers=headers if headers else self.base_headers,
+                                                      params=params, json=json_data) as response:
+                    self.rate_limiter.update(response.headers)
+                    status = response.status
+                    self.request_stats.record(endpoint, status, time.perf_counter() - start)
+                    if status == 204:
+                        return {}
+                    elif status < 400:
+                        return await response.json()
+                    error = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                self.request_stats.record(endpoint, None, time.perf_counter() - start)
+                status = None
+                error = repr(err)
+
+            if status == 401 and refreshes < MAX_TOKEN_REFRESHES:
+                logging.info(f"TwitchAlert: {status}, getting new oauth and retrying")
+                refreshes += 1
+                await self.token_manager.refresh(stale_token=token)
+            elif (status is None or status == 429 or status > 499) and retries < self.max_retries:
+                retries += 1
+                self.request_stats.record_retry(endpoint)
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, self.retry_base_delay * 2 ** retries))
+                logging.warning(f"TwitchAlert: {status or error} while requesting {endpoint}, "
+                                f"retry {retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                logging.warning(f'TwitchAlert: {status} while getting requesting URL:{url}')
+                raise TwitchAPIError(status, f"{status} while requesting {endpoint}: {error[:200]}")
 
-                return await response.json()
+    def endpoint_name(self, url):
+        """
+        :param url: A URL of the twitch API
+        :return: The endpoint of the URL for the request statistics, e.g. streams
+        """
+        path = urlparse(url).path
+        api_path = urlparse(self.api_url).path
+        return path[len(api_path):] if path.startswith(api_path) else path
 
-    async def get_streams_data(self, usernames):
+    async def get_streams_data(self, usernames, failed_usernames=None):
         """
-        Gets all stream information from a list of given usernames
+        Gets all stream information from a list of given usernames. The usernames are requested in batches of 100,
+        with up to streams_concurrency batches in flight at once, and a batch that fails doesn't affect the others
         :param usernames: The list of usernames
-        :return: The JSON data of the request
+        :param failed_usernames: A list the usernames of failed batches are added to, as their status is unknown
+        :return: The JSON data of the request, or None if every batch failed
         """
-        url = 'https://api.twitch.tv/helix/streams?'
+        url = self.api_url + 'streams?'
+        semaphore = asyncio.Semaphore(self.streams_concurrency)
+
+        async def get_batch(batch):
+            async with semaphore:
+                try:
+                    data = (await self.requests_get(url + "user_login=" + "&user_login=".join(batch))).get("data")
+                except Exception as err:
+                    logging.error(f"TwitchAlert: Streams request failed {err}")
+                    data = None
+            if data is None and failed_usernames is not None:
+                failed_usernames.extend(batch)
+            return data
+
+        batches = [usernames[i:i + TWITCH_BATCH_SIZE] for i in range(0, len(usernames), TWITCH_BATCH_SIZE)]
+        result = None
+        for batch in asyncio.as_completed([get_batch(batch) for batch in batches]):
+            data = await batch
+            if data is not None:
+                if result is None:
+                    result = []
+                result += data
+
+        return result
 
-        next_hundred_users = usernames[:100]
-        usernames = usernames[100:]
-        result = (await self.requests_get(url + "user_login=" + "&user_login=".join(next_hundred_users))).get("data")
+    async def get_cached_data(self, cache, endpoint, param, field, keys):
+        """
+        Gets the data of the given keys from a cache, fetching any that aren't cached in batches of 100
+        :param cache: The TTLCache of the data
+        :param endpoint: The helix endpoint of the data, e.g. users
+        :param param: The query parameter of the keys, e.g. login
+        :param field: The field of the returned data that matches the key, e.g. login
+        :param keys: The keys to get the data of
+        :return: dict of key to its JSON data, keys that don't exist on twitch are left out
+        """
+        result = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            data = cache.get(key)
+            if data is not None:
+                result[key] = data
+            else:
+                missing.append(key)
+
+        url = self.api_url + endpoint + '?'
+        semaphore = asyncio.Semaphore(self.streams_concurrency)
 
-        while usernames:
-            next_hundred_users = usernames[:100]
-            usernames = usernames[100:]
-            result += (await self.requests_get(url + "user_login=" + "&user_login=".join(next_hundred_users))).get(
-                "data")
+        async def get_batch(batch):
+            async with semaphore:
+                return (await self.requests_get(url + param + "=" + ("&" + param + "=").join(batch))).get("data")
 
+        batches = [missing[i:i + TWITCH_BATCH_SIZE] for i in range(0, len(missing), TWITCH_BATCH_SIZE)]
+        for batch_data in await asyncio.gather(*[get_batch(batch) for batch in batches]):
+            for data in batch_data or []:
+                key = str(data.get(field)).lower()
+                cache.set(key, data)
+                result[key] = data
         return result
 
+    async def get_users_data(self, usernames):
+        """
+        Gets the user information of the given users, from the cache where possible
+        :param usernames: The twitch usernames of the users
+        :return: dict of lower case username to the JSON information of the user's data
+        """
+        return await self.get_cached_data(self.user_cache, "users", "login", "login",
+                                          [username.lower() for username in usernames if username])
+
+    async def get_games_data(self, game_ids):
+        """
+        Gets the game information of the given games, from the cache where possible
+        :param game_ids: The twitch game IDs of the games
+        :return: dict of game ID to the JSON information of the game's data
+        """
+        return await self.get_cached_data(self.game_cache, "games", "id", "id",
+                                          [str(game_id) for game_id in game_ids if game_id])
+
     async def get_user_data(self, username):
         """
         Gets the user information of a given user
         :param username: The display twitch username of the user
         :return: The JSON information of the user's data
         """
-        url = 'https://api.twitch.tv/helix/users?login=' + username
-        return (await self.requests_get(url)).get("data")[0]
+        return (await self.get_users_data([username])).get(username.lower())
 
     async def get_game_data(self, game_id):
         """
@@ -736,9 +1597,7 @@ class TwitchAPIHandler:
         :return: The JSON information of the game's data
         """
         if game_id != "":
-            url = 'https://api.twitch.tv/helix/games?id=' + game_id
-            game_data = await self.requests_get(url)
-            return game_data.get("data")[0]
+            return (await self.get_games_data([game_id])).get(str(game_id))
         else:
             return None
 
@@ -748,10 +1607,205 @@ class TwitchAPIHandler:
         :param team_id: The team name of the twitch team
         :return: the JSON information of the users
         """
-        url = 'https://api.twitch.tv/helix/teams?name=' + team_id
+        url = self.api_url + 'teams?name=' + team_id
         return (
             await self.requests_get(url)).get("data")[0].get("users")
 
+    async def get_eventsub_subscriptions(self):
+        """
+        Gets every EventSub subscription of this client, following the pages of the results
+        :return: The JSON information of the subscriptions
+        """
+        url = self.api_url + 'eventsub/subscriptions'
+        subscriptions = []
+        cursor = None
+        while True:
+            response = await self.requests_get(url, params={"after": cursor} if cursor else None)
+            subscriptions += response.get("data") or []
+            cursor = (response.get("pagination") or {}).get("cursor")
+            if not cursor:
+                return subscriptions
+
+    async def create_eventsub_subscription(self, event_type, broadcaster_id, callback_url, secret):
+        """
+        Subscribes to an event of a user, sent as webhooks to the given URL
+        :param event_type: The EventSub subscription type, e.g. stream.online
+        :param broadcaster_id: The twitch user ID of the user
+        :param callback_url: The URL twitch sends the events to
+        :param secret: The secret the events are signed with
+        :return: The JSON information of the new subscription, or None if it failed
+        """
+        response = await self.request("POST", self.api_url + 'eventsub/subscriptions', json_data={
+            "type": event_type,
+            "version": "1",
+            "condition": {"broadcaster_user_id": str(broadcaster_id)},
+            "transport": {"method": "webhook", "callback": callback_url, "secret": secret}})
+        data = response.get("data")
+        return data[0] if data else None
+
+    async def delete_eventsub_subscription(self, subscription_id):
+        """
+        Deletes an EventSub subscription
+        :param subscription_id: The ID of the subscription
+        :return:
+        """
+        await self.request("DELETE", self.api_url + 'eventsub/subscriptions', params={"id": subscription_id})
+
+
+class EventSubHandler:
+    """
+    A receiver for twitch EventSub webhooks, which verifies the signature of every message and passes stream.online
+    and stream.offline events to the given callbacks, and manages the subscriptions twitch sends them for
+    """
+
+    def __init__(self, twitch_handler, secret, callback_url, on_online, on_offline, host=TWITCH_EVENTSUB_HOST,
+                 port=TWITCH_EVENTSUB_PORT):
+        """
+        Initialises local variables
+        :param twitch_handler: The TwitchAPIHandler used to manage the subscriptions
+        :param secret: The secret the messages are signed with
+        :param callback_url: The public URL twitch sends the messages to, forwarded to this receiver
+        :param on_online: Coroutine function called with the username of a user that goes live
+        :param on_offline: Coroutine function called with the username of a user that goes offline
+        :param host: The address the receiver listens on
+        :param port: The port the receiver listens on
+        """
+        self.twitch_handler = twitch_handler
+        self.secret = secret
+        self.callback_url = callback_url
+        self.callbacks = {"stream.online": on_online, "stream.offline": on_offline}
+        self.host = host
+        self.port = port
+        self.seen_messages = TTLCache(EVENTSUB_DEDUP_SIZE, EVENTSUB_MESSAGE_MAX_AGE)
+        self.subscriptions = {}
+        self.tasks = set()
+        self.runner = None
+        self.app = web.Application()
+        self.app.router.add_post(urlparse(callback_url).path or "/", self.handle_request)
+
+    async def start(self):
+        """
+        Starts listening for messages
+        :return:
+        """
+        if self.runner is None:
+            self.runner = web.AppRunner(self.app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logging.info(f"TwitchAlert: EventSub receiver listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        """
+        Stops listening for messages
+        :return:
+        """
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def verify_message(self, headers, body):
+        """
+        Checks a message was signed by twitch with the secret, and was sent recently
+        :param headers: The headers of the message
+        :param body: The raw body of the message
+        :return: True if the message is genuine
+        """
+        message_id = headers.get("Twitch-Eventsub-Message-Id")
+        timestamp = headers.get("Twitch-Eventsub-Message-Timestamp")
+        signature = headers.get("Twitch-Eventsub-Message-Signature")
+        if not message_id or not timestamp or not signature:
+            return False
+        expected = "sha256=" + hmac.new(self.secret.encode(), message_id.encode() + timestamp.encode() + body,
+                                        hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            return False
+        try:
+            sent = calendar.timegm(time.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+        except ValueError:
+            return False
+        return abs(time.time() - sent) <= EVENTSUB_MESSAGE_MAX_AGE
+
+    async def handle_request(self, request):
+        """
+        Handles a message from twitch, answering the challenge of a new subscription or dispatching an event
+        :param request: The aiohttp request of the message
+        :return: The aiohttp response
+        """
+        body = await request.read()
+        if not self.verify_message(request.headers, body):
+            logging.warning("TwitchAlert: Rejected EventSub message with an invalid signature")
+            return web.Response(status=403)
+        message_id = request.headers["Twitch-Eventsub-Message-Id"]
+        if self.seen_messages.get(message_id):
+            # Twitch retries messages it isn't sure were received
+            return web.Response(status=204)
+        self.seen_messages.set(message_id, True)
+
+        message = json.loads(body)
+        message_type = request.headers.get("Twitch-Eventsub-Message-Type")
+        subscription = message.get("subscription") or {}
+        if message_type == "webhook_callback_verification":
+            return web.Response(text=message.get("challenge"), content_type="text/plain")
+        elif message_type == "revocation":
+            logging.warning(f"TwitchAlert: EventSub subscription {subscription.get('id')} revoked, "
+                            f"{subscription.get('status')}")
+            self.subscriptions = {key: subscription_id for key, subscription_id in self.subscriptions.items()
+                                  if subscription_id != subscription.get("id")}
+        elif message_type == "notification":
+            callback = self.callbacks.get(subscription.get("type"))
+            username = (message.get("event") or {}).get("broadcaster_user_login")
+            if callback is not None and username:
+                # Twitch expects a quick response, so the event is handled after responding
+                task = asyncio.ensure_future(callback(username.lower()))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        return web.Response(status=204)
+
+    async def sync_subscriptions(self, usernames):
+        """
+        Subscribes to the events of the given users, and removes the subscriptions of this receiver to any others
+        :param usernames: The twitch usernames of the users
+        :return: The number of subscriptions created and deleted
+        """
+        users = await self.twitch_handler.get_users_data(usernames)
+        wanted = {(event_type, str(user.get("id"))) for user in users.values() for event_type in EVENTSUB_TYPES}
+
+        current = {}
+        stale = []
+        for subscription in await self.twitch_handler.get_eventsub_subscriptions():
+            if (subscription.get("transport") or {}).get("callback") != self.callback_url:
+                continue
+            key = (subscription.get("type"), str((subscription.get("condition") or {}).get("broadcaster_user_id")))
+            if key in wanted and key not in current and subscription.get("status") in EVENTSUB_ACTIVE_STATUSES:
+                current[key] = subscription.get("id")
+            else:
+                stale.append(subscription.get("id"))
+
+        semaphore = asyncio.Semaphore(self.twitch_handler.streams_concurrency)
+
+        async def create(key):
+            async with semaphore:
+                try:
+                    subscription = await self.twitch_handler.create_eventsub_subscription(
+                        key[0], key[1], self.callback_url, self.secret)
+                except TwitchAPIError as err:
+                    logging.error(f"TwitchAlert: {err}")
+                    subscription = None
+            if subscription is not None:
+                current[key] = subscription.get("id")
+                return True
+            logging.warning(f"TwitchAlert: Failed to subscribe to {key[0]} of {key[1]}")
+            return False
+
+        async def delete(subscription_id):
+            async with semaphore:
+                await self.twitch_handler.delete_eventsub_subscription(subscription_id)
+
+        results = await asyncio.gather(*[create(key) for key in wanted if key not in current],
+                                       *[delete(subscription_id) for subscription_id in stale])
+        self.subscriptions = current
+        return sum(1 for result in results if result), len(stale)
+
 
 class TwitchAlertDBManager:
     """
@@ -767,6 +1821,16 @@ class TwitchAlertDBManager:
         self.database_manager = database_manager
         self.twitch_handler = TwitchAPIHandler(TWITCH_CLIENT_ID, TWITCH_SECRET)
         self.bot = bot_client
+        self.subscriptions_version = 0
+        self.team_sync_stats = {"runs": 0, "teams": 0, "failed": 0, "added": 0, "removed": 0,
+                                "last_duration": 0.0, "max_duration": 0.0}
+
+    def subscriptions_changed(self):
+        """
+        Records that the alerts in the database have changed, so the live loops reload them
+        :return:
+        """
+        self.subscriptions_version += 1
 
     def get_parent_database_manager(self):
         """
@@ -835,10 +1899,11 @@ class TwitchAlertDBManager:
         );"""
 
         # Create Tables
-        self.database_manager.db_execute_commit(sql_create_twitch_alerts_table)
-        self.database_manager.db_execute_commit(sql_create_user_in_twitch_alert_table)
-        self.database_manager.db_execute_commit(sql_create_team_in_twitch_alert_table)
-        self.database_manager.db_execute_commit(sql_create_user_in_twitch_team_table)
+        self.database_manager.register_schema("TwitchAlert", [sql_create_twitch_alerts_table,
+                                                              sql_create_user_in_twitch_alert_table,
+                                                              sql_create_team_in_twitch_alert_table,
+                                                              sql_create_user_in_twitch_team_table], MIGRATIONS)
+        self.database_manager.bootstrap()
 
     def new_ta(self, guild_id, channel_id, default_message=None, replace=False):
         """
@@ -870,6 +1935,7 @@ class TwitchAlertDBManager:
             VALUES(?,?,?)
             """
         self.database_manager.db_execute_commit(sql_insert_twitch_alert, args=[guild_id, channel_id, default_message])
+        self.subscriptions_changed()
         return default_message
 
     def get_default_message(self, channel_id):
@@ -908,6 +1974,7 @@ class TwitchAlertDBManager:
             """
             self.database_manager.db_execute_commit(
                 sql_insert_user_twitch_alert, args=[channel_id, str.lower(twitch_username)])
+        self.subscriptions_changed()
 
     async def remove_user_from_ta(self, channel_id, twitch_username):
         """
@@ -920,13 +1987,14 @@ class TwitchAlertDBManager:
                              "FROM UserInTwitchAlert " \
                              "WHERE twitch_username = ? " \
                              "AND channel_id = ? "
-        message_id = self.database_manager.db_execute_select(sql_get_message_id,
-                                                             args=[twitch_username, channel_id])[0][0]
+        message_id = (await self.database_manager.select(sql_get_message_id,
+                                                         args=[twitch_username, channel_id]))[0][0]
         if message_id is not None:
             await self.delete_message(message_id, channel_id)
         sql_remove_entry = """DELETE FROM UserInTwitchAlert 
                                WHERE twitch_username = ? AND channel_id = ?"""
-        self.database_manager.db_execute_commit(sql_remove_entry, args=[twitch_username, channel_id])
+        await self.database_manager.commit(sql_remove_entry, args=[twitch_username, channel_id])
+        self.subscriptions_changed()
 
     async def delete_message(self, message_id, channel_id):
         """
@@ -940,7 +2008,8 @@ class TwitchAlertDBManager:
             if channel is None:
                 logging.warning(f"TwitchAlert: Channel ID {channel_id} does not exist, removing from database")
                 sql_remove_invalid_channel = "DELETE FROM TwitchAlerts WHERE channel_id = ?"
-                self.database_manager.db_execute_commit(sql_remove_invalid_channel, args=[channel_id])
+                await self.database_manager.commit(sql_remove_invalid_channel, args=[channel_id])
+                self.subscriptions_changed()
                 return
             message = await channel.fetch_message(message_id)
             await message.delete()
@@ -949,7 +2018,8 @@ class TwitchAlertDBManager:
         except discord.errors.Forbidden as err:
             logging.warning(f"TwitchAlert: {err}  Channel ID: {channel_id}")
             sql_remove_invalid_channel = "DELETE FROM TwitchAlerts WHERE channel_id = ?"
-            self.database_manager.db_execute_commit(sql_remove_invalid_channel, args=[channel_id])
+            await self.database_manager.commit(sql_remove_invalid_channel, args=[channel_id])
+            self.subscriptions_changed()
 
     def get_users_in_ta(self, channel_id):
         """
@@ -996,6 +2066,7 @@ class TwitchAlertDBManager:
             """
             self.database_manager.db_execute_commit(
                 sql_insert_team_twitch_alert, args=[channel_id, str.lower(twitch_team)])
+        self.subscriptions_changed()
 
     async def remove_team_from_ta(self, channel_id, team_name):
         """
@@ -1008,90 +2079,239 @@ class TwitchAlertDBManager:
                                 "FROM TeamInTwitchAlert " \
                                 "WHERE twitch_team_name = ? " \
                                 " AND channel_id = ?"
-        result = self.database_manager.db_execute_select(sql_get_team_alert_id, args=[team_name, channel_id])
+        result = await self.database_manager.select(sql_get_team_alert_id, args=[team_name, channel_id])
         if not result:
             raise AttributeError("Team name not found")
         team_alert_id = result[0][0]
         sql_get_message_id = """SELECT UserInTwitchTeam.message_id
                                  FROM UserInTwitchTeam
                                  WHERE team_twitch_alert_id = ?"""
-        message_ids = self.database_manager.db_execute_select(sql_get_message_id, args=[team_alert_id])
+        message_ids = await self.database_manager.select(sql_get_message_id, args=[team_alert_id])
         if message_ids is not None:
             for message_id in message_ids:
                 if message_id[0] is not None:
                     await self.delete_message(message_id[0], channel_id)
+        await self.database_manager.run(self.remove_team_rows, team_alert_id)
+
+    def remove_team_rows(self, team_alert_id):
+        """
+        Removes a team twitch alert and its members from the database in a single transaction
+        :param team_alert_id: the team twitch alert id
+        :return:
+        """
         sql_remove_users = """DELETE FROM UserInTwitchTeam WHERE team_twitch_alert_id = ?"""
         sql_remove_team = """DELETE FROM TeamInTwitchAlert WHERE team_twitch_alert_id = ?"""
-        self.database_manager.db_execute_commit(sql_remove_users, args=[team_alert_id])
-        self.database_manager.db_execute_commit(sql_remove_team, args=[team_alert_id])
+        with self.database_manager.transaction():
+            self.database_manager.db_execute_commit(sql_remove_users, args=[team_alert_id])
+            self.database_manager.db_execute_commit(sql_remove_team, args=[team_alert_id])
+        self.subscriptions_changed()
 
     async def update_team_members(self, twitch_team_id, team_name):
         """
         Users in a team are updated to ensure they are assigned to the correct team
         :param twitch_team_id: the team twitch alert id
         :param team_name: the name of the team
-        :return:
+        :return: The number of members added and removed
         """
         if re.search(TWITCH_USERNAME_REGEX, team_name):
+            sql_get_members = "SELECT twitch_username, message_id FROM UserInTwitchTeam WHERE team_twitch_alert_id = ?"
+            members = await self.database_manager.select(sql_get_members, args=[twitch_team_id])
             users = await self.twitch_handler.get_team_users(team_name)
-            for user in users:
-                sql_add_user = """INSERT OR IGNORE INTO UserInTwitchTeam(team_twitch_alert_id, twitch_username) 
-                                   VALUES(?, ?)"""
-                try:
-                    self.database_manager.db_execute_commit(sql_add_user, args=[twitch_team_id, user.get("user_login")],
-                                                            pass_errors=True)
-                except KoalaDBManager.sqlite3.IntegrityError as err:
-                    logging.error(f"Twitch Alert: 1034: {err}")
-                    pass
+            return await self.sync_team_members(twitch_team_id, users, members or [])
+        return 0, 0
 
-    async def update_all_teams_members(self):
+    async def sync_team_members(self, twitch_team_id, users, members):
         """
-        Updates all teams with the current team members
+        Diffs the roster of a team against its stored members, adding new members and removing those who have left
+        the team in a single transaction. The alerts of removed members are deleted first
+        :param twitch_team_id: the team twitch alert id
+        :param users: The JSON information of the users in the team
+        :param members: The stored twitch_username and message_id of each member of the team
+        :return: The number of members added and removed
+        """
+        roster = {str.lower(user.get("user_login")) for user in users if user.get("user_login")}
+        stored = {username for username, _ in members}
+        added = sorted(roster - stored)
+        removed = [(username, message_id) for username, message_id in members if username not in roster]
+        if not added and not removed:
+            return 0, 0
+
+        channel_id = None
+        for _, message_id in removed:
+            if message_id is not None:
+                if channel_id is None:
+                    sql_get_channel = "SELECT channel_id FROM TeamInTwitchAlert WHERE team_twitch_alert_id = ?"
+                    channel_id = (await self.database_manager.select(sql_get_channel, args=[twitch_team_id]))[0][0]
+                await self.delete_message(message_id, channel_id)
+        await self.database_manager.run(self.apply_team_changes, twitch_team_id, added,
+                                        [username for username, _ in removed])
+        self.subscriptions_changed()
+        return len(added), len(removed)
+
+    def apply_team_changes(self, twitch_team_id, added, removed):
+        """
+        Adds and removes members of a team in a single transaction
+        :param twitch_team_id: the team twitch alert id
+        :param added: The twitch usernames of the new members
+        :param removed: The twitch usernames of the members who have left
         :return:
         """
+        sql_add_user = """INSERT OR IGNORE INTO UserInTwitchTeam(team_twitch_alert_id, twitch_username) 
+                           VALUES(?, ?)"""
+        sql_remove_user = "DELETE FROM UserInTwitchTeam WHERE team_twitch_alert_id = ? AND twitch_username = ?"
+        with self.database_manager.transaction():
+            self.database_manager.db_execute_many(sql_add_user, [(twitch_team_id, username) for username in added])
+            self.database_manager.db_execute_many(sql_remove_user,
+                                                  [(twitch_team_id, username) for username in removed])
+
+    async def update_all_teams_members(self):
+        """
+        Updates all teams with the current team members. The rosters are fetched concurrently, once per team name,
+        and a team whose roster can't be fetched is left as it is
+        :return: The number of members added and removed
+        """
+        start = time.perf_counter()
         sql_get_teams = """SELECT team_twitch_alert_id, twitch_team_name FROM TeamInTwitchAlert"""
-        teams_info = self.database_manager.db_execute_select(sql_get_teams)
-        for team_info in teams_info:
-            await self.update_team_members(team_info[0], team_info[1])
+        teams_info = await self.database_manager.select(sql_get_teams)
+        sql_get_members = "SELECT team_twitch_alert_id, twitch_username, message_id FROM UserInTwitchTeam"
+        members_info = await self.database_manager.select(sql_get_members)
+        if teams_info is None or members_info is None:
+            return 0, 0
+        members = {}
+        for team_id, username, message_id in members_info:
+            members.setdefault(str(team_id), []).append((username, message_id))
+
+        semaphore = asyncio.Semaphore(self.twitch_handler.streams_concurrency)
+
+        async def get_roster(team_name):
+            async with semaphore:
+                try:
+                    return team_name, await self.twitch_handler.get_team_users(team_name)
+                except Exception as err:
+                    logging.error(f"TwitchAlert: Failed to get members of team {team_name} {err}")
+                    return team_name, None
+
+        team_names = dict.fromkeys(team_name for _, team_name in teams_info
+                                   if re.search(TWITCH_USERNAME_REGEX, team_name))
+        rosters = dict(await asyncio.gather(*[get_roster(team_name) for team_name in team_names]))
+
+        added = removed = failed = 0
+        for team_id, team_name in teams_info:
+            users = rosters.get(team_name)
+            if users is None:
+                failed += int(team_name in rosters)
+                continue
+            try:
+                team_added, team_removed = await self.sync_team_members(team_id, users, members.get(str(team_id), []))
+            except Exception as err:
+                logging.error(f"TwitchAlert: Failed to update members of team {team_name} {err}")
+                failed += 1
+                continue
+            added += team_added
+            removed += team_removed
+
+        duration = time.perf_counter() - start
+        stats = self.team_sync_stats
+        stats["runs"] += 1
+        stats["teams"] = len(teams_info)
+        stats["failed"] += failed
+        stats["added"] += added
+        stats["removed"] += removed
+        stats["last_duration"] = duration
+        stats["max_duration"] = max(stats["max_duration"], duration)
+        return added, removed
+
+    async def delete_messages(self, message_ids, channel_id):
+        """
+        Deletes the given discord messages of a channel, in bulk where the bot can manage messages and the messages
+        are recent enough, and one at a time otherwise
+        :param message_ids: discord message IDs of the messages to delete
+        :param channel_id: discord channel ID which has the messages
+        :return:
+        """
+        channel = self.bot.get_channel(int(channel_id))
+        if channel is None:
+            await self.delete_message(message_ids[0], channel_id)
+            return
+
+        single_ids = list(message_ids)
+        guild = getattr(channel, "guild", None)
+        if guild is not None and channel.permissions_for(guild.me).manage_messages:
+            cutoff = int((time.time() - BULK_DELETE_MAX_AGE) * 1000 - discord.utils.DISCORD_EPOCH) << 22
+            recent_ids = [message_id for message_id in message_ids if message_id > cutoff]
+            single_ids = [message_id for message_id in message_ids if message_id <= cutoff]
+            for i in range(0, len(recent_ids), BULK_DELETE_SIZE):
+                batch = recent_ids[i:i + BULK_DELETE_SIZE]
+                if len(batch) < 2:
+                    single_ids += batch
+                    continue
+                try:
+                    await channel.delete_messages([discord.Object(id=message_id) for message_id in batch])
+                except discord.errors.HTTPException as err:
+                    logging.warning(f"TwitchAlert: Bulk delete failed in {channel_id}, deleting one at a time {err}")
+                    single_ids += batch
+
+        for message_id in single_ids:
+            await self.delete_message(message_id, channel_id)
 
     async def delete_all_offline_streams(self, team: bool, usernames):
         """
-        A method that deletes all currently offline streams
+        A method that deletes all currently offline streams. The usernames are queried in chunks below SQLite's
+        parameter limit, and the messages are deleted per channel, with up to CLEANUP_CONCURRENCY channels at once
         :param team: True if the users are from teams, false if individuals
         :param usernames: The usernames of the team members
         :return:
         """
-        if team:
-            sql_select_offline_streams_with_message_ids = f"""
-            SELECT channel_id, message_id
-            FROM UserInTwitchTeam
-            JOIN TeamInTwitchAlert TITA on UserInTwitchTeam.team_twitch_alert_id = TITA.team_twitch_alert_id
-            WHERE message_id NOT NULL
-            AND twitch_username in ({','.join(['?'] * len(usernames))})"""
-
-            sql_update_offline_streams = f"""
-            UPDATE UserInTwitchTeam
-            SET message_id = NULL
-            WHERE twitch_username in ({','.join(['?'] * len(usernames))})"""
-
-        else:
-            sql_select_offline_streams_with_message_ids = f"""
-            SELECT channel_id, message_id
-            FROM UserInTwitchAlert
-            WHERE message_id NOT NULL
-            AND twitch_username in ({','.join(['?'] * len(usernames))})"""
-
-            sql_update_offline_streams = f"""
-            UPDATE UserInTwitchAlert
-            SET message_id = NULL
-            WHERE twitch_username in ({','.join(['?'] * len(usernames))})"""
+        usernames = list(dict.fromkeys(usernames))
+        chunks = [usernames[i:i + SQL_CHUNK_SIZE] for i in range(0, len(usernames), SQL_CHUNK_SIZE)]
+        messages = {}
+        for chunk in chunks:
+            if team:
+                sql_select_offline_streams_with_message_ids = f"""
+                SELECT {AlertMessageRow.columns}
+                FROM UserInTwitchTeam
+                JOIN TeamInTwitchAlert TITA on UserInTwitchTeam.team_twitch_alert_id = TITA.team_twitch_alert_id
+                WHERE message_id NOT NULL
+                AND twitch_username in ({','.join(['?'] * len(chunk))})"""
+            else:
+                sql_select_offline_streams_with_message_ids = f"""
+                SELECT {AlertMessageRow.columns}
+                FROM UserInTwitchAlert
+                WHERE message_id NOT NULL
+                AND twitch_username in ({','.join(['?'] * len(chunk))})"""
+            results = await self.database_manager.select(sql_select_offline_streams_with_message_ids, chunk,
+                                                         row=AlertMessageRow)
+            for result in results or []:
+                messages.setdefault(result.channel_id, []).append(result.message_id)
+
+        semaphore = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+
+        async def clean_channel(channel_id, message_ids):
+            async with semaphore:
+                try:
+                    await self.delete_messages(message_ids, channel_id)
+                except Exception as err:
+                    logging.error(f"TwitchAlert: Failed to delete offline alerts in {channel_id} {err}")
 
-        results = self.database_manager.db_execute_select(
-            sql_select_offline_streams_with_message_ids, usernames)
+        await asyncio.gather(*[clean_channel(channel_id, message_ids) for channel_id, message_ids in messages.items()])
+        await self.database_manager.run(self.clear_offline_message_ids, team, chunks)
+        self.subscriptions_changed()
 
-        for result in results:
-            await self.delete_message(result[1], result[0])
-        self.database_manager.db_execute_commit(sql_update_offline_streams, usernames)
+    def clear_offline_message_ids(self, team, chunks):
+        """
+        Clears the message IDs of offline streams in a single transaction
+        :param team: True if the users are from teams, false if individuals
+        :param chunks: Lists of the usernames, each below SQLite's parameter limit
+        :return:
+        """
+        table = "UserInTwitchTeam" if team else "UserInTwitchAlert"
+        with self.database_manager.transaction():
+            for chunk in chunks:
+                sql_update_offline_streams = f"""
+                UPDATE {table}
+                SET message_id = NULL
+                WHERE twitch_username in ({','.join(['?'] * len(chunk))})"""
+                self.database_manager.db_execute_commit(sql_update_offline_streams, chunk)
 
 
 def setup(bot: KoalaBot) -> None:
@@ -1102,7 +2322,8 @@ def setup(bot: KoalaBot) -> None:
     if TWITCH_SECRET is None or TWITCH_CLIENT_ID is None:
         logging.error("TwitchAlert not started. API keys not found in environment.")
         print("TwitchAlert not started. API keys not found in environment.")
-        KoalaBot.database_manager.insert_extension("TwitchAlert", 0, False, False)
+        KoalaBot.database_manager.register_extension("TwitchAlert", 0, False, False)
+        KoalaBot.database_manager.bootstrap()
     else:
         bot.add_cog(TwitchAlert(bot))
         logging.info("TwitchAlert is ready.")
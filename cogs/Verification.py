@@ -52,8 +52,8 @@ class Verification(commands.Cog, name="Verify"):
         self.bot = bot
         if not db_manager:
             self.DBManager = KoalaBot.database_manager
+            self.DBManager.register_extension("Verify", 0, True, True)
             self.set_up_tables()
-            self.DBManager.insert_extension("Verify", 0, True, True)
         else:
             self.DBManager = db_manager
 
@@ -97,10 +97,8 @@ class Verification(commands.Cog, name="Verify"):
         );
         """
 
-        self.DBManager.db_execute_commit(verified_table)
-        self.DBManager.db_execute_commit(non_verified_table)
-        self.DBManager.db_execute_commit(role_table)
-        self.DBManager.db_execute_commit(re_verify_table)
+        self.DBManager.register_schema("Verify", [verified_table, non_verified_table, role_table, re_verify_table])
+        self.DBManager.bootstrap()
 
     @staticmethod
     def send_email(email, token):
@@ -442,7 +440,8 @@ def setup(bot: KoalaBot) -> None:
     """
     if GMAIL_EMAIL is None or GMAIL_PASSWORD is None:
         print("Verification not started. API keys not found in environment.")
-        KoalaBot.database_manager.insert_extension("Verify", 0, False, False)
+        KoalaBot.database_manager.register_extension("Verify", 0, False, False)
+        KoalaBot.database_manager.bootstrap()
     else:
         bot.add_cog(Verification(bot))
         print("Verification is ready.")
@@ -18,11 +18,20 @@ import parsedatetime.parsedatetime
 
 # Own modules
 import KoalaBot
+from utils.KoalaDBManager import row_type
 
 # Constants
 load_dotenv()
 MIN_ID_VALUE = 100000000000000000
 MAX_ID_VALUE = 999999999999999999
+# Schema migrations, applied in order after the tables are created
+MIGRATIONS = [
+    ["CREATE INDEX IF NOT EXISTS Votes_end_time ON Votes (end_time)"],
+]
+VoteRow = row_type("VoteRow", ["vote_id", "author_id", "guild_id", "title", "chair_id", "voice_id", "end_time"])
+EndedVoteRow = row_type("EndedVoteRow", ["vote_id", "title"])
+OptionRow = row_type("OptionRow", ["opt_id", "option_title", "option_desc"])
+SentRow = row_type("SentRow", ["vote_receiver_id", "vote_receiver_message"])
 
 # Variables
 
@@ -138,7 +147,7 @@ class Voting(commands.Cog, name="Vote"):
         self.bot = bot
         if not db_manager:
             self.DBManager = KoalaBot.database_manager
-            self.DBManager.insert_extension("Vote", 0, True, True)
+            self.DBManager.register_extension("Vote", 0, True, True)
         else:
             self.DBManager = db_manager
         self.vote_manager = VoteManager(self.DBManager)
@@ -158,8 +167,9 @@ class Voting(commands.Cog, name="Vote"):
     @tasks.loop(seconds=30.0)
     async def vote_end_loop(self):
         now = time.time()
-        votes = self.DBManager.db_execute_select("SELECT * FROM Votes WHERE end_time < ?", (now,))
-        for v_id, a_id, g_id, title, _, _, end_time in votes:
+        votes = await self.DBManager.select(f"SELECT {EndedVoteRow.columns} FROM Votes WHERE end_time < ?", (now,),
+                                            row=EndedVoteRow)
+        for v_id, title in votes:
             if v_id in self.vote_manager.sent_votes.keys():
                 vote = self.vote_manager.get_vote_from_id(v_id)
                 results = await get_results(self.bot, vote)
@@ -184,10 +194,12 @@ class Voting(commands.Cog, name="Vote"):
                             user = await self.bot.fetch_user(guild.owner_id)
                             await user.send(f"A vote in your guild titled {title} has closed and the chair is unavailable.")
                             await user.send(embed=embed)
-                    self.DBManager.db_execute_commit("DELETE FROM Votes WHERE vote_id=?", (vote.id,))
-                    self.vote_manager.cancel_sent_vote(vote.id)
+                    await self.DBManager.commit("DELETE FROM Votes WHERE vote_id=?", (vote.id,))
+                    # The in-memory votes are only changed on the event loop, the database thread just deletes
+                    self.vote_manager.remove_sent_vote(vote.id)
+                    await self.DBManager.run(self.vote_manager.delete_vote, vote.id)
                 except Exception as e:
-                    self.DBManager.db_execute_commit("UPDATE Votes SET end_time=? WHERE vote_id=?", (time.time() + 86400, vote.id))
+                    await self.DBManager.commit("UPDATE Votes SET end_time=? WHERE vote_id=?", (time.time() + 86400, vote.id))
                     logging.error(f"error in vote loop: {e}")
 
     @vote_end_loop.before_loop
@@ -403,9 +415,9 @@ class Voting(commands.Cog, name="Vote"):
         :return:
         """
         embed = discord.Embed(title="Your current votes")
-        votes = self.DBManager.db_execute_select("SELECT * FROM Votes WHERE author_id=? AND guild_id=?", (ctx.author.id, ctx.guild.id))
+        votes = self.DBManager.db_execute_select("SELECT title FROM Votes WHERE author_id=? AND guild_id=?", (ctx.author.id, ctx.guild.id))
         body_string = ""
-        for _, _, _, title, _, _, _ in votes:
+        for title, in votes:
             body_string += f"{title}\n"
         embed.add_field(name="Vote Title", value=body_string, inline=False)
         await ctx.send(embed=embed)
@@ -439,11 +451,12 @@ class Voting(commands.Cog, name="Vote"):
         for user in users:
             try:
                 msg = await user.send(f"You have been asked to participate in this vote from {ctx.guild.name}.\nPlease react to make your choice (You can change your mind until the vote is closed)", embed=create_embed(vote))
-                vote.register_sent(user.id, msg.id)
+                vote.register_sent(user.id, msg.id, save=False)
                 await add_reactions(vote, msg)
             except discord.Forbidden:
                 logging.error(f"tried to send vote to user {user.id} but direct messages are turned off.")
                 pass
+        await self.DBManager.run(vote.save_sent)
         await ctx.send(f"Sent vote to {len(users)} users")
 
     @commands.check(vote_is_enabled)
@@ -587,9 +600,8 @@ class VoteManager:
                               6: "7️⃣", 7: "8️⃣", 8: "9️⃣", 9: "🔟"})
 
     def generate_unique_opt_id(self):
-        used_ids = self.DBManager.db_execute_select("SELECT * FROM VoteOptions")
-        used_ids = [x[1] for x in used_ids]
-        return self.gen_id(len(used_ids) > (MAX_ID_VALUE - MIN_ID_VALUE))
+        used_ids = self.DBManager.db_execute_select("SELECT COUNT(*) FROM VoteOptions")[0][0]
+        return self.gen_id(used_ids > (MAX_ID_VALUE - MIN_ID_VALUE))
 
     def gen_vote_id(self):
         return self.gen_id(len(self.configuring_votes.keys()) == (MAX_ID_VALUE - MIN_ID_VALUE))
@@ -636,34 +648,35 @@ class VoteManager:
         vote_receiver_message integer NOT NULL
         )"""
 
-        self.DBManager.db_execute_commit(vote_table)
-        self.DBManager.db_execute_commit(role_table)
-        self.DBManager.db_execute_commit(option_table)
-        self.DBManager.db_execute_commit(delivered_table)
+        self.DBManager.register_schema("Vote", [vote_table, role_table, option_table, delivered_table], MIGRATIONS)
+        self.DBManager.bootstrap()
 
     def load_from_db(self):
-        existing_votes = self.DBManager.db_execute_select("SELECT * FROM Votes")
+        existing_votes = self.DBManager.db_execute_select(f"SELECT {VoteRow.columns} FROM Votes", row=VoteRow)
         for v_id, a_id, g_id, title, chair_id, voice_id, end_time in existing_votes:
             vote = Vote(v_id, title, a_id, g_id, self.DBManager)
             vote.set_chair(chair_id)
             vote.set_vc(voice_id)
             self.vote_lookup[(a_id, title)] = v_id
 
-            target_roles = self.DBManager.db_execute_select("SELECT * FROM VoteTargetRoles WHERE vote_id=?", (v_id,))
+            target_roles = self.DBManager.db_execute_select("SELECT role_id FROM VoteTargetRoles WHERE vote_id=?",
+                                                            (v_id,))
             if target_roles:
-                for _, r_id in target_roles:
+                for r_id, in target_roles:
                     vote.add_role(r_id)
 
-            options = self.DBManager.db_execute_select("SELECT * FROM VoteOptions WHERE vote_id=?", (v_id,))
+            options = self.DBManager.db_execute_select(f"SELECT {OptionRow.columns} FROM VoteOptions WHERE vote_id=?",
+                                                       (v_id,), row=OptionRow)
             if options:
-                for _, o_id, o_title, o_desc in options:
-                    vote.add_option(Option(o_title, o_desc, opt_id=o_id))
+                for option in options:
+                    vote.add_option(Option(option.option_title, option.option_desc, opt_id=option.opt_id))
 
-            delivered = self.DBManager.db_execute_select("SELECT * FROM VoteSent WHERE vote_id=?", (v_id,))
+            delivered = self.DBManager.db_execute_select(f"SELECT {SentRow.columns} FROM VoteSent WHERE vote_id=?",
+                                                         (v_id,), row=SentRow)
             if delivered:
                 self.sent_votes[v_id] = vote
-                for _, rec_id, msg_id in delivered:
-                    vote.register_sent(rec_id, msg_id)
+                for sent in delivered:
+                    vote.register_sent(sent.vote_receiver_id, sent.vote_receiver_message, save=False)
             else:
                 self.configuring_votes[a_id] = vote
 
@@ -708,8 +721,18 @@ class VoteManager:
         :param v_id: the vote id
         :return: None
         """
+        vote = self.remove_sent_vote(v_id)
+        self.delete_vote(vote.id)
+
+    def remove_sent_vote(self, v_id):
+        """
+        Removes a vote from the active votes in memory, without touching the database
+        :param v_id: the vote id
+        :return: the removed Vote object
+        """
         vote = self.sent_votes.pop(v_id)
-        self.cancel_vote(vote)
+        self.vote_lookup.pop((vote.author, vote.title))
+        return vote
 
     def cancel_configuring_vote(self, author_id):
         vote = self.configuring_votes.pop(author_id)
@@ -717,10 +740,20 @@ class VoteManager:
 
     def cancel_vote(self, vote):
         self.vote_lookup.pop((vote.author, vote.title))
-        self.DBManager.db_execute_commit("DELETE FROM Votes WHERE vote_id=?", (vote.id,))
-        self.DBManager.db_execute_commit("DELETE FROM VoteTargetRoles WHERE vote_id=?", (vote.id,))
-        self.DBManager.db_execute_commit("DELETE FROM VoteOptions WHERE vote_id=?", (vote.id,))
-        self.DBManager.db_execute_commit("DELETE FROM VoteSent WHERE vote_id=?", (vote.id,))
+        self.delete_vote(vote.id)
+
+    def delete_vote(self, v_id):
+        """
+        Deletes a vote and everything attached to it from the database, all together or not at all
+        :param v_id: the vote id
+        :return: None
+        """
+        # Errors are passed on, so callers don't carry on as if the vote was cancelled
+        with self.DBManager.transaction():
+            self.DBManager.db_execute_commit("DELETE FROM Votes WHERE vote_id=?", (v_id,))
+            self.DBManager.db_execute_commit("DELETE FROM VoteTargetRoles WHERE vote_id=?", (v_id,))
+            self.DBManager.db_execute_commit("DELETE FROM VoteOptions WHERE vote_id=?", (v_id,))
+            self.DBManager.db_execute_commit("DELETE FROM VoteSent WHERE vote_id=?", (v_id,))
 
     def was_sent_to(self, msg_id):
         """
@@ -843,17 +876,29 @@ class Vote:
         opt = self.options.pop(index-1)
         self.DBManager.db_execute_commit("DELETE FROM VoteOptions WHERE vote_id=? AND opt_id=?", (self.id, opt.id))
 
-    def register_sent(self, user_id, msg_id):
+    def register_sent(self, user_id, msg_id, save=True):
         """
         Marks a user as having been sent a message to vote on
         :param user_id: user who was sent the message
         :param msg_id: the id of the message that was sent
+        :param save: False to only mark it in memory, to be written later in one batch with save_sent
         :return:
         """
         self.sent_to[user_id] = msg_id
-        in_db = self.DBManager.db_execute_select("SELECT * FROM VoteSent WHERE vote_receiver_message=?", (msg_id,))
-        if not in_db:
-            self.DBManager.db_execute_commit("INSERT INTO VoteSent VALUES (?, ?, ?)", (self.id, user_id, msg_id))
+        if save:
+            self.save_sent({user_id: msg_id})
+
+    def save_sent(self, sent_to=None):
+        """
+        Writes the sent messages that aren't already in the database in a single transaction
+        :param sent_to: dict of user id to message id to save, defaults to every message sent for this vote
+        :return:
+        """
+        if sent_to is None:
+            sent_to = self.sent_to
+        self.DBManager.db_execute_many("INSERT INTO VoteSent SELECT ?, ?, ? WHERE NOT EXISTS "
+                                       "(SELECT 1 FROM VoteSent WHERE vote_receiver_message=?)",
+                                       [(self.id, user_id, msg_id, msg_id) for user_id, msg_id in sent_to.items()])
 
 
 def setup(bot: KoalaBot) -> None:
@@ -195,3 +195,14 @@ async def test_setup():
     with mock.patch.object(discord.ext.commands.bot.Bot, 'add_cog') as mock1:
         BaseCog.setup(KoalaBot.client)
     mock1.assert_called()
+
+
+def test_db_stats_embed():
+    report = {"queries": [{"fingerprint": "SELECT * FROM GuildExtensions WHERE guild_id = ?", "calls": 2, "errors": 0,
+                           "rows": 4, "total_time": 0.002, "max_time": 0.0015, "p50": 0.0005, "p99": 0.0015}],
+              "slow_queries": []}
+    embed = BaseCog.db_stats_embed(report)
+    assert embed.title == "Database query statistics"
+    assert embed.fields[0].name == "SELECT * FROM GuildExtensions WHERE guild_id = ?"
+    assert embed.fields[0].value.startswith("2 calls, 0 errors, 4 rows")
+    assert embed.footer.text == "1 statements, 0 recent slow queries"
@@ -0,0 +1,614 @@
+#!/usr/bin/env python
+
+"""
+Testing KoalaBot KoalaDBManager
+
+Commented using reStructuredText (reST)
+"""
+# Futures
+
+# Built-in/Generic Imports
+import asyncio
+import os
+import threading
+import time
+
+# Libs
+import pytest
+
+# Own modules
+import KoalaBot
+from cogs import ReactForRole, TextFilter, TwitchAlert, Verification, Voting
+from utils import KoalaDBManager
+
+# Constants
+DB_PATH = "KoalaDBManagerTest.db"
+
+# Variables
+
+
+def setup_module():
+    try:
+        if os.name == 'nt' or not KoalaDBManager.ENCRYPTED_DB:
+            os.remove("windows_" + DB_PATH)
+        else:
+            os.remove(DB_PATH)
+    except FileNotFoundError:
+        print("Database Doesn't Exist, Continuing")
+
+
+@pytest.fixture
+def db_manager():
+    db_manager = KoalaDBManager.KoalaDBManager(DB_PATH, KoalaBot.DB_KEY)
+    db_manager.db_execute_commit("CREATE TABLE IF NOT EXISTS PoolTest (id integer NOT NULL PRIMARY KEY, value text)")
+    db_manager.db_execute_commit("DELETE FROM PoolTest")
+    yield db_manager
+    db_manager.close()
+
+
+def test_pool_reuses_connection(db_manager):
+    db_manager.db_execute_select("SELECT * FROM PoolTest")
+    with db_manager.pool.connection() as first:
+        pass
+    with db_manager.pool.connection() as second:
+        pass
+    assert first is second
+    assert db_manager.pool.idle_count() == 1
+
+
+def test_pooled_commit_visible_to_select(db_manager):
+    db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    assert db_manager.db_execute_select("SELECT value FROM PoolTest WHERE id = ?", args=[1]) == [("koala",)]
+
+
+def test_failed_commit_is_rolled_back(db_manager):
+    db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    with pytest.raises(KoalaDBManager.sqlite3.IntegrityError):
+        db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"], pass_errors=True)
+    with db_manager.pool.connection() as conn:
+        assert not conn.in_transaction
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(1,)]
+
+
+def test_pool_is_bounded():
+    pool = KoalaDBManager.ConnectionPool(lambda: KoalaDBManager.sqlite3.connect(":memory:"), max_size=2, timeout=0.1)
+    first = pool.acquire()
+    second = pool.acquire()
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+    pool.release(second)
+    pool.close()
+
+
+def test_pool_waits_for_release():
+    pool = KoalaDBManager.ConnectionPool(lambda: KoalaDBManager.sqlite3.connect(":memory:", check_same_thread=False),
+                                         max_size=1, timeout=5)
+    conn = pool.acquire()
+    threading.Timer(0.1, pool.release, args=[conn]).start()
+    assert pool.acquire() is conn
+    pool.release(conn)
+    pool.close()
+
+
+def test_pool_discards_unhealthy_connection():
+    pool = KoalaDBManager.ConnectionPool(lambda: KoalaDBManager.sqlite3.connect(":memory:"), health_check_interval=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.close()
+    new_conn = pool.acquire()
+    assert new_conn is not conn
+    assert pool.is_healthy(new_conn)
+    pool.release(new_conn)
+    pool.close()
+
+
+def test_close_closes_connections(db_manager):
+    with db_manager.pool.connection() as conn:
+        pass
+    db_manager.close()
+    assert not db_manager.pool.is_healthy(conn)
+    with pytest.raises(KoalaDBManager.sqlite3.ProgrammingError):
+        db_manager.db_execute_select("SELECT * FROM PoolTest", pass_errors=True)
+
+
+@pytest.mark.asyncio
+async def test_async_commit_and_select(db_manager):
+    await db_manager.commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    assert await db_manager.select("SELECT value FROM PoolTest WHERE id = ?", args=[1]) == [("koala",)]
+
+
+@pytest.mark.asyncio
+async def test_async_run_uses_database_thread(db_manager):
+    thread_name = await db_manager.run(lambda: threading.current_thread().name)
+    assert thread_name.startswith(KoalaDBManager.DB_THREAD_NAME)
+    assert thread_name != threading.current_thread().name
+
+
+@pytest.mark.asyncio
+async def test_async_does_not_block_event_loop(db_manager):
+    ticks = []
+
+    async def ticker():
+        for _ in range(5):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(db_manager.run(time.sleep, 0.2), ticker())
+    assert len(ticks) == 5
+    assert ticks[-1] - ticks[0] < 0.2
+
+
+@pytest.mark.asyncio
+async def test_async_pass_errors(db_manager):
+    await db_manager.commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    with pytest.raises(KoalaDBManager.sqlite3.IntegrityError):
+        await db_manager.commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"], pass_errors=True)
+
+
+@pytest.mark.asyncio
+async def test_queue_stats(db_manager):
+    await asyncio.gather(*[db_manager.run(time.sleep, 0.05) for _ in range(4)])
+    stats = db_manager.queue_stats()
+    assert stats["queue_depth"] == 0
+    assert stats["jobs"] == 4
+    assert stats["max_wait"] >= 0.1
+    assert 0 < stats["mean_wait"] <= stats["max_wait"]
+
+
+
+@pytest.mark.asyncio
+async def test_queue_stats_cancelled_job(db_manager):
+    blocker = asyncio.ensure_future(db_manager.run(time.sleep, 0.1))
+    queued = asyncio.ensure_future(db_manager.run(time.sleep, 0.1))
+    await asyncio.sleep(0.02)
+    assert db_manager.queue_stats()["queue_depth"] == 1
+    queued.cancel()
+    await blocker
+    with pytest.raises(asyncio.CancelledError):
+        await queued
+    assert db_manager.queue_stats()["queue_depth"] == 0
+    assert db_manager.queue_stats()["jobs"] == 1
+
+def test_transaction_commits_together(db_manager):
+    with db_manager.transaction():
+        db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+        db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[2, "bear"])
+        assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(2,)]
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(2,)]
+
+
+def test_transaction_rolls_back_on_error(db_manager):
+    with pytest.raises(KoalaDBManager.sqlite3.IntegrityError):
+        with db_manager.transaction():
+            db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+            db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    assert not db_manager.in_transaction()
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(0,)]
+
+
+def test_nested_transaction_joins_outer(db_manager):
+    with pytest.raises(ValueError):
+        with db_manager.transaction() as outer:
+            with db_manager.transaction() as inner:
+                assert inner is outer
+                db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+            raise ValueError
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(0,)]
+
+
+def test_execute_many(db_manager):
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(i, str(i)) for i in range(100)])
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(100,)]
+
+
+def test_execute_many_is_atomic(db_manager):
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(1, "koala"), (2, "bear"), (1, "koala")])
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(0,)]
+    with pytest.raises(KoalaDBManager.sqlite3.IntegrityError):
+        db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(1, "koala"), (1, "koala")],
+                                   pass_errors=True)
+
+
+@pytest.mark.asyncio
+async def test_async_execute_many(db_manager):
+    await db_manager.execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(i, str(i)) for i in range(10)])
+    assert await db_manager.select("SELECT COUNT(*) FROM PoolTest") == [(10,)]
+
+
+def test_engine_profile_applied(db_manager):
+    with db_manager.pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] == KoalaDBManager.DEFAULT_ENGINE_PROFILE["cache_size"]
+
+
+def test_empty_engine_profile():
+    db_manager = KoalaDBManager.KoalaDBManager("KoalaDBManagerProfileTest.db", KoalaBot.DB_KEY, engine_profile={})
+    with db_manager.pool.connection() as conn:
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert db_manager._checkpoint_thread is None
+    db_manager.close()
+    os.remove(db_manager.db_file_path)
+
+
+def test_checkpoint_when_idle():
+    db_manager = KoalaDBManager.KoalaDBManager("KoalaDBManagerCheckpointTest.db", KoalaBot.DB_KEY,
+                                               checkpoint_interval=0.05, checkpoint_idle_time=0.1)
+    db_manager.db_execute_commit("CREATE TABLE IF NOT EXISTS CheckpointTest (id integer)")
+    db_manager.db_execute_commit("INSERT INTO CheckpointTest VALUES (1)")
+    assert not db_manager.is_idle()
+    time.sleep(0.5)
+    assert db_manager._last_checkpoint is not None
+    assert not db_manager.is_idle()
+    assert db_manager.checkpoint("TRUNCATE") == (0, 0, 0)
+    db_manager.close()
+    assert db_manager._checkpoint_thread is None
+    os.remove(db_manager.db_file_path)
+
+
+MIGRATIONS = [
+    ["CREATE TABLE IF NOT EXISTS MigrationTest (id integer NOT NULL PRIMARY KEY)"],
+    ["ALTER TABLE MigrationTest ADD COLUMN value text",
+     "CREATE INDEX IF NOT EXISTS MigrationTest_value ON MigrationTest (value)"],
+]
+
+
+def test_migrate_applies_in_order(db_manager):
+    db_manager.db_execute_commit("DROP TABLE IF EXISTS MigrationTest")
+    db_manager.db_execute_commit("DELETE FROM schema_version WHERE component = ?", args=["MigrationTest"])
+    assert db_manager.get_schema_version("MigrationTest") == 0
+    assert db_manager.migrate("MigrationTest", MIGRATIONS[:1]) == 1
+    assert db_manager.migrate("MigrationTest", MIGRATIONS) == 2
+    assert db_manager.get_schema_version("MigrationTest") == 2
+    db_manager.db_execute_commit("INSERT INTO MigrationTest VALUES (?, ?)", args=[1, "koala"])
+
+
+def test_migrate_is_idempotent(db_manager):
+    db_manager.migrate("MigrationTest", MIGRATIONS)
+    assert db_manager.migrate("MigrationTest", MIGRATIONS) == 2
+    assert db_manager.get_schema_version("MigrationTest") == 2
+
+
+def test_failed_migration_is_rolled_back(db_manager):
+    db_manager.db_execute_commit("DELETE FROM schema_version WHERE component = ?", args=["MigrationFailTest"])
+    db_manager.db_execute_commit("DROP TABLE IF EXISTS MigrationFailTest")
+    migrations = [["CREATE TABLE MigrationFailTest (id integer)", "INSERT INTO MissingTable VALUES (1)"]]
+    assert db_manager.migrate("MigrationFailTest", migrations) == 0
+    assert db_manager.get_schema_version("MigrationFailTest") == 0
+    assert not db_manager.db_execute_select("SELECT name FROM sqlite_master WHERE name = 'MigrationFailTest'")
+
+
+BOOTSTRAP_TABLES = ["CREATE TABLE IF NOT EXISTS BootstrapTest (id integer NOT NULL PRIMARY KEY)"]
+
+
+def table_exists(db_manager, table):
+    return bool(db_manager.db_execute_select("SELECT name FROM sqlite_master WHERE name = ?", args=[table]))
+
+
+def test_bootstrap_runs_once(db_manager):
+    db_manager.db_execute_commit("DROP TABLE IF EXISTS BootstrapTest")
+    db_manager.register_schema("BootstrapTest", BOOTSTRAP_TABLES)
+    db_manager.register_extension("BootstrapTest", 0, True, True)
+    assert db_manager.bootstrap() == ["Base", "BootstrapTest", "BootstrapTest extension"]
+    assert table_exists(db_manager, "BootstrapTest")
+    assert db_manager.db_execute_select("SELECT * FROM KoalaExtensions WHERE extension_id = ?",
+                                        args=["BootstrapTest"]) == [("BootstrapTest", 0, 1, 1)]
+    db_manager.enable_instrumentation()
+    assert db_manager.bootstrap() == []
+    assert not db_manager.query_stats.report()
+
+
+def test_bootstrap_updates_extension(db_manager):
+    db_manager.register_extension("BootstrapTest", 0, True, True)
+    db_manager.bootstrap()
+    db_manager.register_extension("BootstrapTest", 0, False, False)
+    assert db_manager.bootstrap() == ["BootstrapTest extension"]
+    assert db_manager.db_execute_select("SELECT * FROM KoalaExtensions WHERE extension_id = ?",
+                                        args=["BootstrapTest"]) == [("BootstrapTest", 0, 0, 0)]
+
+
+def test_bootstrap_after_drop(db_manager):
+    db_manager.register_schema("BootstrapTest", BOOTSTRAP_TABLES)
+    db_manager.bootstrap()
+    db_manager.db_execute_commit("DROP TABLE BootstrapTest")
+    assert "BootstrapTest" in db_manager.bootstrap()
+    assert table_exists(db_manager, "BootstrapTest")
+
+
+def test_bootstrap_is_atomic(db_manager):
+    db_manager.db_execute_commit("DROP TABLE IF EXISTS BootstrapTest")
+    db_manager.register_schema("BootstrapTest", BOOTSTRAP_TABLES)
+    db_manager.register_schema("BootstrapFailTest", ["CREATE TABLE MissingColumns ()"])
+    with pytest.raises(Exception):
+        db_manager.bootstrap()
+    assert not table_exists(db_manager, "BootstrapTest")
+
+
+def test_startup_report(db_manager):
+    db_manager.register_schema("BootstrapTest", BOOTSTRAP_TABLES)
+    db_manager.bootstrap()
+    report = db_manager.startup_report()
+    assert "Base, BootstrapTest" in report
+    assert "total (1 bootstraps)" in report
+
+
+PoolTestRow = KoalaDBManager.row_type("PoolTestRow", ["PoolTest.id", "value"])
+
+
+def test_row_type():
+    row = PoolTestRow(1, "koala")
+    assert PoolTestRow.columns == "PoolTest.id, value"
+    assert (row.id, row.value) == (1, "koala")
+    assert row == (1, "koala")
+    assert not hasattr(row, "__dict__")
+
+
+@pytest.mark.asyncio
+async def test_select_rows(db_manager):
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(1, "koala"), (2, "panda")])
+    sql = f"SELECT {PoolTestRow.columns} FROM PoolTest ORDER BY id"
+    rows = db_manager.db_execute_select(sql, row=PoolTestRow)
+    assert [row.value for row in rows] == ["koala", "panda"]
+    assert await db_manager.select(sql, row=PoolTestRow) == rows
+
+
+def test_select_iter(db_manager):
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(i, str(i)) for i in range(25)])
+    rows = db_manager.db_execute_select_iter(f"SELECT {PoolTestRow.columns} FROM PoolTest ORDER BY id",
+                                             row=PoolTestRow, batch_size=10)
+    assert [row.id for row in rows] == list(range(25))
+    assert list(db_manager.db_execute_select_iter("SELECT value FROM PoolTest WHERE id < ? ORDER BY id",
+                                                  args=[2])) == [("0",), ("1",)]
+
+
+def test_select_iter_releases_connection(db_manager):
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(i, str(i)) for i in range(25)])
+    rows = db_manager.db_execute_select_iter("SELECT * FROM PoolTest", batch_size=10)
+    next(rows)
+    assert db_manager.reader_pool.idle_count() == 0
+    rows.close()
+    assert db_manager.reader_pool.idle_count() == 1
+
+
+HOT_QUERIES = [
+    ("SELECT * FROM UserInTwitchAlert WHERE twitch_username = ?", [""]),
+    ("SELECT * FROM UserInTwitchTeam WHERE twitch_username = ?", [""]),
+    ("SELECT * FROM TextFilter WHERE guild_id = ?", [0]),
+    ("SELECT * FROM TextFilterIgnoreList WHERE guild_id = ? AND ignore_type = ? ", [0, "user"]),
+    ("SELECT * FROM GuildRFRMessages WHERE guild_id = ? AND channel_id = ? AND message_id = ?;", [0, 0, 0]),
+    ("SELECT email FROM verified_emails WHERE u_id=?", [0]),
+    ("SELECT * FROM Votes WHERE end_time < ?", [0]),
+]
+
+
+@pytest.mark.parametrize("sql, args", HOT_QUERIES)
+def test_hot_queries_use_index(db_manager, sql, args):
+    TwitchAlert.TwitchAlertDBManager(db_manager, None).create_tables()
+    TextFilter.TextFilterDBManager(db_manager, None).create_tables()
+    ReactForRole.ReactForRoleDBManager(db_manager).create_tables()
+    Verification.Verification(None, db_manager).set_up_tables()
+    Voting.VoteManager(db_manager)
+    plan = db_manager.db_execute_select("EXPLAIN QUERY PLAN " + sql, args=args)
+    details = [row[-1] for row in plan]
+    assert any("USING" in detail and "INDEX" in detail for detail in details), details
+    assert not any(detail.startswith("SCAN") and "INDEX" not in detail for detail in details), details
+
+
+def test_fingerprint():
+    assert KoalaDBManager.fingerprint("SELECT *  FROM PoolTest\n WHERE id = 1 AND value = 'it''s';") == \
+        "SELECT * FROM PoolTest WHERE id = ? AND value = ?"
+    assert KoalaDBManager.fingerprint("SELECT * FROM PoolTest WHERE id IN (?, ?, ?)") == \
+        KoalaDBManager.fingerprint("SELECT * FROM PoolTest WHERE id IN (?)")
+
+
+def test_instrumentation_disabled_by_default(db_manager):
+    db_manager.db_execute_select("SELECT * FROM PoolTest")
+    assert db_manager.query_report() is None
+
+
+def test_instrumentation_records_queries(db_manager):
+    db_manager.enable_instrumentation()
+    for i in range(3):
+        db_manager.db_execute_commit(f"INSERT INTO PoolTest VALUES ({i}, 'koala')")
+    db_manager.db_execute_select("SELECT * FROM PoolTest WHERE id < ?", args=[2])
+    db_manager.db_execute_select("SELECT * FROM MissingTable")
+    report = {stats["fingerprint"]: stats for stats in db_manager.query_report()["queries"]}
+    insert = report["INSERT INTO PoolTest VALUES (...)"]
+    assert insert["calls"] == 3
+    assert insert["rows"] == 3
+    assert sum(insert["histogram"]) == 3
+    assert insert["p50"] <= insert["p99"] <= insert["max_time"]
+    assert report["SELECT * FROM PoolTest WHERE id < ?"]["rows"] == 2
+    assert report["SELECT * FROM MissingTable"]["errors"] == 1
+    db_manager.query_stats.reset()
+    assert db_manager.query_report()["queries"] == []
+    db_manager.disable_instrumentation()
+    assert db_manager.query_report() is None
+
+
+def test_slow_query_log_includes_plan(db_manager):
+    db_manager.enable_instrumentation(slow_query_threshold=0)
+    db_manager.db_execute_select("SELECT * FROM PoolTest WHERE value = ?", args=["koala"])
+    slow_query = db_manager.query_report()["slow_queries"][-1]
+    assert slow_query["fingerprint"] == "SELECT * FROM PoolTest WHERE value = ?"
+    assert slow_query["args"] == ["koala"]
+    assert any("PoolTest" in detail for detail in slow_query["plan"])
+
+
+def test_guild_extension_cache(db_manager):
+    db_manager.create_base_tables()
+    db_manager.clear_all_tables([("GuildExtensions",)])
+    db_manager.insert_extension("CacheTest", 0, True, True)
+    db_manager.give_guild_extension(1, "CacheTest")
+    db_manager.load_guild_extensions()
+    assert db_manager.extension_enabled(1, "CacheTest")
+    assert not db_manager.extension_enabled(2, "CacheTest")
+
+    db_manager.enable_instrumentation()
+    db_manager.give_guild_extension(2, "All")
+    assert db_manager.extension_enabled(2, "CacheTest")
+    db_manager.remove_guild_extension(1, "CacheTest")
+    assert not db_manager.extension_enabled(1, "CacheTest")
+    assert not any(stats["fingerprint"].startswith("SELECT guild_id, extension_id")
+                   for stats in db_manager.query_report()["queries"])
+    assert db_manager.load_guild_extensions() == {2: {"All"}}
+
+
+def test_guild_extension_cache_loaded_on_first_use(db_manager):
+    db_manager.create_base_tables()
+    db_manager.clear_all_tables([("GuildExtensions",)])
+    db_manager.give_guild_extension(3, "All")
+    assert db_manager.get_guild_extensions(3) == {"All"}
+    assert db_manager.get_guild_extensions(4) == set()
+
+
+def test_guild_extension_cache_load_racing_a_change(db_manager):
+    db_manager.create_base_tables()
+    db_manager.clear_all_tables([("GuildExtensions",)])
+    db_manager.give_guild_extension(5, "All")
+    main_thread = threading.current_thread()
+    select = db_manager.db_execute_select
+
+    def select_while_giving(*args, **kwargs):
+        rows = select(*args, **kwargs)
+        if threading.current_thread() is not main_thread:
+            return rows
+        # The extension is given by another thread after the rows are read, which must not wait for the load
+        thread = threading.Thread(target=db_manager.give_guild_extension, args=(6, "All"))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        return rows
+
+    db_manager.db_execute_select = select_while_giving
+    assert db_manager.load_guild_extensions() == {5: {"All"}}
+    del db_manager.db_execute_select
+    assert db_manager.get_guild_extensions(6) == {"All"}
+
+
+def test_reader_connections_are_read_only(db_manager):
+    with db_manager.reader_pool.connection() as conn:
+        with pytest.raises(KoalaDBManager.sqlite3.OperationalError):
+            conn.execute("INSERT INTO PoolTest VALUES (1, 'koala')")
+
+
+def test_select_does_not_wait_for_writer(db_manager):
+    db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    in_transaction = threading.Event()
+    finish_transaction = threading.Event()
+
+    def writer():
+        with db_manager.transaction():
+            db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[2, "bear"])
+            in_transaction.set()
+            finish_transaction.wait(5)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    in_transaction.wait(5)
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(1,)]
+    finish_transaction.set()
+    thread.join()
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(2,)]
+
+
+def run_stress(db_manager, readers=4, duration=0.5):
+    reads, writes = [0] * readers, [0]
+    stop = threading.Event()
+
+    def reader(i):
+        while not stop.is_set():
+            db_manager.db_execute_select("SELECT * FROM PoolTest WHERE id = ?", args=[i])
+            reads[i] += 1
+
+    def writer():
+        while not stop.is_set():
+            with db_manager.transaction():
+                db_manager.db_execute_commit("INSERT OR REPLACE INTO PoolTest VALUES (?, ?)", args=[writes[0], "koala"])
+                time.sleep(0.005)
+            writes[0] += 1
+
+    threads = [threading.Thread(target=reader, args=[i]) for i in range(readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(reads), writes[0]
+
+
+def test_stress_concurrent_readers_and_writer(db_manager):
+    shared_manager = KoalaDBManager.KoalaDBManager(DB_PATH, KoalaBot.DB_KEY, pool_size=0)
+    shared_reads, shared_writes = run_stress(shared_manager)
+    shared_manager.close()
+    reads, writes = run_stress(db_manager)
+    # Sharing one connection, readers and the writer queue behind each other, which usually starves the writer.
+    # How badly depends on thread scheduling, so only check the writer keeps making progress alongside the readers
+    assert reads > shared_reads
+    assert writes >= 10
+
+
+BACKUP_PATH = "KoalaDBManagerTestBackup.db"
+
+
+def remove_backup():
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(BACKUP_PATH + suffix):
+            os.remove(BACKUP_PATH + suffix)
+
+
+def test_backup_and_restore(db_manager):
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(i, "koala") for i in range(1000)])
+    steps = []
+    assert db_manager.backup(BACKUP_PATH, pages_per_step=1, sleep=0,
+                             progress=lambda status, remaining, total: steps.append(remaining)) == BACKUP_PATH
+    assert len(steps) > 1
+
+    db_manager.db_execute_commit("DELETE FROM PoolTest WHERE id >= 500")
+    db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[5000, "bear"])
+    db_manager.restore(BACKUP_PATH)
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(1000,)]
+    assert db_manager.db_execute_select("SELECT * FROM PoolTest WHERE id = 5000") == []
+    db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[5000, "bear"])
+    assert db_manager.db_execute_select("SELECT COUNT(*) FROM PoolTest") == [(1001,)]
+    remove_backup()
+
+
+def test_backup_while_writing(db_manager):
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            db_manager.db_execute_commit("INSERT INTO PoolTest VALUES (?, ?)", args=[i, "koala"])
+            i += 1
+
+    db_manager.db_execute_many("INSERT INTO PoolTest VALUES (?, ?)", [(-i, "koala") for i in range(1, 2000)])
+    thread = threading.Thread(target=writer)
+    thread.start()
+    db_manager.backup(BACKUP_PATH, pages_per_step=1, sleep=0.001)
+    stop.set()
+    thread.join()
+    backup = db_manager.connect(BACKUP_PATH)
+    assert backup.execute("PRAGMA integrity_check").fetchall() == [("ok",)]
+    assert backup.execute("SELECT COUNT(*) FROM PoolTest WHERE id < 0").fetchall() == [(1999,)]
+    backup.close()
+    remove_backup()
+
+
+def test_restore_missing_backup(db_manager):
+    with pytest.raises(FileNotFoundError):
+        db_manager.restore("MissingBackup.db")
+
+
+@pytest.mark.asyncio
+async def test_run_backup(db_manager):
+    await db_manager.commit("INSERT INTO PoolTest VALUES (?, ?)", args=[1, "koala"])
+    assert await db_manager.run_backup(BACKUP_PATH) == BACKUP_PATH
+    assert os.path.exists(BACKUP_PATH)
+    remove_backup()
@@ -238,6 +238,85 @@ async def test_unfilter_word_correct_database(tf_cog):
     dpytest.verify_message("*unfilterboi* has been unfiltered.")
     cleanup(dpytest.get_config().guilds[0].id, tf_cog)
 
+@pytest.mark.asyncio()
+async def test_unfilter_word_stops_filtering(tf_cog):
+    await dpytest.message(KoalaBot.COMMAND_PREFIX + "filter_word cachedword")
+    assertFilteredConfirmation("cachedword", "banned")
+
+    await dpytest.message("cachedword")
+    assertBannedWarning("cachedword")
+
+    await dpytest.message(KoalaBot.COMMAND_PREFIX + "unfilter_word cachedword")
+    dpytest.verify_message("*cachedword* has been unfiltered.")
+
+    await dpytest.message("cachedword")
+    dpytest.verify_message(assert_nothing=True)
+    cleanup(dpytest.get_config().guilds[0].id, tf_cog)
+
+@pytest.mark.asyncio()
+async def test_banned_word_mod_channel_lookup_failed(tf_cog):
+    await dpytest.message(KoalaBot.COMMAND_PREFIX + "filter_word nomodchannel")
+    assertFilteredConfirmation("nomodchannel", "banned")
+
+    with mock.patch.object(tf_cog.tf_database_manager, "get_mod_channel", return_value=None), \
+            mock.patch.object(discord.Message, "delete", new_callable=mock.AsyncMock) as delete:
+        await dpytest.message("nomodchannel")
+    assertBannedWarning("nomodchannel")
+    delete.assert_awaited_once()
+    dpytest.verify_message(assert_nothing=True)
+    cleanup(dpytest.get_config().guilds[0].id, tf_cog)
+
+
+def test_filter_matcher_overlapping_words():
+    matcher = TextFilter.FilterMatcher([("hers", "banned", "0"), ("she", "risky", "0"), ("he", "banned", "0"),
+                                        ("his", "risky", "0")])
+    assert matcher.match("ushers") == ("hers", "banned", "0")
+    assert matcher.match("usher") == ("she", "risky", "0")
+    assert matcher.match("ahis") == ("his", "risky", "0")
+    assert matcher.match("hi") is None
+    assert matcher.match("") is None
+
+def test_filter_matcher_first_filter_wins():
+    matcher = TextFilter.FilterMatcher([("[0-9]{3}", "risky", "1"), ("abc", "banned", "0"),
+                                        ("^hello", "banned", "1"), ("123", "banned", "0")])
+    assert matcher.match("abc 123") == ("[0-9]{3}", "risky", "1")
+    assert matcher.match("abc 12") == ("abc", "banned", "0")
+    assert matcher.match("hello 12") == ("^hello", "banned", "1")
+    assert matcher.match("say hello") is None
+
+def test_filter_matcher_regex_literal_and_groups():
+    matcher = TextFilter.FilterMatcher([("a.c", "banned", "1"), ("(x)\\1", "risky", "1"), ("(?i)caps", "banned", "1"),
+                                        ("skipped", "email", "0")])
+    assert matcher.match("abc") == ("a.c", "banned", "1")
+    assert matcher.match("xx") == ("(x)\\1", "risky", "1")
+    assert matcher.match("x") is None
+    assert matcher.match("CAPS") == ("(?i)caps", "banned", "1")
+    assert matcher.match("skipped") is None
+
+def test_literal_prefix():
+    assert TextFilter.literal_prefix("verify [a-z]+") == "verify "
+    assert TextFilter.literal_prefix("^hello") == "hello"
+    assert TextFilter.literal_prefix("abc+d") == "abc"
+    assert TextFilter.literal_prefix("abc*d") == "ab"
+    assert TextFilter.literal_prefix("abc|def") == ""
+    assert TextFilter.literal_prefix("(?i)abc") == ""
+    assert TextFilter.literal_prefix(r"\d+abc") == ""
+
+def test_filter_matcher_cached_until_changed(tf_cog):
+    db_manager = tf_cog.tf_database_manager
+    guild_id = dpytest.get_config().guilds[0].id
+    matcher = db_manager.get_matcher(guild_id)
+    assert db_manager.get_matcher(guild_id) is matcher
+
+    db_manager.new_filtered_text(guild_id, "matcherword", "banned", False)
+    new_matcher = db_manager.get_matcher(guild_id)
+    assert new_matcher is not matcher
+    assert new_matcher.match("a matcherword") == ("matcherword", "banned", "0")
+
+    db_manager.remove_filter_text(guild_id, "matcherword")
+    assert db_manager.get_matcher(guild_id).match("a matcherword") is None
+    cleanup(guild_id, tf_cog)
+
 @pytest.mark.asyncio()
 async def test_unfilter_empty():
     with pytest.raises(Exception):
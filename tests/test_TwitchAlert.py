@@ -10,8 +10,15 @@ Commented using reStructuredText (reST)
 # Built-in/Generic Imports
 import os
 import asyncio
+import calendar
+import hashlib
+import hmac
+import json
+import time
 
 # Libs
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 import discord.ext.test as dpytest
 import mock
 import pytest_ordering as pytest
@@ -382,8 +389,723 @@ async def test_loop_check_team_live(twitch_cog):
 # Test TwitchAPIHandler
 
 @pytest.fixture
-def twitch_api_handler():
-    return TwitchAlert.TwitchAPIHandler(TwitchAlert.TWITCH_CLIENT_ID, TwitchAlert.TWITCH_SECRET)
+async def twitch_api_handler():
+    handler = TwitchAlert.TwitchAPIHandler(TwitchAlert.TWITCH_CLIENT_ID, TwitchAlert.TWITCH_SECRET)
+    yield handler
+    await handler.close()
+
+
+def create_twitch_app():
+    """
+    Creates a local stand-in for the twitch API, recording the requests it receives and the client connections
+    they were made on
+    """
+    app = web.Application()
+    state = app["state"] = {"requests": [], "peers": set(), "delay": 0, "in_flight": 0, "max_in_flight": 0,
+                            "subscriptions": {}, "failures": 0, "teams": {}, "oauth_delay": 0, "oauth_status": 200}
+
+    async def record(request):
+        state["requests"].append(request.path_qs)
+        state["peers"].add(request.transport.get_extra_info("peername"))
+
+    async def oauth(request):
+        await record(request)
+        await asyncio.sleep(state["oauth_delay"])
+        if state["oauth_status"] != 200:
+            return web.json_response({"message": "Internal Server Error", "status": state["oauth_status"]},
+                                     status=state["oauth_status"])
+        tokens = len([path for path in state["requests"] if path.startswith("/oauth2/token")])
+        return web.json_response({"access_token": f"test_token_{tokens}", "expires_in": 3600,
+                                  "token_type": "bearer"})
+
+    async def users(request):
+        await record(request)
+        return web.json_response({"data": [{"id": "id_" + login, "login": login,
+                                            "profile_image_url": "http://koalabot.uk"}
+                                           for login in request.query.getall("login", [])]})
+
+    async def streams(request):
+        await record(request)
+        logins = request.query.getall("user_login", [])
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(state["delay"])
+        state["in_flight"] -= 1
+        if any(login.startswith("error") for login in logins):
+            return web.json_response({"error": "Internal Server Error", "status": 500}, status=500)
+        return web.json_response({"data": [{"user_name": login, "type": "live", "game_id": "26936"}
+                                           for login in logins if not login.startswith("offline")]})
+
+    async def games(request):
+        await record(request)
+        return web.json_response({"data": [{"id": game_id, "name": "Music"}
+                                           for game_id in request.query.getall("id", [])]})
+
+    async def list_subscriptions(request):
+        await record(request)
+        return web.json_response({"data": list(state["subscriptions"].values()), "pagination": {}})
+
+    async def create_subscription(request):
+        await record(request)
+        subscription = dict(await request.json(), id=f"sub_{len(state['requests'])}",
+                            status="webhook_callback_verification_pending")
+        del subscription["transport"]["secret"]
+        state["subscriptions"][subscription["id"]] = subscription
+        return web.json_response({"data": [subscription]}, status=202)
+
+    async def delete_subscription(request):
+        await record(request)
+        del state["subscriptions"][request.query["id"]]
+        return web.Response(status=204)
+
+    async def flaky(request):
+        await record(request)
+        if state["failures"] > 0:
+            state["failures"] -= 1
+            return web.json_response({"error": "Service Unavailable", "status": 503}, status=503)
+        return web.json_response({"data": [{"id": "1"}]})
+
+    async def limited(request):
+        await record(request)
+        if len([path for path in state["requests"] if path.startswith("/helix/limited")]) == 1:
+            return web.json_response({"error": "Too Many Requests", "status": 429}, status=429, headers={
+                "Ratelimit-Limit": "800", "Ratelimit-Remaining": "0", "Ratelimit-Reset": str(int(time.time()))})
+        return web.json_response({"data": []}, headers={
+            "Ratelimit-Limit": "800", "Ratelimit-Remaining": "799", "Ratelimit-Reset": str(int(time.time()))})
+
+    async def unauthorized(request):
+        await record(request)
+        return web.json_response({"error": "Unauthorized", "status": 401}, status=401)
+
+    async def teams(request):
+        await record(request)
+        team = state["teams"].get(request.query.get("name"))
+        if team is None:
+            return web.json_response({"error": "Not Found", "status": 404}, status=404)
+        return web.json_response({"data": [{"team_name": request.query.get("name"),
+                                            "users": [{"user_login": login} for login in team]}]})
+
+    app.router.add_post("/oauth2/token", oauth)
+    app.router.add_get("/helix/teams", teams)
+    app.router.add_get("/helix/flaky", flaky)
+    app.router.add_get("/helix/limited", limited)
+    app.router.add_get("/helix/unauthorized", unauthorized)
+    app.router.add_get("/helix/eventsub/subscriptions", list_subscriptions)
+    app.router.add_post("/helix/eventsub/subscriptions", create_subscription)
+    app.router.add_delete("/helix/eventsub/subscriptions", delete_subscription)
+    app.router.add_get("/helix/users", users)
+    app.router.add_get("/helix/streams", streams)
+    app.router.add_get("/helix/games", games)
+    return app
+
+
+@pytest.fixture
+async def twitch_server():
+    server = TestServer(create_twitch_app())
+    await server.start_server()
+    yield server
+    await server.close()
+
+
+@pytest.fixture
+async def local_api_handler(twitch_server):
+    handler = TwitchAlert.TwitchAPIHandler("client_id", "client_secret",
+                                           api_url=str(twitch_server.make_url("/helix/")),
+                                           oauth_url=str(twitch_server.make_url("/oauth2/token")),
+                                           retry_base_delay=0.01)
+    yield handler
+    await handler.close()
+
+
+@pytest.mark.asyncio
+async def test_session_reused(local_api_handler, twitch_server):
+    session = local_api_handler.get_session()
+    for _ in range(5):
+        assert (await local_api_handler.get_streams_data(["monstercat"]))[0].get("user_name") == "monstercat"
+    assert local_api_handler.session is session
+    state = twitch_server.app["state"]
+    assert state["requests"][0] == "/oauth2/token?client_id=client_id&client_secret=client_secret" \
+                                   "&grant_type=client_credentials"
+    assert len(state["requests"]) == 6
+    assert len(state["peers"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_local_streams_data(local_api_handler, twitch_server):
+    usernames = [f"user_{i}" for i in range(150)]
+    streams_data = await local_api_handler.get_streams_data(usernames)
+    assert sorted(stream.get("user_name") for stream in streams_data) == sorted(usernames)
+    assert (await local_api_handler.get_game_data("26936")).get("name") == "Music"
+
+
+@pytest.mark.asyncio
+async def test_streams_batches_are_bounded(local_api_handler, twitch_server):
+    twitch_server.app["state"]["delay"] = 0.05
+    local_api_handler.streams_concurrency = 2
+    usernames = [f"user_{i}" for i in range(500)]
+    streams_data = await local_api_handler.get_streams_data(usernames)
+    assert sorted(stream.get("user_name") for stream in streams_data) == sorted(usernames)
+    assert twitch_server.app["state"]["max_in_flight"] == 2
+
+
+@pytest.mark.asyncio
+async def test_streams_failed_batch(local_api_handler):
+    usernames = [f"user_{i}" for i in range(100)] + ["error_user"] + [f"user_{i}" for i in range(100, 250)]
+    failed_usernames = []
+    streams_data = await local_api_handler.get_streams_data(usernames, failed_usernames)
+    assert failed_usernames == usernames[100:200]
+    assert sorted(stream.get("user_name") for stream in streams_data) == sorted(usernames[:100] + usernames[200:])
+
+
+@pytest.mark.asyncio
+async def test_streams_all_batches_failed(local_api_handler):
+    failed_usernames = []
+    assert await local_api_handler.get_streams_data(["error_user"], failed_usernames) is None
+    assert failed_usernames == ["error_user"]
+
+
+def test_ttl_cache_expires():
+    cache = TwitchAlert.TTLCache(10, 0)
+    cache.set("koala", 1)
+    assert cache.get("koala") is None
+    assert cache.stats() == {"hits": 0, "misses": 1, "hit_rate": 0.0, "size": 0}
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TwitchAlert.TTLCache(2, 60)
+    cache.set("koala", 1)
+    cache.set("panda", 2)
+    assert cache.get("koala") == 1
+    cache.set("sloth", 3)
+    assert cache.get("panda") is None
+    assert (cache.get("koala"), cache.get("sloth")) == (1, 3)
+    assert (cache.hits, cache.misses, len(cache)) == (3, 1, 2)
+
+
+@pytest.mark.asyncio
+async def test_users_data_batched_and_cached(local_api_handler, twitch_server):
+    state = twitch_server.app["state"]
+    usernames = [f"User_{i}" for i in range(150)]
+    users_data = await local_api_handler.get_users_data(usernames)
+    assert sorted(users_data) == sorted(username.lower() for username in usernames)
+    assert len([path for path in state["requests"] if path.startswith("/helix/users")]) == 2
+
+    assert (await local_api_handler.get_user_data("User_7")).get("login") == "user_7"
+    assert len([path for path in state["requests"] if path.startswith("/helix/users")]) == 2
+    assert local_api_handler.user_cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_games_data_cached(local_api_handler, twitch_server):
+    assert (await local_api_handler.get_game_data("26936")).get("name") == "Music"
+    assert (await local_api_handler.get_game_data("26936")).get("name") == "Music"
+    assert await local_api_handler.get_game_data("") is None
+    assert len([path for path in twitch_server.app["state"]["requests"] if path.startswith("/helix/games")]) == 1
+    assert (local_api_handler.game_cache.hits, local_api_handler.game_cache.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_prefetch_alert_data(twitch_cog, local_api_handler, twitch_server):
+    twitch_cog.ta_database_manager.twitch_handler = local_api_handler
+    streams_data = [{"user_name": f"User_{i}", "user_login": f"user_{i}", "type": "live", "game_id": str(i % 3),
+                     "title": "Test Title"} for i in range(20)]
+    await twitch_cog.prefetch_alert_data(streams_data)
+    requests = [path for path in twitch_server.app["state"]["requests"] if path.startswith("/helix/")]
+    assert len(requests) == 2
+    for stream_data in streams_data:
+        embed = await twitch_cog.create_alert_embed(stream_data, "")
+        assert embed.author.name == f"{stream_data['user_name']} is now streaming!"
+    assert [path for path in twitch_server.app["state"]["requests"] if path.startswith("/helix/")] == requests
+
+
+@pytest.mark.asyncio
+async def test_loop_check_live_reconciles(twitch_cog, local_api_handler):
+    channel = dpytest.get_config().channels[0]
+    guild_id = dpytest.get_config().guilds[0].id
+    ta_database_manager = twitch_cog.ta_database_manager
+    ta_database_manager.twitch_handler = local_api_handler
+    database_manager = ta_database_manager.database_manager
+    for table in ["UserInTwitchAlert", "UserInTwitchTeam", "TeamInTwitchAlert"]:
+        database_manager.db_execute_commit(f"DELETE FROM {table}")
+    database_manager.give_guild_extension(guild_id, "TwitchAlert")
+    ta_database_manager.new_ta(guild_id, channel.id)
+    ta_database_manager.add_user_to_ta(channel.id, "live_user", "Live now!", guild_id)
+    ta_database_manager.add_user_to_ta(channel.id, "offline_user", None, guild_id)
+    old_alert = await channel.send("Old alert")
+    await dpytest.empty_queue()
+    database_manager.db_execute_commit("UPDATE UserInTwitchAlert SET message_id = ? WHERE twitch_username = ?",
+                                       args=[old_alert.id, "offline_user"])
+
+    with mock.patch.object(database_manager, "select", wraps=database_manager.select) as select, \
+            mock.patch.object(database_manager, "execute_many", wraps=database_manager.execute_many) as execute_many:
+        await twitch_cog.loop_check_live()
+    assert select.call_count == 2
+    execute_many.assert_called_once()
+
+    assert dpytest.get_embed().description == "Live now!"
+    assert dict(database_manager.db_execute_select("SELECT twitch_username, message_id FROM UserInTwitchAlert"))[
+               "offline_user"] is None
+    assert database_manager.db_execute_select("SELECT message_id FROM UserInTwitchAlert WHERE twitch_username = ?",
+                                              args=["live_user"])[0][0] is not None
+    with pytest.raises(discord.NotFound):
+        await channel.fetch_message(old_alert.id)
+
+
+@pytest.mark.asyncio
+async def test_loop_check_live_steady_state(twitch_cog, local_api_handler):
+    channel = dpytest.get_config().channels[0]
+    guild_id = dpytest.get_config().guilds[0].id
+    ta_database_manager = twitch_cog.ta_database_manager
+    ta_database_manager.twitch_handler = local_api_handler
+    database_manager = ta_database_manager.database_manager
+    for table in ["UserInTwitchAlert", "UserInTwitchTeam", "TeamInTwitchAlert"]:
+        database_manager.db_execute_commit(f"DELETE FROM {table}")
+    database_manager.give_guild_extension(guild_id, "TwitchAlert")
+    ta_database_manager.new_ta(guild_id, channel.id)
+    ta_database_manager.add_user_to_ta(channel.id, "live_user", "Live now!", guild_id)
+    await twitch_cog.loop_check_live()
+    assert dpytest.get_embed().description == "Live now!"
+    assert twitch_cog.user_alerts.live.keys() == {"live_user"}
+
+    # Nothing has changed, so the pass neither reads nor writes the database or discord
+    with mock.patch.object(database_manager, "select", wraps=database_manager.select) as select, \
+            mock.patch.object(database_manager, "execute_many", wraps=database_manager.execute_many) as execute_many:
+        await twitch_cog.loop_check_live()
+        select.assert_not_called()
+        execute_many.assert_not_called()
+        dpytest.verify_message(assert_nothing=True)
+
+        # Adding a user reloads the alerts
+        ta_database_manager.add_user_to_ta(channel.id, "live_user_2", None, guild_id)
+        await twitch_cog.loop_check_live()
+        assert select.call_count == 2
+        execute_many.assert_called_once()
+    assert dpytest.get_embed() is not None
+    assert database_manager.db_execute_select("SELECT message_id FROM UserInTwitchAlert WHERE twitch_username = ?",
+                                              args=["live_user_2"])[0][0] is not None
+
+@pytest.mark.asyncio
+async def test_loop_check_live_polls_users_once(twitch_cog, local_api_handler, twitch_server):
+    channel = dpytest.get_config().channels[0]
+    guild_id = dpytest.get_config().guilds[0].id
+    ta_database_manager = twitch_cog.ta_database_manager
+    ta_database_manager.twitch_handler = local_api_handler
+    database_manager = ta_database_manager.database_manager
+    for table in ["UserInTwitchAlert", "UserInTwitchTeam", "TeamInTwitchAlert"]:
+        database_manager.db_execute_commit(f"DELETE FROM {table}")
+    database_manager.give_guild_extension(guild_id, "TwitchAlert")
+    ta_database_manager.new_ta(guild_id, channel.id)
+    ta_database_manager.add_user_to_ta(channel.id, "shared_user", "User alert", guild_id)
+    ta_database_manager.add_team_to_ta(channel.id, "shared_team", "Team alert", guild_id)
+    team_alert_id = database_manager.db_execute_select("SELECT team_twitch_alert_id FROM TeamInTwitchAlert")[0][0]
+    database_manager.db_execute_many("INSERT INTO UserInTwitchTeam(team_twitch_alert_id, twitch_username) "
+                                     "VALUES (?, ?)", [(team_alert_id, "shared_user"), (team_alert_id, "team_user")])
+    ta_database_manager.subscriptions_changed()
+
+    await twitch_cog.loop_check_live()
+    streams_requests = [path for path in twitch_server.app["state"]["requests"] if path.startswith("/helix/streams")]
+    assert len(streams_requests) == 1
+    assert sorted(streams_requests[0].split("?")[1].split("&")) == ["user_login=shared_user",
+                                                                     "user_login=team_user"]
+    assert sorted([dpytest.get_embed().description for _ in range(3)]) == ["Team alert", "Team alert", "User alert"]
+    assert twitch_cog.user_alerts.live.keys() == {"shared_user"}
+    assert twitch_cog.team_alerts.live.keys() == {"shared_user", "team_user"}
+
+@pytest.mark.asyncio
+async def test_update_all_teams_members_diff(twitch_cog, local_api_handler, twitch_server):
+    channel = dpytest.get_config().channels[0]
+    guild_id = dpytest.get_config().guilds[0].id
+    ta_database_manager = twitch_cog.ta_database_manager
+    ta_database_manager.twitch_handler = local_api_handler
+    database_manager = ta_database_manager.database_manager
+    for table in ["UserInTwitchTeam", "TeamInTwitchAlert"]:
+        database_manager.db_execute_commit(f"DELETE FROM {table}")
+    ta_database_manager.new_ta(guild_id, channel.id)
+    for team_alert_id, team_name in [(701, "koala_team"), (702, "koala_team"), (703, "missing_team")]:
+        database_manager.db_execute_commit("INSERT INTO TeamInTwitchAlert(team_twitch_alert_id, channel_id, "
+                                           "twitch_team_name) VALUES (?, ?, ?)", args=[team_alert_id, channel.id,
+                                                                                       team_name])
+    old_alert = await channel.send("Old alert")
+    await dpytest.empty_queue()
+    database_manager.db_execute_many("INSERT INTO UserInTwitchTeam VALUES (?, ?, ?)",
+                                     [(701, "stays", None), (701, "left_team", old_alert.id), (703, "unknown", None)])
+    twitch_server.app["state"]["teams"]["koala_team"] = ["stays", "New_Member"]
+
+    assert await ta_database_manager.update_all_teams_members() == (3, 1)
+    members = database_manager.db_execute_select("SELECT team_twitch_alert_id, twitch_username FROM UserInTwitchTeam")
+    assert sorted((int(team_alert_id), username) for team_alert_id, username in members) == [
+        (701, "new_member"), (701, "stays"), (702, "new_member"), (702, "stays"), (703, "unknown")]
+    with pytest.raises(discord.NotFound):
+        await channel.fetch_message(old_alert.id)
+    assert len([path for path in twitch_server.app["state"]["requests"] if path.startswith("/helix/teams")]) == 2
+    stats = ta_database_manager.team_sync_stats
+    assert (stats["runs"], stats["teams"], stats["failed"], stats["added"], stats["removed"]) == (1, 3, 1, 3, 1)
+
+    version = ta_database_manager.subscriptions_version
+    assert await ta_database_manager.update_all_teams_members() == (0, 0)
+    assert ta_database_manager.subscriptions_version == version
+
+@pytest.mark.asyncio
+async def test_loop_check_live_skips_streamers_not_due(twitch_cog, local_api_handler, twitch_server):
+    channel = dpytest.get_config().channels[0]
+    guild_id = dpytest.get_config().guilds[0].id
+    ta_database_manager = twitch_cog.ta_database_manager
+    ta_database_manager.twitch_handler = local_api_handler
+    database_manager = ta_database_manager.database_manager
+    for table in ["UserInTwitchAlert", "UserInTwitchTeam", "TeamInTwitchAlert"]:
+        database_manager.db_execute_commit(f"DELETE FROM {table}")
+    database_manager.give_guild_extension(guild_id, "TwitchAlert")
+    ta_database_manager.new_ta(guild_id, channel.id)
+    ta_database_manager.add_user_to_ta(channel.id, "offline_user", None, guild_id)
+    old_alert = await channel.send("Old alert")
+    await dpytest.empty_queue()
+    database_manager.db_execute_commit("UPDATE UserInTwitchAlert SET message_id = ? WHERE twitch_username = ?",
+                                       args=[old_alert.id, "offline_user"])
+    twitch_cog.poll_scheduler.observe("offline_user", True)
+
+    await twitch_cog.loop_check_live()
+    assert not [path for path in twitch_server.app["state"]["requests"] if path.startswith("/helix/streams")]
+    assert (await channel.fetch_message(old_alert.id)).id == old_alert.id
+
+    twitch_cog.poll_scheduler.histories["offline_user"].next_poll = 0
+    await twitch_cog.loop_check_live()
+    with pytest.raises(discord.NotFound):
+        await channel.fetch_message(old_alert.id)
+    assert twitch_cog.poll_scheduler.due(["offline_user"]) == []
+
+
+def test_poll_scheduler_new_streamers():
+    scheduler = TwitchAlert.PollScheduler(min_interval=60, max_interval=600)
+    now = calendar.timegm((2021, 6, 7, 12, 0, 0))
+    assert scheduler.due(["new_user"], now) == ["new_user"]
+    scheduler.observe("new_user", False, now)
+    assert scheduler.due(["new_user"], now + 59) == []
+    assert scheduler.due(["new_user"], now + 60) == ["new_user"]
+
+
+def test_poll_scheduler_backs_off_dormant_streamers():
+    scheduler = TwitchAlert.PollScheduler(min_interval=60, max_interval=600)
+    now = calendar.timegm((2021, 6, 7, 12, 0, 0))
+    scheduler.observe("dormant_user", False, now)
+    scheduler.observe("dormant_user", False, now + 2 * TwitchAlert.POLL_LEARNING_PERIOD)
+    assert scheduler.histories["dormant_user"].next_poll == now + 2 * TwitchAlert.POLL_LEARNING_PERIOD + 240
+    scheduler.observe("dormant_user", False, now + 30 * 24 * 60 * 60)
+    assert scheduler.histories["dormant_user"].next_poll == now + 30 * 24 * 60 * 60 + 600
+
+    scheduler.observe("dormant_user", True, now + 31 * 24 * 60 * 60)
+    assert scheduler.histories["dormant_user"].next_poll == now + 31 * 24 * 60 * 60 + 60
+
+
+def test_poll_scheduler_learns_usual_hours():
+    scheduler = TwitchAlert.PollScheduler(min_interval=60, max_interval=600)
+    start = calendar.timegm((2021, 6, 7, 20, 0, 0))
+    for day in range(7):
+        scheduler.observe("weekly_user", day == 0, start + day * 24 * 60 * 60)
+        scheduler.observe("weekly_user", False, start + day * 24 * 60 * 60 + 2 * 60 * 60)
+    history = scheduler.histories["weekly_user"]
+    assert scheduler.interval(history, start + 7 * 24 * 60 * 60 - 30 * 60) == 60
+    assert scheduler.interval(history, start + 7 * 24 * 60 * 60 - 12 * 60 * 60) == 600
+
+
+def test_poll_scheduler_prune():
+    scheduler = TwitchAlert.PollScheduler()
+    scheduler.due(["user_a", "user_b"])
+    scheduler.due(["user_b", "user_c"])
+    scheduler.prune(["user_b", "user_c"])
+    assert sorted(scheduler.histories) == ["user_b", "user_c"]
+
+def eventsub_headers(message_type, body, message_id="message_1", secret="eventsub_secret", timestamp=None):
+    """
+    Creates the headers of an EventSub message, signed like twitch signs them
+    """
+    if timestamp is None:
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S.123456789Z", time.gmtime())
+    signature = hmac.new(secret.encode(), (message_id + timestamp).encode() + body, hashlib.sha256).hexdigest()
+    return {"Twitch-Eventsub-Message-Id": message_id,
+            "Twitch-Eventsub-Message-Timestamp": timestamp,
+            "Twitch-Eventsub-Message-Signature": "sha256=" + signature,
+            "Twitch-Eventsub-Message-Type": message_type,
+            "Content-Type": "application/json"}
+
+
+def stream_event(event_type, username):
+    return json.dumps({"subscription": {"id": "sub_1", "type": event_type, "status": "enabled"},
+                       "event": {"broadcaster_user_id": "id_" + username, "broadcaster_user_login": username,
+                                 "broadcaster_user_name": username}}).encode()
+
+
+@pytest.fixture
+async def eventsub_client():
+    events = []
+
+    async def on_online(username):
+        events.append(("online", username))
+
+    async def on_offline(username):
+        events.append(("offline", username))
+
+    handler = TwitchAlert.EventSubHandler(None, "eventsub_secret", "https://koalabot.uk/twitch/eventsub",
+                                          on_online, on_offline)
+    client = TestClient(TestServer(handler.app))
+    await client.start_server()
+    client.events = events
+    client.handler = handler
+    yield client
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_eventsub_verification_challenge(eventsub_client):
+    body = json.dumps({"challenge": "pogchamp-kappa-360noscope-vohiyo",
+                       "subscription": {"id": "sub_1", "type": "stream.online"}}).encode()
+    response = await eventsub_client.post("/twitch/eventsub", data=body,
+                                          headers=eventsub_headers("webhook_callback_verification", body))
+    assert response.status == 200
+    assert await response.text() == "pogchamp-kappa-360noscope-vohiyo"
+
+
+@pytest.mark.asyncio
+async def test_eventsub_rejects_invalid_messages(eventsub_client):
+    body = stream_event("stream.online", "monstercat")
+    for headers in [eventsub_headers("notification", body, secret="wrong_secret"),
+                    eventsub_headers("notification", body, timestamp="2020-01-01T00:00:00.123456789Z"),
+                    {"Content-Type": "application/json"}]:
+        response = await eventsub_client.post("/twitch/eventsub", data=body, headers=headers)
+        assert response.status == 403
+    response = await eventsub_client.post("/twitch/eventsub", data=body + b" ",
+                                          headers=eventsub_headers("notification", body))
+    assert response.status == 403
+    assert eventsub_client.events == []
+
+
+@pytest.mark.asyncio
+async def test_eventsub_notifications(eventsub_client):
+    online = stream_event("stream.online", "MonsterCat")
+    offline = stream_event("stream.offline", "monstercat")
+    for body, message_id in [(online, "message_1"), (online, "message_1"), (offline, "message_2")]:
+        response = await eventsub_client.post("/twitch/eventsub", data=body,
+                                              headers=eventsub_headers("notification", body, message_id))
+        assert response.status == 204
+    await asyncio.gather(*eventsub_client.handler.tasks)
+    assert eventsub_client.events == [("online", "monstercat"), ("offline", "monstercat")]
+
+
+@pytest.mark.asyncio
+async def test_eventsub_revocation(eventsub_client):
+    eventsub_client.handler.subscriptions = {("stream.online", "id_monstercat"): "sub_1",
+                                             ("stream.offline", "id_monstercat"): "sub_2"}
+    body = json.dumps({"subscription": {"id": "sub_1", "type": "stream.online",
+                                        "status": "authorization_revoked"}}).encode()
+    response = await eventsub_client.post("/twitch/eventsub", data=body, headers=eventsub_headers("revocation", body))
+    assert response.status == 204
+    assert eventsub_client.handler.subscriptions == {("stream.offline", "id_monstercat"): "sub_2"}
+
+
+@pytest.mark.asyncio
+async def test_eventsub_sync_subscriptions(local_api_handler, twitch_server):
+    callback_url = "https://koalabot.uk/twitch/eventsub"
+    subscriptions = twitch_server.app["state"]["subscriptions"]
+    subscriptions["old"] = {"id": "old", "type": "stream.online", "status": "enabled",
+                            "condition": {"broadcaster_user_id": "id_removed_user"},
+                            "transport": {"method": "webhook", "callback": callback_url}}
+    subscriptions["other"] = {"id": "other", "type": "stream.online", "status": "enabled",
+                              "condition": {"broadcaster_user_id": "id_removed_user"},
+                              "transport": {"method": "webhook", "callback": "https://example.com"}}
+    handler = TwitchAlert.EventSubHandler(local_api_handler, "eventsub_secret", callback_url, None, None)
+
+    assert await handler.sync_subscriptions(["monstercat", "jaydwee"]) == (4, 1)
+    assert sorted((subscription["type"], subscription["condition"]["broadcaster_user_id"])
+                  for subscription in subscriptions.values() if subscription["id"] != "other") == [
+        ("stream.offline", "id_jaydwee"), ("stream.offline", "id_monstercat"),
+        ("stream.online", "id_jaydwee"), ("stream.online", "id_monstercat")]
+    assert "other" in subscriptions
+    assert set(handler.subscriptions.values()) == set(subscriptions) - {"other"}
+
+    assert await handler.sync_subscriptions(["monstercat", "jaydwee"]) == (0, 0)
+    assert await handler.sync_subscriptions(["monstercat"]) == (0, 2)
+    assert len(subscriptions) == 3
+
+
+@pytest.mark.asyncio
+async def test_stream_events_update_alerts(twitch_cog, local_api_handler):
+    channel = dpytest.get_config().channels[0]
+    guild_id = dpytest.get_config().guilds[0].id
+    ta_database_manager = twitch_cog.ta_database_manager
+    ta_database_manager.twitch_handler = local_api_handler
+    database_manager = ta_database_manager.database_manager
+    for table in ["UserInTwitchAlert", "UserInTwitchTeam", "TeamInTwitchAlert"]:
+        database_manager.db_execute_commit(f"DELETE FROM {table}")
+    database_manager.give_guild_extension(guild_id, "TwitchAlert")
+    ta_database_manager.new_ta(guild_id, channel.id)
+    ta_database_manager.add_user_to_ta(channel.id, "event_user", "Live now!", guild_id)
+    ta_database_manager.add_user_to_ta(channel.id, "other_user", None, guild_id)
+
+    await twitch_cog.on_stream_online("event_user")
+    assert dpytest.get_embed().description == "Live now!"
+    dpytest.verify_message(assert_nothing=True)
+    message_id = database_manager.db_execute_select(
+        "SELECT message_id FROM UserInTwitchAlert WHERE twitch_username = ?", args=["event_user"])[0][0]
+    assert message_id is not None
+    assert twitch_cog.user_alerts.live.keys() == {"event_user"}
+
+    await twitch_cog.on_stream_offline("event_user")
+    assert database_manager.db_execute_select(
+        "SELECT message_id FROM UserInTwitchAlert WHERE twitch_username = ?", args=["event_user"])[0][0] is None
+    with pytest.raises(discord.NotFound):
+        await channel.fetch_message(message_id)
+    assert twitch_cog.user_alerts.live == {}
+
+@pytest.mark.asyncio
+async def test_request_retries_server_errors(local_api_handler, twitch_server):
+    twitch_server.app["state"]["failures"] = 2
+    assert await local_api_handler.requests_get(local_api_handler.api_url + "flaky") == {"data": [{"id": "1"}]}
+    stats = local_api_handler.request_stats.report()
+    flaky = next(stats for stats in stats if stats["endpoint"] == "flaky")
+    assert flaky["requests"] == 3 and flaky["errors"] == 2 and flaky["retries"] == 2
+    assert flaky["statuses"] == {503: 2, 200: 1}
+
+
+@pytest.mark.asyncio
+async def test_request_retries_capped(local_api_handler, twitch_server):
+    twitch_server.app["state"]["failures"] = 10
+    with pytest.raises(TwitchAlert.TwitchAPIError) as err:
+        await local_api_handler.requests_get(local_api_handler.api_url + "flaky")
+    assert err.value.status == 503
+    assert len([path for path in twitch_server.app["state"]["requests"] if path == "/helix/flaky"]) == \
+           1 + TwitchAlert.MAX_RETRIES
+
+
+@pytest.mark.asyncio
+async def test_request_client_errors_not_retried(local_api_handler, twitch_server):
+    with pytest.raises(TwitchAlert.TwitchAPIError) as err:
+        await local_api_handler.requests_get(local_api_handler.api_url + "missing")
+    assert err.value.status == 404
+    assert local_api_handler.request_stats.report()[0]["retries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_request_unauthorized_refreshes_once(local_api_handler, twitch_server):
+    with pytest.raises(TwitchAlert.TwitchAPIError) as err:
+        await local_api_handler.requests_get(local_api_handler.api_url + "unauthorized")
+    assert err.value.status == 401
+    requests = twitch_server.app["state"]["requests"]
+    assert len([path for path in requests if path.startswith("/oauth2/token")]) == 1 + TwitchAlert.MAX_TOKEN_REFRESHES
+    assert len([path for path in requests if path == "/helix/unauthorized"]) == 1 + TwitchAlert.MAX_TOKEN_REFRESHES
+
+
+@pytest.mark.asyncio
+async def test_request_rate_limited(local_api_handler, twitch_server):
+    assert await local_api_handler.requests_get(local_api_handler.api_url + "limited") == {"data": []}
+    limited = next(stats for stats in local_api_handler.request_stats.report() if stats["endpoint"] == "limited")
+    assert limited["statuses"] == {429: 1, 200: 1} and limited["retries"] == 1
+    assert local_api_handler.rate_limiter.tokens <= 799
+
+
+@pytest.mark.asyncio
+async def test_token_single_flight(local_api_handler, twitch_server):
+    state = twitch_server.app["state"]
+    state["oauth_delay"] = 0.1
+    await asyncio.gather(*[local_api_handler.get_streams_data([f"user_{i}"]) for i in range(10)],
+                         local_api_handler.get_new_twitch_oauth())
+    assert len([path for path in state["requests"] if path.startswith("/oauth2/token")]) == 1
+    assert local_api_handler.token["access_token"] == "test_token_1"
+
+
+@pytest.mark.asyncio
+async def test_token_refreshed_in_background(local_api_handler, twitch_server):
+    state = twitch_server.app["state"]
+    await local_api_handler.get_streams_data(["monstercat"])
+    local_api_handler.token["expires_in"] = time.time() + TwitchAlert.TOKEN_REFRESH_MARGIN / 2
+    state["oauth_delay"] = 0.2
+    start = time.monotonic()
+    await local_api_handler.get_streams_data(["monstercat"])
+    assert time.monotonic() - start < 0.2
+    assert local_api_handler.token["access_token"] == "test_token_1"
+    await local_api_handler.token_manager.refresh_future
+    assert local_api_handler.token["access_token"] == "test_token_2"
+    assert local_api_handler.token["expires_in"] > time.time() + TwitchAlert.TOKEN_REFRESH_MARGIN
+
+
+@pytest.mark.asyncio
+async def test_token_refresh_backs_off(local_api_handler, twitch_server):
+    state = twitch_server.app["state"]
+    state["oauth_status"] = 500
+    for _ in range(3):
+        with pytest.raises(TwitchAlert.TwitchAPIError):
+            await local_api_handler.get_streams_data(["monstercat"]) or await local_api_handler.requests_get(
+                local_api_handler.api_url + "streams")
+    assert len([path for path in state["requests"] if path.startswith("/oauth2/token")]) == 1
+    assert local_api_handler.token_manager.failures == 1
+
+    state["oauth_status"] = 200
+    local_api_handler.token_manager.retry_at = 0
+    assert (await local_api_handler.get_streams_data(["monstercat"]))[0]["user_name"] == "monstercat"
+    assert local_api_handler.token_manager.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_token_concurrent_unauthorized(local_api_handler, twitch_server):
+    results = await asyncio.gather(*[local_api_handler.requests_get(local_api_handler.api_url + "unauthorized")
+                                     for _ in range(5)], return_exceptions=True)
+    assert all(isinstance(result, TwitchAlert.TwitchAPIError) for result in results)
+    requests = twitch_server.app["state"]["requests"]
+    assert len([path for path in requests if path.startswith("/oauth2/token")]) == 2
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_requests():
+    bucket = TwitchAlert.TokenBucket(capacity=5, period=0.5)
+    start = time.monotonic()
+    waits = [await bucket.acquire() for _ in range(10)]
+    assert time.monotonic() - start >= 0.4
+    assert waits[:5] == pytest.approx([0] * 5, abs=0.01)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_rate_limit_headers():
+    bucket = TwitchAlert.TokenBucket()
+    reset = int(time.time()) + 60
+    bucket.update({"Ratelimit-Limit": "100", "Ratelimit-Remaining": "0", "Ratelimit-Reset": str(reset)})
+    assert bucket.capacity == 100 and bucket.tokens == 0 and bucket.reset_at == reset
+    bucket.update({})
+    assert bucket.capacity == 100
+
+
+def test_twitch_stats_embed():
+    request_stats = TwitchAlert.RequestStats()
+    request_stats.record("streams", 200, 0.1)
+    request_stats.record("streams", 503, 0.3)
+    request_stats.record_retry("streams")
+    request_stats.record_throttle("streams", 2)
+    request_stats.record("users", 200, 0.1)
+    embed = TwitchAlert.twitch_stats_embed(request_stats.report(), {"runs": 2, "teams": 3, "failed": 1, "added": 4,
+                                                                     "removed": 5, "last_duration": 0.5,
+                                                                     "max_duration": 1.25})
+    assert embed.title == "Twitch request statistics"
+    assert [field.name for field in embed.fields] == ["Team rosters", "streams", "users"]
+    assert embed.fields[0].value == "2 syncs of 3 teams, 1 failed\n4 members added, 5 removed\nlast 0.5s, max 1.2s"
+    embed = TwitchAlert.twitch_stats_embed(request_stats.report())
+    assert embed.fields[0].value == "2 requests, 1 errors, 1 retries\n1 throttled for 2.0s, mean 200.0ms, max 300.0ms"
+    request_stats.reset()
+    assert request_stats.report() == []
+
+
+@pytest.mark.asyncio
+async def test_close_session(local_api_handler):
+    await local_api_handler.get_streams_data(["monstercat"])
+    session = local_api_handler.session
+    await local_api_handler.close()
+    assert session.closed and local_api_handler.session is None
+    await local_api_handler.get_streams_data(["monstercat"])
+    assert not local_api_handler.session.closed
+
+
+@pytest.mark.asyncio
+async def test_cog_unload_closes_session(twitch_cog):
+    session = twitch_cog.ta_database_manager.twitch_handler.get_session()
+    twitch_cog.cog_unload()
+    await asyncio.sleep(0.1)
+    assert session.closed
+    assert not twitch_cog.running
 
 
 @pytest.mark.asyncio
@@ -427,8 +1149,11 @@ async def test_get_team_users(twitch_api_handler):
 
 # Test TwitchAlertDBManager
 @pytest.fixture
-def twitch_alert_db_manager(twitch_cog):
-    return TwitchAlert.TwitchAlertDBManager(KoalaDBManager.KoalaDBManager(DB_PATH, KoalaBot.DB_KEY), twitch_cog.bot)
+async def twitch_alert_db_manager(twitch_cog):
+    twitch_alert_db_manager = TwitchAlert.TwitchAlertDBManager(KoalaDBManager.KoalaDBManager(DB_PATH, KoalaBot.DB_KEY),
+                                                               twitch_cog.bot)
+    yield twitch_alert_db_manager
+    await twitch_alert_db_manager.twitch_handler.close()
 
 
 @pytest.fixture
@@ -619,6 +1344,47 @@ async def test_delete_all_offline_streams(twitch_alert_db_manager_tables, bot: d
     pass
 
 
+@pytest.mark.asyncio()
+async def test_delete_all_offline_streams_chunked(twitch_alert_db_manager_tables, bot: discord.ext.commands.Bot):
+    channel = bot.guilds[0].channels[0]
+    database_manager = twitch_alert_db_manager_tables.get_parent_database_manager()
+    database_manager.db_execute_commit("DELETE FROM UserInTwitchAlert")
+    message_ids = [(await dpytest.message(f"test_msg {i}", channel)).id for i in range(3)]
+    database_manager.db_execute_many("INSERT INTO UserInTwitchAlert(channel_id, twitch_username, message_id) "
+                                     "VALUES (?, ?, ?)", [(channel.id, f"offline_{i}", message_id)
+                                                          for i, message_id in enumerate(message_ids)])
+    usernames = [f"offline_{i}" for i in range(1500)]
+
+    with mock.patch.object(discord.TextChannel, "permissions_for",
+                           mock.MagicMock(return_value=discord.Permissions(manage_messages=True))), \
+            mock.patch.object(discord.TextChannel, "delete_messages", mock.AsyncMock()) as delete_messages:
+        await twitch_alert_db_manager_tables.delete_all_offline_streams(False, usernames)
+    delete_messages.assert_called_once()
+    assert sorted(message.id for message in delete_messages.call_args[0][0]) == sorted(message_ids)
+    assert database_manager.db_execute_select("SELECT message_id FROM UserInTwitchAlert") == [(None,)] * 3
+
+
+@pytest.mark.asyncio()
+async def test_delete_all_offline_streams_without_bulk(twitch_alert_db_manager_tables,
+                                                       bot: discord.ext.commands.Bot):
+    channel = bot.guilds[0].channels[0]
+    database_manager = twitch_alert_db_manager_tables.get_parent_database_manager()
+    database_manager.db_execute_commit("DELETE FROM UserInTwitchAlert")
+    message_ids = [(await dpytest.message(f"test_msg {i}", channel)).id for i in range(2)]
+    database_manager.db_execute_many("INSERT INTO UserInTwitchAlert(channel_id, twitch_username, message_id) "
+                                     "VALUES (?, ?, ?)", [(channel.id, f"offline_{i}", message_id)
+                                                          for i, message_id in enumerate(message_ids)])
+
+    with mock.patch.object(discord.TextChannel, "permissions_for",
+                           mock.MagicMock(return_value=discord.Permissions(manage_messages=False))), \
+            mock.patch.object(discord.TextChannel, "delete_messages", mock.AsyncMock()) as delete_messages:
+        await twitch_alert_db_manager_tables.delete_all_offline_streams(False, ["offline_0", "offline_1"])
+    delete_messages.assert_not_called()
+    for message_id in message_ids:
+        with pytest.raises(discord.errors.NotFound):
+            await channel.fetch_message(message_id)
+    assert database_manager.db_execute_select("SELECT message_id FROM UserInTwitchAlert") == [(None,)] * 2
+
 @pytest.mark.asyncio()
 async def test_delete_all_offline_streams_team(twitch_alert_db_manager_tables, bot: discord.ext.commands.Bot):
     await test_update_all_teams_members(twitch_alert_db_manager_tables)
@@ -219,6 +219,33 @@ def test_votemanager_cancel_sent_vote():
     assert not in_db
 
 
+
+def test_votemanager_remove_sent_vote_keeps_db():
+    populate_vote_tables()
+    vote_manager.load_from_db()
+    vote = vote_manager.remove_sent_vote(111)
+    assert 111 not in vote_manager.sent_votes.keys()
+    assert (vote.author, vote.title) not in vote_manager.vote_lookup.keys()
+    assert db_manager.db_execute_select("SELECT * FROM Votes WHERE vote_id=?", (111,))
+    vote_manager.delete_vote(111)
+    assert not db_manager.db_execute_select("SELECT * FROM Votes WHERE vote_id=?", (111,))
+
+def test_votemanager_cancel_vote_error_rolls_back():
+    populate_vote_tables()
+    vote_manager.load_from_db()
+    db_execute_commit = db_manager.db_execute_commit
+
+    def fail_on_options(sql_str, args=None, pass_errors=False):
+        if "VoteOptions" in sql_str:
+            raise KoalaDBManager.sqlite3.OperationalError("database is locked")
+        return db_execute_commit(sql_str, args, pass_errors)
+
+    with mock.patch.object(db_manager, "db_execute_commit", side_effect=fail_on_options):
+        with pytest.raises(KoalaDBManager.sqlite3.OperationalError):
+            vote_manager.cancel_sent_vote(111)
+    assert db_manager.db_execute_select("SELECT * FROM Votes WHERE vote_id=?", (111,))
+    assert db_manager.db_execute_select("SELECT * FROM VoteTargetRoles WHERE vote_id=?", (111,))
+
 def test_votemanager_cancel_configuring_vote():
     populate_vote_tables()
     vote_manager.load_from_db()
@@ -308,6 +335,16 @@ def test_vote_register_sent():
     assert in_db
 
 
+def test_vote_save_sent():
+    vote = vote_manager.create_vote(111, 222, "Save Sent Test")
+    vote.register_sent(555, 777, save=False)
+    vote.register_sent(556, 778, save=False)
+    assert not db_manager.db_execute_select("SELECT * FROM VoteSent WHERE vote_id=?", (vote.id,))
+    vote.save_sent()
+    vote.save_sent()
+    assert len(db_manager.db_execute_select("SELECT * FROM VoteSent WHERE vote_id=?", (vote.id,))) == 2
+
+
 def test_two_way():
     def test_asserts(f, *args, **kwargs):
         try:
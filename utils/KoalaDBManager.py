@@ -8,7 +8,17 @@ Commented using reStructuredText (reST)
 # Futures
 
 # Built-in/Generic Imports
+import asyncio
+import atexit
+import logging
 import os
+import queue
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Libs
 from dotenv import load_dotenv
@@ -27,139 +37,1032 @@ else:
 
 
 # Constants
+DEFAULT_POOL_SIZE = 5  # Maximum number of read-only connections a KoalaDBManager keeps open
+POOL_TIMEOUT = 30  # Seconds to wait for a free connection when the pool is exhausted
+HEALTH_CHECK_INTERVAL = 60  # Seconds a connection can sit idle before it is checked on checkout
+DB_THREAD_NAME = "KoalaDB"
+SLOW_QUEUE_WAIT = 1  # Seconds a queued database job can wait before a backpressure warning is logged
+# PRAGMAs applied to every new connection. SQLCipher ignores mmap_size for encrypted databases
+DEFAULT_ENGINE_PROFILE = {"journal_mode": "WAL",
+                          "synchronous": "NORMAL",
+                          "mmap_size": 64 * 1024 * 1024,
+                          "cache_size": -16 * 1024,  # Negative values are KiB rather than pages
+                          "temp_store": "MEMORY"}
+CHECKPOINT_INTERVAL = 30  # Seconds between checks of whether the WAL should be checkpointed
+CHECKPOINT_IDLE_TIME = 5  # Seconds without a write before the database is considered idle
+CHECKPOINT_MODE = "PASSIVE"
+BACKUP_PAGES_PER_STEP = 256  # Pages copied by each step of an online backup
+BACKUP_STEP_SLEEP = 0.01  # Seconds an online backup yields to other connections between steps
+SLOW_QUERY_THRESHOLD = 0.1  # Seconds a statement can take before it is written to the slow query log
+SLOW_QUERY_LOG_SIZE = 50  # Number of recent slow queries kept for query_report
+LATENCY_SAMPLE_SIZE = 1000  # Number of recent latencies kept per fingerprint for percentiles
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, float("inf"))  # Upper bounds (s) of the histogram buckets
+SELECT_BATCH_SIZE = 500  # Rows fetched at a time when streaming the results of a select
+BASE_COMPONENT = "Base"
+BASE_TABLES = ["""
+        CREATE TABLE IF NOT EXISTS GuildWelcomeMessages (
+        guild_id integer NOT NULL PRIMARY KEY,
+        welcome_message text
+        );""",
+               """
+        CREATE TABLE IF NOT EXISTS KoalaExtensions (
+        extension_id text NOT NULL PRIMARY KEY,
+        subscription_required integer NOT NULL,
+        available boolean NOT NULL,
+        enabled boolean NOT NULL
+        );""",
+               """
+        CREATE TABLE IF NOT EXISTS GuildExtensions (
+        extension_id text NOT NULL,
+        guild_id integer NOT NULL,
+        PRIMARY KEY (extension_id,guild_id),
+        CONSTRAINT fk_extensions
+            FOREIGN KEY (extension_id) 
+            REFERENCES KoalaExtensions (extension_id)
+            ON DELETE CASCADE 
+        );"""]
+DROP_TABLE_PATTERN = re.compile(r"^\s*DROP\s+TABLE", re.IGNORECASE)
+
 # Variables
 
 
+def row_type(name, columns):
+    """
+    Creates a namedtuple type for the rows of a select of the given columns. Namedtuples have empty __slots__, so the
+    rows are no bigger than plain tuples, but can be read by column name. The projected columns, joined ready to be
+    used in a SELECT statement, are available as the columns attribute of the type
+
+    :param name: The name of the row type
+    :param columns: The selected columns, which can be qualified by their table, e.g. "TA.guild_id"
+    :return: The row type
+    """
+    row = namedtuple(name, [column.split(".")[-1] for column in columns])
+    row.columns = ", ".join(columns)
+    return row
+
+
+class ConnectionPool:
+    """
+    A bounded pool of open database connections, so the cost of opening (and keying) a connection is paid once
+    rather than on every query
+    """
+
+    def __init__(self, connect, max_size=DEFAULT_POOL_SIZE, timeout=POOL_TIMEOUT,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        """
+        Initialises local variables
+
+        :param connect: A function returning a new connection that is ready to be used
+        :param max_size: The maximum number of connections that can be open at once
+        :param timeout: Seconds to wait for a connection to be released when all are in use
+        :param health_check_interval: Seconds a connection can be idle before it is checked before reuse
+        """
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.closed = False
+
+    def acquire(self):
+        """
+        Takes a connection from the pool, opening a new one if no healthy idle connection is available
+
+        :return: A connection object
+        :raises: TimeoutError if every connection is in use for longer than the pool timeout
+        """
+        if self.closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed connection pool.")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No database connection was released within {self.timeout}s")
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < self.health_check_interval or self.is_healthy(conn):
+                    return conn
+                self._close_connection(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        """
+        Returns a connection to the pool
+
+        :param conn: The connection taken from acquire
+        :param discard: True if the connection should be closed instead of reused
+        """
+        try:
+            if discard or self.closed:
+                self._close_connection(conn)
+            else:
+                if getattr(conn, "in_transaction", False):
+                    conn.rollback()
+                self._idle.put((conn, time.monotonic()))
+        except Exception as e:
+            print(e)
+            self._close_connection(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the duration of a with block
+
+        :return: A connection object
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @staticmethod
+    def is_healthy(conn):
+        """
+        Checks a connection can still run a query
+
+        :param conn: The connection to check
+        :return: True if the connection is usable
+        """
+        try:
+            conn.execute("SELECT 1").fetchall()
+            return True
+        except Exception:
+            return False
+
+    def idle_count(self):
+        """
+        :return: The number of open connections currently waiting in the pool
+        """
+        return self._idle.qsize()
+
+    def close(self):
+        """
+        Closes all idle connections, connections still in use are closed as they are released
+        """
+        self.closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close_connection(conn)
+
+    @staticmethod
+    def _close_connection(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            print(e)
+
+
+def fingerprint(sql_str):
+    """ Normalises an SQL statement so that statements which only differ in their literals, placeholder counts
+    or whitespace are counted together
+
+    :param sql_str: An SQL statement
+    :return: The fingerprint of the statement
+    """
+    sql_str = re.sub(r"'(?:[^']|'')*'", "?", sql_str)
+    sql_str = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql_str)
+    sql_str = re.sub(r"\s+", " ", sql_str).strip().rstrip(";").strip()
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(...)", sql_str)
+
+
+def percentile(samples, p):
+    """ Gets a percentile of a sorted list of samples
+
+    :param samples: Sorted list of samples
+    :param p: The percentile to get, e.g. 99
+    :return: The sample at the percentile, or 0 if there are no samples
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class QueryStats:
+    """
+    Call counts, rows and latency distributions of the statements run through a KoalaDBManager, grouped by fingerprint
+    """
+
+    def __init__(self, slow_query_threshold=SLOW_QUERY_THRESHOLD, sample_size=LATENCY_SAMPLE_SIZE):
+        """
+        Initialises local variables
+
+        :param slow_query_threshold: Seconds a statement can take before it is logged as a slow query
+        :param sample_size: Number of recent latencies kept per fingerprint for the percentiles
+        """
+        self.slow_query_threshold = slow_query_threshold
+        self.sample_size = sample_size
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql_str, elapsed, rows, error=False):
+        """ Records a run of a statement
+
+        :param sql_str: The SQL statement that was run
+        :param elapsed: Seconds the statement took
+        :param rows: Number of rows returned or changed
+        :param error: True if the statement raised an error
+        :return: True if the statement is slow
+        """
+        key = fingerprint(sql_str)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {"calls": 0, "errors": 0, "rows": 0, "total_time": 0.0, "max_time": 0.0,
+                                            "samples": deque(maxlen=self.sample_size),
+                                            "histogram": [0] * len(LATENCY_BUCKETS)}
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["rows"] += max(rows, 0)
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+            stats["samples"].append(elapsed)
+            stats["histogram"][next(i for i, bound in enumerate(LATENCY_BUCKETS) if elapsed <= bound)] += 1
+        return elapsed >= self.slow_query_threshold
+
+    def log_slow_query(self, sql_str, args, elapsed, plan):
+        """ Adds a statement to the slow query log
+
+        :param sql_str: The SQL statement that was run
+        :param args: The args passed with the statement
+        :param elapsed: Seconds the statement took
+        :param plan: The details of the query plan of the statement
+        """
+        self.slow_queries.append({"fingerprint": fingerprint(sql_str), "args": args, "time": elapsed, "plan": plan})
+        logging.warning(f"KoalaDBManager: Slow query ({elapsed * 1000:.1f}ms): {fingerprint(sql_str)} "
+                        f"| Plan: {'; '.join(plan) if plan else 'unavailable'}")
+
+    def report(self):
+        """ Gets the statistics of each fingerprint, slowest in total first
+
+        :return: List of dicts of the fingerprint, calls, errors, rows, total/mean/p50/p95/p99/max time (s) and the
+        histogram of calls in each of LATENCY_BUCKETS
+        """
+        with self._lock:
+            items = [(key, dict(stats, samples=sorted(stats["samples"]), histogram=list(stats["histogram"])))
+                     for key, stats in self._stats.items()]
+        report = []
+        for key, stats in items:
+            samples = stats.pop("samples")
+            report.append(dict(stats, fingerprint=key,
+                               mean_time=stats["total_time"] / stats["calls"],
+                               p50=percentile(samples, 50),
+                               p95=percentile(samples, 95),
+                               p99=percentile(samples, 99)))
+        return sorted(report, key=lambda stats: stats["total_time"], reverse=True)
+
+    def reset(self):
+        """ Clears all recorded statistics and the slow query log
+        """
+        with self._lock:
+            self._stats.clear()
+            self.slow_queries.clear()
+
+
 class KoalaDBManager:
 
-    def __init__(self, db_file_path, db_secret_key):
+    def __init__(self, db_file_path, db_secret_key, pool_size=DEFAULT_POOL_SIZE, engine_profile=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, checkpoint_idle_time=CHECKPOINT_IDLE_TIME, instrument=False,
+                 slow_query_threshold=SLOW_QUERY_THRESHOLD):
         self.db_file_path = db_file_path
         if os.name == 'nt' or not ENCRYPTED_DB:
             self.db_file_path = "windows_" + self.db_file_path
         self.db_secret_key = db_secret_key
+        self.engine_profile = DEFAULT_ENGINE_PROFILE if engine_profile is None else engine_profile
+        # A single writer serialises all writes, while selects run in parallel on the read-only connections
+        self.pool = ConnectionPool(self.open_connection, max_size=1)
+        self.reader_pool = ConnectionPool(self.open_read_connection, max_size=pool_size) if pool_size else None
+        self._local = threading.local()
+        self.query_stats = QueryStats(slow_query_threshold) if instrument else None
+        self._guild_extensions = None
+        # Bumped whenever the cached extensions change, so a load that raced a change doesn't replace it
+        self._guild_extensions_version = 0
+        self._guild_extensions_lock = threading.Lock()
+        # Registered schemas and extensions, and the ones that have been created in this process
+        self._schemas = {BASE_COMPONENT: (BASE_TABLES, [])}
+        self._extensions = {}
+        self._bootstrapped = set()
+        self._bootstrapped_extensions = {}
+        self._bootstrap_lock = threading.RLock()
+        self.bootstrap_timings = []
+        self._executor = None
+        self._reader_executor = None
+        self._queue_lock = threading.Lock()
+        self._queue_depth = 0
+        self._queue_jobs = 0
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+        self._queue_wait_last = 0.0
+        self._last_write = None
+        self._last_checkpoint = None
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_idle_time = checkpoint_idle_time
+        self._checkpoint_stop = threading.Event()
+        self._checkpoint_thread = None
+        if str(self.engine_profile.get("journal_mode", "")).upper() == "WAL":
+            # The write-ahead log is only merged and removed once the last connection is closed
+            atexit.register(self.close)
+            if checkpoint_interval:
+                self.start_checkpoint_scheduler()
+
+    def open_connection(self):
+        """ Open and key a new connection to the SQLite3 database specified in db_file_path, and apply the
+        engine profile to it
+
+        :return: Connection object
+        """
+        conn = self.connect(self.db_file_path)
+        for pragma, value in self.engine_profile.items():
+            conn.execute(f"PRAGMA {pragma} = {value}").fetchall()
+        return conn
+
+    def connect(self, db_file_path):
+        """ Open and key a new connection to a database file, without applying the engine profile
+
+        :param db_file_path: The path of the database file
+        :return: Connection object
+        """
+        conn = sqlite3.connect(db_file_path, check_same_thread=False)
+        if not (os.name == 'nt' or not ENCRYPTED_DB):
+            conn.execute('''PRAGMA key="x'{}'"'''.format(self.db_secret_key))
+        return conn
+
+    def open_read_connection(self):
+        """ Open a new connection like open_connection, which can only be used to read from the database
+
+        :return: Connection object
+        """
+        conn = self.open_connection()
+        conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def backup(self, dest, pages_per_step=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP, progress=None):
+        """ Copies the database to dest while it is in use, using the SQLite online backup interface.
+        The backup is copied a few pages at a time, sleeping between steps so other connections can keep reading and
+        writing. An encrypted database is backed up with the same key. If the SQLCipher build doesn't have the backup
+        interface the database is exported with sqlcipher_export in a single step instead
+
+        :param dest: The path of the backup file, which is overwritten
+        :param pages_per_step: The number of pages to copy in each step, or -1 to copy everything in one step
+        :param sleep: Seconds to sleep between steps
+        :param progress: Optional function called with (status, remaining, total) pages after each step
+        :return: The path of the backup file
+        """
+        start = time.time()
+        for suffix in ["", "-wal", "-shm", "-journal"]:
+            if os.path.exists(dest + suffix):
+                os.remove(dest + suffix)
+        src = self.connect(self.db_file_path)
+        try:
+            if hasattr(src, "backup"):
+                dst = self.connect(dest)
+                try:
+                    src.backup(dst, pages=pages_per_step, progress=progress, sleep=sleep)
+                finally:
+                    dst.close()
+            else:
+                src.execute('''ATTACH DATABASE ? AS backup KEY "x'{}'"'''.format(self.db_secret_key), [dest])
+                src.execute("SELECT sqlcipher_export('backup')").fetchall()
+                src.execute("DETACH DATABASE backup")
+        finally:
+            src.close()
+        logging.info(f"KoalaDBManager: Backed up {self.db_file_path} to {dest} in {time.time() - start:.2f}s")
+        return dest
+
+    async def run_backup(self, dest, pages_per_step=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP):
+        """ Runs backup in a background thread, so neither the event loop nor the database thread waits for it
+
+        :param dest: The path of the backup file, which is overwritten
+        :param pages_per_step: The number of pages to copy in each step
+        :param sleep: Seconds to sleep between steps
+        :return: The path of the backup file
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, self.backup, dest, pages_per_step, sleep)
+
+    def restore(self, src):
+        """ Replaces the contents of the database with a backup made by backup.
+        The writer connection is held for the whole restore, so no writes are lost part way through
+
+        :param src: The path of the backup file
+        """
+        if not os.path.exists(src):
+            raise FileNotFoundError(f"Backup {src} does not exist")
+        backup = self.connect(src)
+        try:
+            with self.pool.connection() as conn:
+                if hasattr(backup, "backup"):
+                    backup.backup(conn)
+                else:
+                    tables = conn.execute("SELECT name FROM sqlite_master "
+                                          "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+                    conn.execute("PRAGMA foreign_keys = OFF")
+                    for table in tables:
+                        conn.execute(f'DROP TABLE IF EXISTS "{table[0]}"')
+                    conn.execute('''ATTACH DATABASE ? AS backup KEY "x'{}'"'''.format(self.db_secret_key), [src])
+                    conn.execute("SELECT sqlcipher_export('main', 'backup')").fetchall()
+                    conn.execute("DETACH DATABASE backup")
+                    conn.commit()
+        finally:
+            backup.close()
+        self.reset_bootstrap()
+        with self._guild_extensions_lock:
+            self._guild_extensions = None
+            self._guild_extensions_version += 1
+        logging.info(f"KoalaDBManager: Restored {self.db_file_path} from {src}")
+
+    def start_checkpoint_scheduler(self):
+        """ Starts a background thread which checkpoints the write-ahead log whenever the database is idle
+        """
+        if self._checkpoint_thread is None:
+            self._checkpoint_stop.clear()
+            self._checkpoint_thread = threading.Thread(target=self._checkpoint_loop, name=DB_THREAD_NAME + "Checkpoint",
+                                                       daemon=True)
+            self._checkpoint_thread.start()
+
+    def stop_checkpoint_scheduler(self):
+        """ Stops the checkpoint thread started by start_checkpoint_scheduler
+        """
+        if self._checkpoint_thread is not None:
+            self._checkpoint_stop.set()
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+
+    def _checkpoint_loop(self):
+        while not self._checkpoint_stop.wait(self.checkpoint_interval):
+            if self.is_idle():
+                self.checkpoint()
+
+    def is_idle(self):
+        """ Checks if there have been writes since the last checkpoint, and none within the idle time
+
+        :return: True if the write-ahead log should be checkpointed
+        """
+        last_write = self._last_write
+        if last_write is None or (self._last_checkpoint is not None and self._last_checkpoint >= last_write):
+            return False
+        return time.monotonic() - last_write >= self.checkpoint_idle_time
+
+    def checkpoint(self, mode=CHECKPOINT_MODE):
+        """ Copies the write-ahead log back into the database file
+
+        :param mode: The checkpoint mode, PASSIVE, FULL, RESTART or TRUNCATE
+        :return: (busy, wal pages, checkpointed pages) as returned by PRAGMA wal_checkpoint, or None on error
+        """
+        try:
+            started = time.monotonic()
+            with self.pool.connection() as conn:
+                result = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            self._last_checkpoint = started
+            return result
+        except Exception as e:
+            print(e)
 
     def create_connection(self):
         """ Create a database connection to the SQLite3 database specified in db_file_path
+        This connection is not pooled, and must be closed by the caller
 
         :return: Connection object or None
         """
         conn = None
         try:
-            conn = sqlite3.connect(self.db_file_path)
+            conn = self.open_connection()
             c = conn.cursor()
-            if not (os.name == 'nt' or not ENCRYPTED_DB):
-                c.execute('''PRAGMA key="x'{}'"'''.format(self.db_secret_key))
-
             return conn, c
         except Exception as e:
             print(e)
 
         return conn
 
-    def db_execute_select(self, sql_str, args=None, pass_errors=False):
+    def close(self):
+        """ Close all pooled connections to the database, after any queued async database jobs are finished
+        """
+        self.stop_checkpoint_scheduler()
+        for executor in [self._executor, self._reader_executor]:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._executor = None
+        self._reader_executor = None
+        self.pool.close()
+        if self.reader_pool is not None:
+            self.reader_pool.close()
+
+    def get_executor(self):
+        """ Gets the executor of the dedicated database thread, creating it if required
+
+        :return: The ThreadPoolExecutor used by the awaitable database methods
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=DB_THREAD_NAME)
+        return self._executor
+
+    def get_reader_executor(self):
+        """ Gets the executor of the database reader threads, one per read-only connection, creating it if required
+
+        :return: The ThreadPoolExecutor used by the awaitable read-only database methods
+        """
+        if self.reader_pool is None:
+            return self.get_executor()
+        if self._reader_executor is None:
+            self._reader_executor = ThreadPoolExecutor(max_workers=self.reader_pool.max_size,
+                                                       thread_name_prefix=DB_THREAD_NAME + "Reader")
+        return self._reader_executor
+
+    async def run(self, func, *args, **kwargs):
+        """ Run a blocking database function on the database thread, without blocking the event loop
+
+        :param func: The function to run, e.g. a method of a cog's database manager
+        :param args: Positional arguments to pass to func
+        :param kwargs: Keyword arguments to pass to func
+        :return: The result of func
+        """
+        return await self._submit(self.get_executor(), func, *args, **kwargs)
+
+    async def run_read(self, func, *args, **kwargs):
+        """ Run a blocking database function which only reads from the database on a reader thread, so it can run
+        in parallel with other reads and the writes on the database thread
+
+        :param func: The function to run, e.g. a method of a cog's database manager
+        :param args: Positional arguments to pass to func
+        :param kwargs: Keyword arguments to pass to func
+        :return: The result of func
+        """
+        return await self._submit(self.get_reader_executor(), func, *args, **kwargs)
+
+    async def _submit(self, executor, func, *args, **kwargs):
+        submitted = time.monotonic()
+        queued = [True]
+        with self._queue_lock:
+            self._queue_depth += 1
+
+        def job():
+            self._record_queue_wait(queued, time.monotonic() - submitted)
+            return func(*args, **kwargs)
+
+        try:
+            return await asyncio.get_event_loop().run_in_executor(executor, job)
+        finally:
+            # A job cancelled (or rejected) before it started never leaves the queue by itself
+            with self._queue_lock:
+                if queued[0]:
+                    queued[0] = False
+                    self._queue_depth -= 1
+
+    async def select(self, sql_str, args=None, pass_errors=False, row=None):
+        """ Awaitable version of db_execute_select, run on a reader thread
+
+        :param sql_str: An SQL SELECT statement
+        :param args: Additional args to pass with the sql statement
+        :param pass_errors: Raise errors that are raised by this query
+        :param row: A type made by row_type to map the results to
+        :return: The results of the query
+        """
+        return await self.run_read(self.db_execute_select, sql_str, args, pass_errors, row)
+
+    async def commit(self, sql_str, args=None, pass_errors=False):
+        """ Awaitable version of db_execute_commit, run on the database thread
+
+        :param sql_str: An SQL transaction
+        :param args: Additional args to pass with the sql statement
+        :param pass_errors: Raise errors that are raised by this query
+        :return: void
+        """
+        return await self.run(self.db_execute_commit, sql_str, args, pass_errors)
+
+    async def execute_many(self, sql_str, rows, pass_errors=False):
+        """ Awaitable version of db_execute_many, run on the database thread
+
+        :param sql_str: An SQL statement
+        :param rows: An iterable of args to pass with each execution of the sql statement
+        :param pass_errors: Raise errors that are raised by this query
+        :return: void
+        """
+        return await self.run(self.db_execute_many, sql_str, rows, pass_errors)
+
+    def _record_queue_wait(self, queued, wait):
+        with self._queue_lock:
+            if not queued[0]:
+                return
+            queued[0] = False
+            self._queue_depth -= 1
+            self._queue_jobs += 1
+            self._queue_wait_total += wait
+            self._queue_wait_last = wait
+            self._queue_wait_max = max(self._queue_wait_max, wait)
+            depth = self._queue_depth
+        if wait > SLOW_QUEUE_WAIT:
+            logging.warning(f"KoalaDBManager: Database job waited {wait:.3f}s in the queue, {depth} still queued")
+
+    def queue_stats(self):
+        """ Gets the backpressure statistics of the database threads
+
+        :return: dict of the current queue depth, jobs run, and the last, mean and max time (s) jobs waited to start
+        """
+        with self._queue_lock:
+            return {"queue_depth": self._queue_depth,
+                    "jobs": self._queue_jobs,
+                    "last_wait": self._queue_wait_last,
+                    "mean_wait": self._queue_wait_total / self._queue_jobs if self._queue_jobs else 0.0,
+                    "max_wait": self._queue_wait_max}
+
+    def in_transaction(self):
+        """ Checks if the current thread is inside a transaction block
+
+        :return: True if queries on this thread are part of a transaction
+        """
+        return getattr(self._local, "conn", None) is not None
+
+    @contextmanager
+    def transaction(self):
+        """ Groups the queries run on this thread inside the with block into a single atomic transaction.
+        Statements are committed together when the block exits, or all rolled back if an error is raised.
+        Errors raised by queries inside a transaction are always passed on. Nested blocks join the outer transaction.
+
+        :return: The connection the transaction is running on
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with self.pool.connection() as conn:
+            self._local.conn = conn
+            try:
+                # Begin explicitly, so table and index changes are also part of the transaction
+                conn.execute("BEGIN")
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.conn = None
+
+    @contextmanager
+    def get_connection(self, read_only=False):
+        """ Borrows the connection of this thread's transaction, or a pooled connection if there is no transaction
+
+        :param read_only: True to borrow a read-only connection, which doesn't wait for the writer
+        :return: A connection object
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+        else:
+            pool = self.reader_pool if read_only and self.reader_pool is not None else self.pool
+            with pool.connection() as conn:
+                yield conn
+
+    def enable_instrumentation(self, slow_query_threshold=SLOW_QUERY_THRESHOLD):
+        """ Starts recording statistics of every statement run through this manager
+
+        :param slow_query_threshold: Seconds a statement can take before it is logged as a slow query
+        """
+        if self.query_stats is None:
+            self.query_stats = QueryStats(slow_query_threshold)
+        else:
+            self.query_stats.slow_query_threshold = slow_query_threshold
+
+    def disable_instrumentation(self):
+        """ Stops recording statement statistics, and discards those recorded
+        """
+        self.query_stats = None
+
+    def query_report(self):
+        """ Gets the recorded statement statistics
+
+        :return: dict of the per fingerprint statistics ("queries", see QueryStats.report) and recent "slow_queries",
+        or None if instrumentation is disabled
+        """
+        query_stats = self.query_stats
+        if query_stats is None:
+            return None
+        return {"queries": query_stats.report(), "slow_queries": list(query_stats.slow_queries)}
+
+    def _record_query(self, conn, sql_str, args, started, rows, error=False):
+        query_stats = self.query_stats
+        if query_stats is None:
+            return
+        elapsed = time.perf_counter() - started
+        if query_stats.record(sql_str, elapsed, rows, error):
+            query_stats.log_slow_query(sql_str, args, elapsed, self._explain(conn, sql_str, args))
+
+    @staticmethod
+    def _explain(conn, sql_str, args):
+        if conn is None:
+            return None
+        try:
+            return [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql_str, args or []).fetchall()]
+        except Exception:
+            return None
+
+    def db_execute_select(self, sql_str, args=None, pass_errors=False, row=None):
         """ Execute an SQL selection with the connection stored in this object
 
         :param sql_str: An SQL SELECT statement
         :param args: Additional args to pass with the sql statement
         :param pass_errors: Raise errors that are raised by this query
+        :param row: A type made by row_type to map the results to, rather than returning plain tuples
         :return:
         """
+        started = time.perf_counter()
         try:
-            conn, c = self.create_connection()
-            if args:
-                c.execute(sql_str, args)
-            else:
-                c.execute(sql_str)
-            results = c.fetchall()
-            c.close()
-            conn.close()
+            with self.get_connection(read_only=True) as conn:
+                c = conn.cursor()
+                if args:
+                    c.execute(sql_str, args)
+                else:
+                    c.execute(sql_str)
+                results = c.fetchall()
+                c.close()
+                self._record_query(conn, sql_str, args, started, len(results))
+            if row is not None:
+                results = list(map(row._make, results))
             return results
         except Exception as e:
-            if pass_errors:
+            self._record_query(None, sql_str, args, started, 0, error=True)
+            if pass_errors or self.in_transaction():
+                raise e
+            else:
+                print(e)
+
+    def db_execute_select_iter(self, sql_str, args=None, pass_errors=False, row=None, batch_size=SELECT_BATCH_SIZE):
+        """ Execute an SQL selection, yielding the results a batch at a time rather than fetching them all at once.
+        A read-only connection is held until the results are exhausted or the generator is closed
+
+        :param sql_str: An SQL SELECT statement
+        :param args: Additional args to pass with the sql statement
+        :param pass_errors: Raise errors that are raised by this query
+        :param row: A type made by row_type to map the results to, rather than yielding plain tuples
+        :param batch_size: The number of rows to fetch at a time
+        :return: A generator of the results
+        """
+        started = time.perf_counter()
+        count = 0
+        try:
+            with self.get_connection(read_only=True) as conn:
+                c = conn.cursor()
+                try:
+                    if args:
+                        c.execute(sql_str, args)
+                    else:
+                        c.execute(sql_str)
+                    while True:
+                        results = c.fetchmany(batch_size)
+                        if not results:
+                            break
+                        count += len(results)
+                        if row is not None:
+                            yield from map(row._make, results)
+                        else:
+                            yield from results
+                finally:
+                    c.close()
+                self._record_query(conn, sql_str, args, started, count)
+        except Exception as e:
+            self._record_query(None, sql_str, args, started, count, error=True)
+            if pass_errors or self.in_transaction():
                 raise e
             else:
                 print(e)
 
     def db_execute_commit(self, sql_str, args=None, pass_errors=False):
-        """ Execute an SQL transaction with the connection stored in this object
+        """ Execute an SQL transaction with the connection stored in this object.
+        Inside a transaction block the statement is committed when the block exits.
 
         :param sql_str: An SQL transaction
         :param args: Additional args to pass with the sql statement
         :param pass_errors: Raise errors that are raised by this query
-        :return: void
+        :return: The number of rows changed by the statement
         """
+        started = time.perf_counter()
         try:
-            conn, c = self.create_connection()
-            if args:
-                c.execute(sql_str, args)
+            with self.get_connection() as conn:
+                c = conn.cursor()
+                if args:
+                    c.execute(sql_str, args)
+                else:
+                    c.execute(sql_str)
+                if not self.in_transaction():
+                    conn.commit()
+                c.close()
+                self._record_query(conn, sql_str, args, started, c.rowcount)
+            self._last_write = time.monotonic()
+            if DROP_TABLE_PATTERN.match(sql_str):
+                self.reset_bootstrap()
+            return c.rowcount
+        except Exception as e:
+            self._record_query(None, sql_str, args, started, 0, error=True)
+            if pass_errors or self.in_transaction():
+                raise e
             else:
-                c.execute(sql_str)
-            conn.commit()
-            c.close()
-            conn.close()
+                print(e)
+
+    def db_execute_many(self, sql_str, rows, pass_errors=False):
+        """ Execute an SQL statement once for every row of args, committed as a single transaction
+
+        :param sql_str: An SQL statement
+        :param rows: An iterable of args to pass with each execution of the sql statement
+        :param pass_errors: Raise errors that are raised by this query
+        :return: void
+        """
+        started = time.perf_counter()
+        try:
+            with self.transaction() as conn:
+                c = conn.cursor()
+                c.executemany(sql_str, rows)
+                c.close()
+                self._record_query(conn, sql_str, None, started, c.rowcount)
+            self._last_write = time.monotonic()
         except Exception as e:
-            if pass_errors:
+            self._record_query(None, sql_str, None, started, 0, error=True)
+            if pass_errors or self.in_transaction():
                 raise e
             else:
                 print(e)
 
-    def create_base_tables(self):
-        sql_create_koala_extensions_table = """
-        CREATE TABLE IF NOT EXISTS KoalaExtensions (
-        extension_id text NOT NULL PRIMARY KEY,
-        subscription_required integer NOT NULL,
-        available boolean NOT NULL,
-        enabled boolean NOT NULL
-        );"""
+    def get_schema_version(self, component):
+        """ Gets the schema version of a component, i.e. the number of its migrations that have been applied
 
-        sql_create_guild_extensions_table = """
-        CREATE TABLE IF NOT EXISTS GuildExtensions (
-        extension_id text NOT NULL,
-        guild_id integer NOT NULL,
-        PRIMARY KEY (extension_id,guild_id),
-        CONSTRAINT fk_extensions
-            FOREIGN KEY (extension_id) 
-            REFERENCES KoalaExtensions (extension_id)
-            ON DELETE CASCADE 
-        );"""
+        :param component: The name of the component, e.g. the name of a cog
+        :return: The schema version, 0 if no migrations have been applied
+        """
+        self.db_execute_commit("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+        component text NOT NULL PRIMARY KEY,
+        version integer NOT NULL
+        );""")
+        result = self.db_execute_select("SELECT version FROM schema_version WHERE component = ?", args=[component])
+        return result[0][0] if result else 0
 
-        sql_create_guild_welcome_messages_table = """
-        CREATE TABLE IF NOT EXISTS GuildWelcomeMessages (
-        guild_id integer NOT NULL PRIMARY KEY,
-        welcome_message text
-        );"""
+    def migrate(self, component, migrations):
+        """ Applies the migrations of a component that haven't already been applied, in order.
+        Each migration is applied in its own transaction along with the new schema version, so a failed migration
+        leaves the schema at the previous version
+
+        :param component: The name of the component, e.g. the name of a cog
+        :param migrations: Ordered list of migrations, each a list of SQL statements
+        :return: The schema version of the component after migrating
+        """
+        version = self.get_schema_version(component)
+        for next_version, statements in enumerate(migrations[version:], start=version + 1):
+            try:
+                with self.transaction():
+                    # Another connection may have applied it since the version was read
+                    if self.get_schema_version(component) < next_version:
+                        for statement in statements:
+                            self.db_execute_commit(statement)
+                        self.db_execute_commit("INSERT OR REPLACE INTO schema_version VALUES (?, ?)",
+                                               args=[component, next_version])
+            except Exception as e:
+                logging.error(f"KoalaDBManager: {component} migration {next_version} failed: {e}")
+                break
+            version = next_version
+        return version
 
-        self.db_execute_commit(sql_create_guild_welcome_messages_table)
-        self.db_execute_commit(sql_create_koala_extensions_table)
-        self.db_execute_commit(sql_create_guild_extensions_table)
-        pass
+    def register_schema(self, component, tables, migrations=None):
+        """ Registers the tables of a component to be created by the next bootstrap
 
-    def insert_extension(self, extension_id: str, subscription_required: int, available: bool, enabled: bool):
-        sql_check_extension_exists = """SELECT * FROM KoalaExtensions WHERE extension_id = ?"""
+        :param component: The name of the component, e.g. the name of a cog
+        :param tables: List of CREATE TABLE IF NOT EXISTS statements
+        :param migrations: Ordered list of migrations of the component, see migrate
+        """
+        with self._bootstrap_lock:
+            self._schemas[component] = (tables, migrations or [])
 
-        if len(self.db_execute_select(sql_check_extension_exists, args=[extension_id])) > 0:
-            sql_update_extension = """
-            UPDATE KoalaExtensions
-            SET subscription_required = ?,
-                available = ?,
-                enabled = ?
-            WHERE extension_id = ?"""
-            self.db_execute_commit(sql_update_extension, args=[subscription_required, available, enabled, extension_id])
+    def register_extension(self, extension_id: str, subscription_required: int, available: bool, enabled: bool):
+        """ Registers an extension to be inserted into KoalaExtensions by the next bootstrap
 
-        else:
+        :param extension_id: The name of the extension
+        :param subscription_required: The subscription level required to use the extension
+        :param available: Whether the extension can be enabled by guilds
+        :param enabled: Whether the extension is enabled
+        """
+        with self._bootstrap_lock:
+            self._extensions[extension_id] = (subscription_required, available, enabled)
+
+    def bootstrap(self):
+        """ Creates the tables and inserts the extensions that have been registered since the last bootstrap in a
+        single transaction, then applies their migrations. Anything already bootstrapped by this process is skipped,
+        so calling this again (e.g. when a cog is reloaded) doesn't touch the database
+
+        :return: The names of the components and extensions that were bootstrapped
+        """
+        with self._bootstrap_lock:
+            components = [component for component in self._schemas if component not in self._bootstrapped]
+            extensions = {extension_id: values for extension_id, values in self._extensions.items()
+                          if self._bootstrapped_extensions.get(extension_id) != values}
+            if BASE_COMPONENT in self._bootstrapped:
+                pending = components
+            else:
+                # KoalaExtensions has to exist before extensions are inserted into it
+                pending = [BASE_COMPONENT] + [component for component in components if component != BASE_COMPONENT]
+            if not pending and not extensions:
+                return []
+
+            started = time.perf_counter()
+            with self.transaction():
+                for component in pending:
+                    for statement in self._schemas[component][0]:
+                        self.db_execute_commit(statement)
+                for extension_id, values in extensions.items():
+                    self.insert_extension(extension_id, *values)
+            for component in pending:
+                if self._schemas[component][1]:
+                    self.migrate(component, self._schemas[component][1])
+            elapsed = time.perf_counter() - started
+
+            self._bootstrapped.update(pending)
+            self._bootstrapped_extensions.update(extensions)
+            bootstrapped = pending + [f"{extension_id} extension" for extension_id in extensions]
+            self.bootstrap_timings.append((bootstrapped, elapsed))
+            logging.info(f"KoalaDBManager: Bootstrapped {', '.join(bootstrapped)} in {elapsed * 1000:.1f}ms")
+            return bootstrapped
+
+    def reset_bootstrap(self):
+        """ Forgets what has been bootstrapped, so the next bootstrap recreates every registered table and extension.
+        Used when tables are dropped or cleared
+        """
+        # Not under the bootstrap lock, as a bootstrap can be waiting on the writer connection held by the caller
+        self._bootstrapped.clear()
+        self._bootstrapped_extensions.clear()
+
+    def startup_report(self):
+        """ Gets a report of the time taken by each bootstrap of the database
+
+        :return: The report as a string, one line per bootstrap followed by the total
+        """
+        lines = [f"{elapsed * 1000:>8.1f}ms  {', '.join(bootstrapped)}"
+                 for bootstrapped, elapsed in self.bootstrap_timings]
+        lines.append(f"{sum(elapsed for _, elapsed in self.bootstrap_timings) * 1000:>8.1f}ms  total "
+                     f"({len(self.bootstrap_timings)} bootstraps)")
+        return "\n".join(lines)
+
+    def create_base_tables(self):
+        """ Creates the base tables, along with anything else registered but not yet bootstrapped
+        """
+        self.bootstrap()
+
+    def insert_extension(self, extension_id: str, subscription_required: int, available: bool, enabled: bool):
+        sql_update_extension = """
+        UPDATE KoalaExtensions
+        SET subscription_required = ?,
+            available = ?,
+            enabled = ?
+        WHERE extension_id = ?"""
+
+        if not self.db_execute_commit(sql_update_extension,
+                                      args=[subscription_required, available, enabled, extension_id]):
             sql_insert_extension = """
             INSERT INTO KoalaExtensions 
             VALUES (?,?,?,?)"""
 
             self.db_execute_commit(sql_insert_extension, args=[extension_id, subscription_required, available, enabled])
 
+    def load_guild_extensions(self):
+        """ Loads the enabled extensions of every guild into memory, replacing the cached extensions
+
+        :return: dict of guild ID to the set of its enabled extension IDs
+        """
+        # The lock isn't held while reading, as the read can wait for the writer, which may need the lock itself
+        with self._guild_extensions_lock:
+            version = self._guild_extensions_version
+        try:
+            rows = self.db_execute_select("SELECT guild_id, extension_id FROM GuildExtensions", pass_errors=True)
+        except Exception as e:
+            print(e)
+            return {}
+        guild_extensions = {}
+        for guild_id, extension_id in rows:
+            guild_extensions.setdefault(int(guild_id), set()).add(extension_id)
+        with self._guild_extensions_lock:
+            if self._guild_extensions_version == version:
+                self._guild_extensions = guild_extensions
+                self._guild_extensions_version += 1
+        return guild_extensions
+
+    def get_guild_extensions(self, guild_id):
+        """ Gets the enabled extensions of a guild from memory, loading every guild's extensions on first use
+
+        :param guild_id: The discord guild ID
+        :return: The set of enabled extension IDs, which should not be modified
+        """
+        guild_extensions = self._guild_extensions
+        if guild_extensions is None:
+            guild_extensions = self.load_guild_extensions()
+        return guild_extensions.get(int(guild_id), frozenset())
 
     def extension_enabled(self, guild_id, extension_id):
-        sql_select_extension = "SELECT extension_id " \
-                               "FROM GuildExtensions " \
-                               "WHERE guild_id = ?"
-        result = self.db_execute_select(sql_select_extension, args=[guild_id])
-        return ("All",) in result or (extension_id,) in result
+        extensions = self.get_guild_extensions(guild_id)
+        return "All" in extensions or extension_id in extensions
 
     def give_guild_extension(self, guild_id, extension_id):
         sql_check_extension_exists = """SELECT * FROM KoalaExtensions WHERE extension_id = ? and available = 1"""
@@ -168,6 +1071,10 @@ class KoalaDBManager:
             INSERT INTO GuildExtensions 
             VALUES (?,?)"""
             self.db_execute_commit(sql_insert_guild_extension, args=[extension_id, guild_id])
+            with self._guild_extensions_lock:
+                self._guild_extensions_version += 1
+                if self._guild_extensions is not None:
+                    self._guild_extensions.setdefault(int(guild_id), set()).add(extension_id)
         else:
             raise NotImplementedError(f"{extension_id} is not a valid extension")
 
@@ -175,6 +1082,10 @@ class KoalaDBManager:
         sql_remove_extension = "DELETE FROM GuildExtensions " \
                                "WHERE extension_id = ? AND guild_id = ?"
         self.db_execute_commit(sql_remove_extension, args=[extension_id, guild_id], pass_errors=True)
+        with self._guild_extensions_lock:
+            self._guild_extensions_version += 1
+            if self._guild_extensions is not None:
+                self._guild_extensions.get(int(guild_id), set()).discard(extension_id)
 
     def get_enabled_guild_extensions(self, guild_id: int):
         sql_select_enabled = "SELECT GuildExtensions.extension_id FROM GuildExtensions, KoalaExtensions " \
@@ -194,6 +1105,10 @@ class KoalaDBManager:
     def clear_all_tables(self, tables):
         for table in tables:
             self.db_execute_commit('DELETE FROM ' + table[0] + ';')
+        self.reset_bootstrap()
+        with self._guild_extensions_lock:
+            self._guild_extensions = None
+            self._guild_extensions_version += 1
 
     def fetch_guild_welcome_message(self, guild_id):
         msg = self.db_execute_select("SELECT * FROM GuildWelcomeMessages WHERE guild_id = ?", args=[guild_id])